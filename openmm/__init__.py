@@ -26,7 +26,7 @@
 
 import os
 
-from scipion.install.funcs import InstallHelper
+import pyworkflow as pw
 
 import pwchem
 
@@ -43,6 +43,8 @@ class Plugin(pwchem.Plugin):
         """
         cls._defineEmVar(OPENMM_DIC['home'], '{}-{}'.format(OPENMM_DIC['name'], OPENMM_DIC['version']))
         cls._defineVar("OPENMM_ENV_ACTIVATION", cls.getEnvActivationCommand(OPENMM_DIC))
+        cls._defineVar(OPENMM_CACHE_DIR, os.path.join(pw.Config.SCIPION_USER_DATA, 'openmm_cache'))
+        cls._defineVar(OPENMM_CACHE_SIZE, '20')
 
     @classmethod
     def defineBinaries(cls, env):
@@ -50,10 +52,12 @@ class Plugin(pwchem.Plugin):
 
     @classmethod
     def addOPENMMPackage(cls, env, default=True):
+        # Only needed when installing, not imported with the plugin
+        from scipion.install.funcs import InstallHelper
         installer = InstallHelper(OPENMM_DIC['name'], packageHome=cls.getVar(OPENMM_DIC['home']),
                                   packageVersion=OPENMM_DIC['version'])
 
-        condaPackages = [f'openmm={OPENMM_DIC["version"]}', 'pdbfixer']
+        condaPackages = [f'openmm={OPENMM_DIC["version"]}', 'pdbfixer', 'openmmforcefields']
 
         installer.getCondaEnvCommand(requirementsFile=False). \
             addCondaPackages(condaPackages, channel='conda-forge'). \
@@ -66,6 +70,23 @@ class Plugin(pwchem.Plugin):
         fnDir = os.path.split(openmm.__file__)[0]
         return os.path.join(fnDir, path)
 
+    @classmethod
+    def getCacheDir(cls, path=""):
+        """ Persistent cache directory shared by the OpenMM protocols of every project """
+        cacheDir = cls.getVar(OPENMM_CACHE_DIR)
+        os.makedirs(cacheDir, exist_ok=True)
+        return os.path.join(cacheDir, path)
+
+    @classmethod
+    def getCacheSizeLimit(cls):
+        """ Maximum size (bytes) of the prepared systems in the cache (OPENMM_CACHE_SIZE, in GB) """
+        return float(cls.getVar(OPENMM_CACHE_SIZE)) * 1024 ** 3
+
+    @classmethod
+    def getLigandCacheFile(cls, ligandFF):
+        """ On-disk cache of the ligand parameters generated with the ligandFF force field """
+        return cls.getCacheDir('ligandTemplates_{}.json'.format(ligandFF))
+
     @classmethod
     def runOpenMM(cls, protocol, program, args, cwd=None):
         """ Run Ambertools command from a given protocol. """
@@ -25,4 +25,8 @@
 # **************************************************************************
 
 
-OPENMM_DIC = {'name': 'openmm',    'version': '7.6', 'home': 'OPENMM_HOME'}
+OPENMM_DIC = {'name': 'openmm',    'version': '8.0', 'home': 'OPENMM_HOME'}
+
+OPENMM_CACHE_DIR = 'OPENMM_CACHE_DIR'
+OPENMM_CACHE_SIZE = 'OPENMM_CACHE_SIZE'
+LIGAND_FFS = ['gaff-2.11', 'gaff-1.81', 'openff-2.0.0', 'openff-1.3.0']
@@ -30,13 +30,23 @@ import pyworkflow.object as pwobj
 
 from pwchem.objects import MDSystem
 
+from .utils import readTrajectoryIndex
+
 
 class OpenMMSystem(MDSystem):
   """A system atom structure (prepared for MD) in the file format of OpenMM
-  _pdbFile: structure file .pdb
+  _pdbFile: structure file, .pdb or PDBx/mmCIF (.cif) for the systems too large for the PDB format
   _trjFile: trajectory file (.dcd)
+  _repFile: state log of the simulation, binary columnar (.bin) or text CSV (.txt) for the older ones
   _ff: main force field
-  _wff: water force field model"""
+  _wff: water force field model
+  _ligFiles: ligand files (.sdf) parametrized with the ligand force field _ligFF
+  _biasFile: bias log (.bin) of an enhanced sampling simulation
+  _biasDir: directory with the metadynamics bias grid
+  _trjIndexFile: frame index (.json) of a trajectory that may still be growing (streamed output)
+  _stateFile: serialized final State (.xml) of a simulation, with velocities and box, to continue it exactly
+  _monitorFile: log (.json) of the sanity monitor of a simulation, with its rollbacks
+  _profileFile: profiling report (.json) of a simulation"""
 
   def __init__(self, filename=None, **kwargs):
     super().__init__(filename=filename, **kwargs)
@@ -44,6 +54,18 @@ class OpenMMSystem(MDSystem):
     self._repFile = pwobj.String(kwargs.get('repFile', None))
     self._nbMethod = pwobj.String(kwargs.get('nonbondedMethod', None))
     self._nbCutoff = pwobj.Float(kwargs.get('nonbondedCutoff', None))
+    self._constraints = pwobj.String(kwargs.get('constraints', None))
+    self._solventType = pwobj.String(kwargs.get('solventType', 'Explicit'))
+    self._saltConc = pwobj.Float(kwargs.get('saltConc', None))
+    self._egFile = pwobj.String(kwargs.get('egFile', None))
+    self._ligFiles = pwobj.String(kwargs.get('ligandFiles', None))
+    self._ligFF = pwobj.String(kwargs.get('ligandFF', None))
+    self._biasFile = pwobj.String(kwargs.get('biasFile', None))
+    self._biasDir = pwobj.String(kwargs.get('biasDir', None))
+    self._trjIndexFile = pwobj.String(kwargs.get('trjIndexFile', None))
+    self._stateFile = pwobj.String(kwargs.get('stateFile', None))
+    self._monitorFile = pwobj.String(kwargs.get('monitorFile', None))
+    self._profileFile = pwobj.String(kwargs.get('profileFile', None))
 
     self._nFrames = pwobj.Integer(kwargs.get('nFrames', None))
     self._nTime = pwobj.Float(kwargs.get('nTime', None))
@@ -52,6 +74,8 @@ class OpenMMSystem(MDSystem):
     strStr = '{} ({}'.format(self.getClassName(), os.path.basename(self.getSystemFile()))
     if self.hasTrajectory():
       strStr += f', frames: {self._nFrames.get()}, time(ps): {self._nTime.get()}'
+      if self.isStreamOpen():
+        strStr += ', running'
     strStr += ')'
     return strStr
 
@@ -61,3 +85,77 @@ class OpenMMSystem(MDSystem):
   def setReportFile(self, value):
     self._repFile.set(value)
 
+  def isPDBx(self):
+    return os.path.splitext(self.getSystemFile())[1].lower() in ['.cif', '.mmcif', '.pdbx']
+
+  def getConstraints(self):
+    return self._constraints.get()
+
+  def getSolventType(self):
+    return self._solventType.get()
+
+  def isImplicit(self):
+    return self.getSolventType() == 'Implicit'
+
+  def getSaltConcentration(self):
+    return self._saltConc.get()
+
+  def getEnergyGroupsFile(self):
+    return self._egFile.get()
+
+  def setEnergyGroupsFile(self, value):
+    self._egFile.set(value)
+
+  def hasLigands(self):
+    return bool(self._ligFiles.get())
+
+  def getLigandFiles(self):
+    return self._ligFiles.get().split(',') if self.hasLigands() else []
+
+  def getLigandForceField(self):
+    return self._ligFF.get()
+
+  def getBiasFile(self):
+    return self._biasFile.get()
+
+  def setBiasFile(self, value):
+    self._biasFile.set(value)
+
+  def getBiasDir(self):
+    return self._biasDir.get()
+
+  def setBiasDir(self, value):
+    self._biasDir.set(value)
+
+  def getStateFile(self):
+    return self._stateFile.get()
+
+  def setStateFile(self, value):
+    self._stateFile.set(value)
+
+  def getMonitorFile(self):
+    return self._monitorFile.get()
+
+  def setMonitorFile(self, value):
+    self._monitorFile.set(value)
+
+  def getProfileFile(self):
+    return self._profileFile.get()
+
+  def setProfileFile(self, value):
+    self._profileFile.set(value)
+
+  def getTrajectoryIndexFile(self):
+    return self._trjIndexFile.get()
+
+  def setTrajectoryIndexFile(self, value):
+    self._trjIndexFile.set(value)
+
+  def getTrajectoryIndex(self):
+    indexFile = self.getTrajectoryIndexFile()
+    return readTrajectoryIndex(indexFile) if indexFile and os.path.exists(indexFile) else None
+
+  def isStreamOpen(self):
+    """Whether the trajectory is still growing, with only the frames in its index available"""
+    index = self.getTrajectoryIndex()
+    return index is not None and not index['finished']
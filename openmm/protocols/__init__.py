@@ -6,4 +6,11 @@
 
 from .protocol_receptor_prep import ProtOpenMMReceptorPrep
 from .protocol_system_prep import ProtOpenMMSystemPrep
-from .protocol_system_simulation import ProtOpenMMSystemSimulation
\ No newline at end of file
+from .protocol_system_simulation import ProtOpenMMSystemSimulation
+from .protocol_energy_decomposition import ProtOpenMMEnergyDecomposition
+from .protocol_replica_exchange import ProtOpenMMReplicaExchange
+from .protocol_alchemical import ProtOpenMMAlchemical
+from .protocol_umbrella_sampling import ProtOpenMMUmbrellaSampling
+from .protocol_adaptive_sampling import ProtOpenMMAdaptiveSampling
+from .protocol_pose_rescoring import ProtOpenMMPoseRescoring
+from .protocol_minimize_set import ProtOpenMMMinimizeSet
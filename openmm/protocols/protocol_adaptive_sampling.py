@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will run an adaptive sampling campaign of short simulations seeded from the under-sampled states
+"""
+import os, json
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from ..objects import OpenMMSystem
+from ..utils import writeSystemParams, runScheduledScript
+
+STATE_FILE = 'adaptive_state.json'
+
+
+class ProtOpenMMAdaptiveSampling(EMProtocol):
+    """
+    This protocol explores the conformations of an OpenMMSystem with rounds of many short simulations instead of a
+    single long one. After each round, the frames of all the trajectories are featurized (backbone dihedrals or
+    alpha carbon contacts) and clustered, and the next round is started from frames of the least visited clusters.
+    The trajectories of each round run in parallel (one per GPU or CPU threads group) and the state of the campaign
+    is stored, so it can be resumed or extended with more rounds by continuing the protocol.
+    """
+    _label = 'adaptive sampling'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The trajectories are distributed "
+                            "among those not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Input system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem', help='OpenMMSystem to sample')
+
+        aGroup = form.addGroup('Adaptive sampling')
+        aGroup.addParam('nRounds', params.IntParam, default=10, label="Number of rounds: ",
+                        help='Number of rounds of simulations. A finished campaign can be extended increasing this '
+                             'number and continuing the protocol')
+        aGroup.addParam('nTrajs', params.IntParam, default=8, label="Trajectories per round: ")
+        aGroup.addParam('nSteps', params.IntParam, default=50000, label="Steps per trajectory: ")
+        aGroup.addParam('saveInterval', params.IntParam, default=500, label="Save frame every (steps): ",
+                        help='Frames are saved and featurized at this interval')
+
+        fGroup = form.addGroup('Featurization and clustering')
+        fGroup.addParam('features', params.EnumParam, default=0, label="Features: ",
+                        choices=['Backbone dihedrals', 'Contact map'],
+                        help='Backbone dihedrals: sine and cosine of the phi and psi dihedrals.\n'
+                             'Contact map: contacts between the alpha carbons (3 or more residues apart)')
+        fGroup.addParam('featureResidues', params.StringParam, default='', label="Featurized residues: ",
+                        help='Residue ids to featurize, as "1-20, 35, B:40". If empty, all the residues are used')
+        fGroup.addParam('contactCutoff', params.FloatParam, default=0.8, label="Contact cutoff (nm): ",
+                        condition='features==1', help='Alpha carbons closer than this distance are in contact')
+        fGroup.addParam('nClusters', params.IntParam, default=50, label="Number of clusters: ",
+                        help='Number of k-means clusters of the accumulated frames. The next round starts from the '
+                             'least visited ones')
+        fGroup.addParam('randomSeed', params.IntParam, default=0, label="Random seed: ",
+                        expertLevel=params.LEVEL_ADVANCED)
+
+        sGroup = form.addGroup('Simulation')
+        sGroup.addParam('temperature', params.FloatParam, default=300, label="Temperature (K): ")
+        sGroup.addParam('stepSize', params.FloatParam, default=0.002, label="Step size for integration (ps): ")
+        sGroup.addParam('fricCoef', params.FloatParam, default=1, label="Friction coefficient (1/ps): ")
+        sGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
+                        choices=['None', 'HBonds', 'AllBonds', 'HAngles'],
+                        help='http://docs.openmm.org/latest/userguide/application/02_running_sims.html#constraints')
+        sGroup.addParam('addBarostat', params.BooleanParam, default=False, label="Add barostat: ")
+        sGroup.addParam('pressure', params.FloatParam, default=1, label="Pressure (bar): ", condition='addBarostat')
+        sGroup.addParam('addMinimization', params.BooleanParam, default=True, label="Minimize input: ",
+                        help='Minimize the input structure before seeding the first round')
+        sGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        condition='addMinimization', expertLevel=params.LEVEL_ADVANCED)
+        sGroup.addParam('maxIter', params.IntParam, default=1000, label="Minimization maximum iterations: ",
+                        condition='addMinimization', expertLevel=params.LEVEL_ADVANCED)
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('adaptiveStep', self.nRounds.get())
+      self._insertFunctionStep('createOutputStep')
+
+    def adaptiveStep(self, nRounds):
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(self.getSystemFilename()))
+        writeSystemParams(f, self.inputSystem.get())
+        f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
+        f.write('features :: {}\n'.format(self.getEnumText('features')))
+        for pName in ['nRounds', 'nTrajs', 'nSteps', 'saveInterval', 'featureResidues', 'contactCutoff', 'nClusters',
+                      'randomSeed', 'temperature', 'stepSize', 'fricCoef', 'addBarostat', 'pressure',
+                      'addMinimization', 'minimTol', 'maxIter']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+      runScheduledScript(self, 'openmmAdaptiveSampling.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      state = self.getCampaignState()
+      nFrames = sum(traj['nFrames'] for traj in state['trajectories'])
+      outSystem = OpenMMSystem()
+      outSystem.copy(self.inputSystem.get(), copyId=False)
+      outSystem.setTrajectoryFile(self._getPath('adaptive.dcd'))
+      outSystem._nFrames.set(nFrames)
+      outSystem._nTime.set(nFrames * self.saveInterval.get() * self.stepSize.get())
+
+      self._defineOutputs(outputSystem=outSystem)
+      self._defineSourceRelation(self.inputSystem, outSystem)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self._getPath(STATE_FILE)):
+        state = self.getCampaignState()
+        nDone = len([traj for traj in state['trajectories'] if traj['done']])
+        summary.append('{} rounds finished, {} trajectories'.format(state['round'], nDone))
+        if state['clusterCounts']:
+          counts = state['clusterCounts']
+          summary.append('{} of {} clusters visited (frames per cluster: min {}, max {})'.format(
+            len([c for c in counts if c > 0]), len(counts), min(counts), max(counts)))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if self.nSteps.get() < self.saveInterval.get():
+        errors.append('The number of steps must be larger than the interval to save the frames')
+      if self.nClusters.get() < 2:
+        errors.append('At least 2 clusters are needed')
+      if self.addBarostat.get() and self.inputSystem.get().isImplicit():
+        errors.append('A barostat cannot be used with an implicit solvent system, which is not periodic')
+      return errors
+
+    # -------------------------- UTILS functions ----------------------
+    def getCampaignState(self):
+      with open(self._getPath(STATE_FILE)) as f:
+        return json.load(f)
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('adaptiveParams.txt'))
+
+    def getSystemFilename(self):
+      return os.path.abspath(self.inputSystem.get().getFileName())
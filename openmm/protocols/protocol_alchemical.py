@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will compute the alchemical decoupling free energy of a region of a system
+"""
+import os
+import numpy as np
+
+from pyworkflow.protocol import params
+import pyworkflow.object as pwobj
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from ..utils import writeSystemParams, parseParamsFile, readBinaryLog, subsampleIndexes, computeMBAR, runScheduledScript
+
+KJ_TO_KCAL = 1 / 4.184
+
+
+class ProtOpenMMAlchemical(EMProtocol):
+    """
+    This protocol computes the free energy of decoupling a region of an OpenMMSystem (usually a ligand) from the
+    rest of the system. The charges of the region are turned off and then its Lennard-Jones interactions, through a
+    softcore potential, over a set of lambda windows that run in parallel. The free energy and its uncertainty are
+    estimated with MBAR.
+    The absolute binding free energy is obtained from the decoupling of the ligand from the complex (restrained) and
+    from the solvent: dG_bind = dG_solvent - dG_complex + restraint correction.
+    """
+    _label = 'alchemical free energy'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The windows are distributed "
+                            "among those not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Input system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem',
+                      help='Explicit solvent OpenMMSystem containing the region to decouple')
+        form.addParam('alchResidues', params.StringParam, default='', label="Alchemical residues: ",
+                      help='Residue ids of the region to decouple, as "1-20, 35". '
+                           'If empty, the non standard residues (ligands) are used.')
+
+        lGroup = form.addGroup('Alchemical states')
+        lGroup.addParam('elecLambdas', params.StringParam, default='1.0, 0.75, 0.5, 0.25, 0.0',
+                        label="Electrostatics lambdas: ",
+                        help='Scaling of the charges of the alchemical region in the first windows')
+        lGroup.addParam('stericsLambdas', params.StringParam,
+                        default='1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0',
+                        label="Sterics lambdas: ",
+                        help='Scaling of the softcore Lennard-Jones interactions of the alchemical region, once its '
+                             'charges are off')
+        lGroup.addParam('softcoreAlpha', params.FloatParam, default=0.5, label="Softcore alpha: ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Softcore parameter avoiding the Lennard-Jones singularities when decoupling')
+
+        rGroup = form.addGroup('Restraint')
+        rGroup.addParam('restrainLigand', params.BooleanParam, default=False, label="Restrain to pocket: ",
+                        help='Restrain the alchemical region to the binding pocket with a flat bottom harmonic '
+                             'restraint between their centroids, needed for the complex leg of a binding free energy')
+        rGroup.addParam('pocketResidues', params.StringParam, default='', label="Pocket residues: ",
+                        condition='restrainLigand', help='Residue ids of the pocket, as "1-20, 35"')
+        rGroup.addParam('restraintRadius', params.FloatParam, default=0.5, label="Flat bottom radius (nm): ",
+                        condition='restrainLigand',
+                        help='Distance between centroids under which the restraint is not applied')
+        rGroup.addParam('restraintK', params.FloatParam, default=1000, label="Force constant (kJ/mol/nm^2): ",
+                        condition='restrainLigand', help='Force constant of the restraint')
+
+        sGroup = form.addGroup('Simulation')
+        sGroup.addParam('temperature', params.FloatParam, default=300, label="Temperature (K): ")
+        sGroup.addParam('stepSize', params.FloatParam, default=0.002, label="Step size for integration (ps): ")
+        sGroup.addParam('fricCoef', params.FloatParam, default=1, label="Friction coefficient (1/ps): ")
+        sGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
+                        choices=['None', 'HBonds', 'AllBonds', 'HAngles'],
+                        help='http://docs.openmm.org/latest/userguide/application/02_running_sims.html#constraints')
+        sGroup.addParam('nEquilSteps', params.IntParam, default=5000, label="Equilibration steps: ",
+                        help='Steps simulated in each window before sampling')
+        sGroup.addParam('nIterations', params.IntParam, default=500, label="Number of samples: ",
+                        help='Number of samples collected in each window')
+        sGroup.addParam('stepsPerIteration', params.IntParam, default=500, label="Steps between samples: ",
+                        help='At each sample, the reduced potential of the configuration is evaluated at all the '
+                             'alchemical states')
+        sGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        expertLevel=params.LEVEL_ADVANCED)
+        sGroup.addParam('maxIter', params.IntParam, default=1000, label="Minimization maximum iterations: ",
+                        expertLevel=params.LEVEL_ADVANCED)
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('alchemicalStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def alchemicalStep(self):
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(os.path.abspath(self.inputSystem.get().getSystemFile())))
+        writeSystemParams(f, self.inputSystem.get())
+        f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
+        f.write('alchResidues :: {}\n'.format(self.alchResidues.get()))
+        f.write('restrainLigand :: {}\n'.format(self.restrainLigand.get()))
+        if self.restrainLigand.get():
+          for pName in ['pocketResidues', 'restraintRadius', 'restraintK']:
+            f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+        for pName in ['elecLambdas', 'stericsLambdas', 'softcoreAlpha', 'temperature', 'stepSize', 'fricCoef',
+                      'nEquilSteps', 'nIterations', 'stepsPerIteration', 'minimTol', 'maxIter']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+      runScheduledScript(self, 'openmmAlchemical.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      nStates = int(parseParamsFile(self._getPath('alchemical_states.txt'))['nStates'])
+      kT = 0.0083144626 * self.temperature.get()
+
+      # Pool the uncorrelated samples of every window
+      uKn, nK = [], []
+      for k in range(nStates):
+        _, data = readBinaryLog(self.getWindowFile(k))
+        idxs = subsampleIndexes(data[:, k + 1])
+        uKn.append(data[idxs, 1:].T)
+        nK.append(len(idxs))
+      fK, dF = computeMBAR(np.concatenate(uKn, axis=1), nK)
+
+      with open(self.getFreeEnergiesFile(), 'w') as f:
+        f.write('deltaG :: {}\ndeltaGError :: {}\n'.format(fK[-1] * kT, dF[0, -1] * kT))
+        for k in range(nStates):
+          f.write('f_{} :: {}\ndf_{} :: {}\nnSamples_{} :: {}\n'.format(k, fK[k] * kT, k, dF[0, k] * kT, k, nK[k]))
+
+      self._defineOutputs(deltaG=pwobj.Float(fK[-1] * kT), deltaGError=pwobj.Float(dF[0, -1] * kT))
+      self._defineSourceRelation(self.inputSystem, self.deltaG)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getFreeEnergiesFile()):
+        fDic = parseParamsFile(self.getFreeEnergiesFile())
+        dG, ddG = float(fDic['deltaG']), float(fDic['deltaGError'])
+        summary.append('Decoupling free energy: {:.2f} +- {:.2f} kJ/mol ({:.2f} +- {:.2f} kcal/mol)'.
+                       format(dG, ddG, dG * KJ_TO_KCAL, ddG * KJ_TO_KCAL))
+
+        statesDic = parseParamsFile(self._getPath('alchemical_states.txt'))
+        if 'restraintCorrection' in statesDic:
+          corr = float(statesDic['restraintCorrection'])
+          summary.append('Restraint standard state correction (to add to the binding free energy): '
+                         '{:.2f} kJ/mol ({:.2f} kcal/mol)'.format(corr, corr * KJ_TO_KCAL))
+      return summary
+
+    def _validate(self):
+      errors = []
+      system = self.inputSystem.get()
+      if system.isImplicit():
+        errors.append('Alchemical decoupling is only available for explicit solvent systems')
+      for pName in ['elecLambdas', 'stericsLambdas']:
+        try:
+          lambdas = [float(l) for l in getattr(self, pName).get().split(',')]
+          if lambdas[0] != 1.0 or lambdas[-1] != 0.0:
+            errors.append('The lambdas must go from 1.0 to 0.0')
+        except ValueError:
+          errors.append('The lambdas must be a list of numbers separated by commas')
+      if self.restrainLigand.get() and not self.pocketResidues.get():
+        errors.append('The pocket residues must be defined to restrain the ligand')
+      return errors
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('alchemicalParams.txt'))
+
+    def getWindowFile(self, k):
+      return self._getPath(f'window_{k}.bin')
+
+    def getFreeEnergiesFile(self):
+      return self._getPath('free_energies.txt')
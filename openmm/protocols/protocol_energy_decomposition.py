@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will decompose the potential energy of a simulated system by force group
+"""
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from ..objects import OpenMMSystem
+from ..utils import writeSystemParams, runScheduledScript
+
+
+class ProtOpenMMEnergyDecomposition(EMProtocol):
+    """
+    This protocol re-evaluates the potential energy of each force group of the system over the frames of a
+    simulated trajectory.
+    """
+    _label = 'energy decomposition'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The frames are evaluated on the first one not "
+                            "used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Input system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem',
+                      help='Simulated OpenMMSystem (with trajectory) to decompose the energy of')
+        form.addParam('stride', params.IntParam, default=1, label="Frames stride: ",
+                      help='Evaluate only one of each "stride" frames of the trajectory')
+
+        form.addParallelSection(threads=1, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('decompositionStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def decompositionStep(self):
+      system = self.inputSystem.get()
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(os.path.abspath(system.getSystemFile())))
+        f.write('trajFile :: {}\n'.format(os.path.abspath(system.getTrajectoryFile())))
+        writeSystemParams(f, system)
+        f.write('constraints :: {}\n'.format(system.getConstraints()))
+        f.write('stride :: {}\n'.format(self.stride.get()))
+        f.write('outputFile :: {}\n'.format(self.getEnergyGroupsFile()))
+
+      runScheduledScript(self, 'openmmEnergyDecomposition.py', self.getParamsFile(), cwd=self._getPath())
+
+    def createOutputStep(self):
+      outSystem = OpenMMSystem()
+      outSystem.copy(self.inputSystem.get(), copyId=False)
+      outSystem.setEnergyGroupsFile(self.getEnergyGroupsFile())
+
+      self._defineOutputs(outputSystem=outSystem)
+      self._defineSourceRelation(self.inputSystem, outSystem)
+
+    def _validate(self):
+      errors = []
+      if not self.inputSystem.get().hasTrajectory():
+        errors.append('The input system must contain a trajectory to decompose its energy')
+      return errors
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('decompositionParams.txt'))
+
+    def getEnergyGroupsFile(self):
+      return os.path.abspath(self._getPath('energy_groups.bin'))
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will minimize the energy of a set of structures
+"""
+import os
+import numpy as np
+
+from pyworkflow.protocol import params
+import pyworkflow.object as pwobj
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+from pwem.objects import SetOfAtomStructs, AtomStruct
+
+from ..utils import readBinaryLog, runScheduledScript
+from .protocol_system_prep import defineForceFieldParams, getForceFieldFiles, hasImplicitParameters
+
+
+class ProtOpenMMMinimizeSet(EMProtocol):
+    """
+    This protocol minimizes the energy of a set of structures (e.g. predicted models or mutants) to relieve their
+    clashes, in vacuum or implicit solvent. The structures are distributed among a pool of workers (one per GPU or
+    CPU threads group), each of them loading the force field once. The System and Context of structures sharing
+    the same topology are reused, only updating their coordinates. The initial and final energies of each structure
+    are reported.
+    """
+    _label = 'minimize structures'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=False,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The structures are distributed "
+                            "among those not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputAtomStructs', params.PointerParam, label="Input structures: ", allowsNull=False,
+                      important=True, pointerClass='SetOfAtomStructs', help='Set of structures (PDB) to minimize')
+
+        defineForceFieldParams(form, waterCondition='False')
+
+        sGroup = form.addGroup('Solvent')
+        sGroup.addParam('solventType', params.EnumParam, label="Solvent type: ", default=1,
+                        choices=['Vacuum', 'Implicit'], display=params.EnumParam.DISPLAY_HLIST,
+                        help='Vacuum: no solvent model.\n'
+                             'Implicit: the solvent is modelled as a continuum (Generalized Born). Not available for '
+                             'CHARMM force fields.')
+        sGroup.addParam('implicitModel', params.EnumParam, label="Implicit solvent model: ", default=0,
+                        choices=['GBn2', 'GBn', 'OBC2', 'OBC1', 'HCT'], condition='solventType == 1',
+                        help='Generalized Born implicit solvent model. '
+                             'http://docs.openmm.org/latest/userguide/application/02_running_sims.html#implicit-solvent')
+        sGroup.addParam('saltConc', params.FloatParam, default=0, label='Salt concentration (M): ',
+                        condition='solventType == 1', help='Salt concentration of the continuum solvent')
+        sGroup.addParam('nonbondedMethod', params.EnumParam, default=0, choices=['NoCutoff', 'CutoffNonPeriodic'],
+                        label="Non bonded method: ", expertLevel=params.LEVEL_ADVANCED,
+                        help='Non bonded method to compute the non bonded atom interactions')
+        sGroup.addParam('nonbondedCutoff', params.FloatParam, default=1.0, expertLevel=params.LEVEL_ADVANCED,
+                        label='Distance cutoff for non bonded interactions (nm): ', condition='nonbondedMethod!=0')
+
+        hGroup = form.addGroup('Hydrogens')
+        hGroup.addParam('addH', params.BooleanParam, default=True, label='Add hydrogens: ',
+                        help='Add the missing hydrogens of the structures')
+        hGroup.addParam('hPH', params.FloatParam, default=7.0, expertLevel=params.LEVEL_ADVANCED,
+                        label='PH for hydrogen addition: ', help='The pH based on which to select variants')
+
+        mGroup = form.addGroup('Minimization')
+        mGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        help='Energy tolerance of the minimization')
+        mGroup.addParam('maxIter', params.IntParam, default=1000, label="Maximum iterations: ",
+                        help='Maximum number of iterations (0 for no limit)')
+        mGroup.addParam('restrainHeavy', params.BooleanParam, default=True, label="Restrain heavy atoms: ",
+                        help='Restrain the heavy atoms to their initial positions, so only the clashes are relieved '
+                             'and the structures are kept close to the input ones')
+        mGroup.addParam('restraintK', params.FloatParam, default=1000, label="Force constant (kJ/mol/nm^2): ",
+                        condition='restrainHeavy')
+        mGroup.addParam('reuseContexts', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                        label="Reuse contexts: ",
+                        help='Structures with the same topology reuse the System and Context built for the first '
+                             'of them, only updating the coordinates')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('minimizeStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def minimizeStep(self):
+      mFF, wFF = self.getFFFiles()
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFiles :: {}\n'.format(','.join(self.getInputFiles())))
+        f.write('outputDir :: {}\n'.format(os.path.abspath(self._getExtraPath())))
+        f.write('mFF :: {}\nwFF :: {}\n'.format(mFF, wFF))
+        f.write('nbMethod :: {}\nnbCutoff :: {}\n'.format(self.getEnumText('nonbondedMethod'),
+                                                         self.nonbondedCutoff.get()))
+        f.write('solventType :: {}\n'.format(self.getEnumText('solventType')))
+        f.write('implicitSalt :: {}\n'.format(self.saltConc.get()))
+        for pName in ['addH', 'hPH', 'minimTol', 'maxIter', 'restrainHeavy', 'restraintK', 'reuseContexts']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+      runScheduledScript(self, 'openmmMinimizeSet.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      _, data = readBinaryLog(self.getEnergiesFile())
+      energies = {int(row[0]): row[1:] for row in data}
+      outputFiles = self.getOutputFiles()
+
+      outSet = self._createSet(SetOfAtomStructs, 'atomStructs%s.sqlite', '')
+      for i in sorted(energies):
+        initEnergy, finalEnergy, rmsd = energies[i]
+        aStruct = AtomStruct(filename=outputFiles[i])
+        aStruct._initialEnergy = pwobj.Float(initEnergy)
+        aStruct._finalEnergy = pwobj.Float(finalEnergy)
+        # Heavy atoms RMSD to the input structure, in Angstroms
+        aStruct._minimizationRMSD = pwobj.Float(10 * rmsd)
+        outSet.append(aStruct)
+
+      self._defineOutputs(outputAtomStructs=outSet)
+      self._defineSourceRelation(self.inputAtomStructs, outSet)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getEnergiesFile()):
+        _, data = readBinaryLog(self.getEnergiesFile())
+        summary.append('{} structures minimized'.format(len(data)))
+        if len(data):
+          summary.append('Median energy: {:.1f} -> {:.1f} kJ/mol. Median heavy atoms RMSD: {:.2f} A'.format(
+            np.median(data[:, 1]), np.median(data[:, 2]), 10 * np.median(data[:, 3])))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if self.solventType.get() == 1 and not hasImplicitParameters(self):
+        errors.append('Implicit solvent models are not available for CHARMM force fields')
+      return errors
+
+    # -------------------------- UTILS functions ----------------------
+    def getFFFiles(self):
+      return getForceFieldFiles(self, self.getEnumText('implicitModel') if self.solventType.get() == 1 else None)
+
+    def getInputFiles(self):
+      return [os.path.abspath(aStruct.getFileName()) for aStruct in self.inputAtomStructs.get()]
+
+    def getOutputFiles(self):
+      return [os.path.abspath(self._getExtraPath('min_{}_{}'.format(i + 1, os.path.basename(inFile))))
+              for i, inFile in enumerate(self.getInputFiles())]
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('minimizationParams.txt'))
+
+    def getEnergiesFile(self):
+      return self._getPath('minimization.bin')
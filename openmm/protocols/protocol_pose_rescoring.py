@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will rescore a set of docked poses with short MD simulations of the complexes
+"""
+import os
+import numpy as np
+
+from pyworkflow.protocol import params
+import pyworkflow.object as pwobj
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from pwchem.objects import SetOfSmallMolecules
+from pwchem.utils import convertToSdf
+
+from .. import Plugin
+from ..constants import LIGAND_FFS
+from ..utils import writeSystemParams, readBinaryLog, runScheduledScript
+
+
+class ProtOpenMMPoseRescoring(EMProtocol):
+    """
+    This protocol rescores a set of docked poses by their stability in short MD simulations. The receptor
+    OpenMMSystem is built once and, for each pose, the parametrized ligand is appended to it, then the complex is
+    minimized and simulated. The poses are distributed among a pool of workers (one per GPU or CPU threads group).
+    For each pose, the RMSD of the ligand respect to the docked pose (after superposing the pocket) and its
+    interaction energy with the environment (Lennard-Jones and reaction field Coulomb) are reported.
+    """
+    _label = 'MD pose rescoring'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The poses are distributed "
+                            "among those not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Receptor system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem',
+                      help='OpenMMSystem of the receptor, prepared without the docked ligands. Implicit solvent '
+                           'systems are recommended to rescore many poses')
+        form.addParam('inputSmallMolecules', params.PointerParam, pointerClass='SetOfSmallMolecules',
+                      allowsNull=False, important=True, label='Docked poses: ',
+                      help='Docked poses to rescore. Their coordinates must be placed in the receptor frame and '
+                           'contain all hydrogens.')
+        form.addParam('ligandFF', params.EnumParam, default=0, choices=LIGAND_FFS, label='Ligand force field: ',
+                      help='Force field used to parametrize the ligands: GAFF (with AM1-BCC charges) or '
+                           'SMIRNOFF (Open Force Field). The parameters of each molecule are generated once and '
+                           'stored in a persistent cache. https://github.com/openmm/openmmforcefields')
+
+        sGroup = form.addGroup('Simulation')
+        sGroup.addParam('nSteps', params.IntParam, default=25000, label="Steps per pose: ")
+        sGroup.addParam('saveInterval', params.IntParam, default=500, label="Evaluate every (steps): ",
+                        help='Interval at which the ligand RMSD and interaction energy are computed')
+        sGroup.addParam('temperature', params.FloatParam, default=300, label="Temperature (K): ")
+        sGroup.addParam('stepSize', params.FloatParam, default=0.002, label="Step size for integration (ps): ")
+        sGroup.addParam('fricCoef', params.FloatParam, default=1, label="Friction coefficient (1/ps): ")
+        sGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
+                        choices=['None', 'HBonds', 'AllBonds', 'HAngles'],
+                        help='http://docs.openmm.org/latest/userguide/application/02_running_sims.html#constraints')
+        sGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        expertLevel=params.LEVEL_ADVANCED)
+        sGroup.addParam('maxIter', params.IntParam, default=1000, label="Minimization maximum iterations: ",
+                        expertLevel=params.LEVEL_ADVANCED)
+
+        rGroup = form.addGroup('Receptor')
+        rGroup.addParam('restrainReceptor', params.BooleanParam, default=True, label="Restrain receptor: ",
+                        help='Restrain the receptor heavy atoms to their initial positions, so the ligand stability '
+                             'is measured in the docked receptor conformation')
+        rGroup.addParam('restraintK', params.FloatParam, default=100, label="Force constant (kJ/mol/nm^2): ",
+                        condition='restrainReceptor')
+        rGroup.addParam('waterClearance', params.FloatParam, default=0.2, label="Water clearance (nm): ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='In explicit solvent systems, the waters closer to the pose than this distance are '
+                             'turned into non interacting particles')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('convertStep')
+      self._insertFunctionStep('rescoringStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def convertStep(self):
+      for i, mol in enumerate(self.inputSmallMolecules.get()):
+        molFile = mol.getPoseFile() or mol.getFileName()
+        convertToSdf(self, os.path.abspath(molFile), self.getPoseFiles()[i], overWrite=True)
+
+    def rescoringStep(self):
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(self.getSystemFilename()))
+        writeSystemParams(f, self.inputSystem.get())
+        f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
+        f.write('poseFiles :: {}\n'.format(','.join(self.getPoseFiles())))
+        f.write('poseFF :: {}\n'.format(self.getEnumText('ligandFF')))
+        f.write('poseCache :: {}\n'.format(Plugin.getLigandCacheFile(self.getEnumText('ligandFF'))))
+        for pName in ['nSteps', 'saveInterval', 'temperature', 'stepSize', 'fricCoef', 'minimTol', 'maxIter',
+                      'restrainReceptor', 'restraintK', 'waterClearance']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+      runScheduledScript(self, 'openmmPoseRescoring.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      metrics = self.getPoseMetrics()
+      inSet = self.inputSmallMolecules.get()
+      outSet = self._createSet(SetOfSmallMolecules, 'smallMolecules%s.sqlite', '')
+      outSet.copyInfo(inSet)
+      for i, mol in enumerate(inSet):
+        newMol = mol.clone()
+        rmsds, energies = metrics[i]
+        # RMSDs in Angstroms
+        newMol._mdMeanRMSD = pwobj.Float(10 * np.mean(rmsds[1:]))
+        newMol._mdFinalRMSD = pwobj.Float(10 * rmsds[-1])
+        newMol._mdInteractionEnergy = pwobj.Float(np.mean(energies[1:]))
+        newMol._mdInteractionEnergyStd = pwobj.Float(np.std(energies[1:]))
+        outSet.append(newMol)
+
+      self._defineOutputs(outputSmallMolecules=outSet)
+      self._defineSourceRelation(self.inputSmallMolecules, outSet)
+      self._defineSourceRelation(self.inputSystem, outSet)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getMetricsFile()):
+        metrics = self.getPoseMetrics()
+        stable = [i for i, (rmsds, _) in metrics.items() if 10 * rmsds[-1] < 2.0]
+        summary.append('{} poses rescored, {} stable (final ligand RMSD < 2 A)'.format(len(metrics), len(stable)))
+        if metrics:
+          best = min(metrics, key=lambda i: np.mean(metrics[i][1][1:]))
+          summary.append('Lowest mean interaction energy: pose {} ({:.1f} kJ/mol)'.format(
+            best + 1, np.mean(metrics[best][1][1:])))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if self.nSteps.get() < self.saveInterval.get():
+        errors.append('The number of steps must be larger than the evaluation interval')
+      return errors
+
+    # -------------------------- UTILS functions ----------------------
+    def getPoseMetrics(self):
+      """Returns the ligand RMSDs (nm) and interaction energies (kJ/mol) of each pose over its simulation (the first
+      values, of the minimized pose)"""
+      _, data = readBinaryLog(self.getMetricsFile())
+      data = data[np.lexsort((data[:, 1], data[:, 0]))]
+      metrics = {}
+      for pose in np.unique(data[:, 0]).astype(int):
+        poseData = data[data[:, 0] == pose]
+        metrics[pose] = (poseData[:, 2], poseData[:, 3])
+      return metrics
+
+    def getPoseFiles(self):
+      return [os.path.abspath(self._getExtraPath('pose_{}.sdf'.format(i + 1)))
+              for i in range(len(self.inputSmallMolecules.get()))]
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('rescoringParams.txt'))
+
+    def getMetricsFile(self):
+      return self._getPath('pose_metrics.bin')
+
+    def getSystemFilename(self):
+      return os.path.abspath(self.inputSystem.get().getFileName())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will run a replica exchange simulation of a system
+"""
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from ..objects import OpenMMSystem
+from ..utils import writeSystemParams, parseParamsFile, getStructureFile, runScheduledScript
+
+
+class ProtOpenMMReplicaExchange(EMProtocol):
+    """
+    This protocol runs a replica exchange simulation (temperature REMD or Hamiltonian REST2) over an OpenMMSystem.
+    All the replicas run in a single process, with one context per replica built from the same System, and
+    exchanges between neighbour replicas are attempted at fixed intervals.
+    """
+    _label = 'replica exchange simulation'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The replicas are distributed over the "
+                            "ones not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Input system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem', help='OpenMMSystem to execute the simulation over')
+
+        rGroup = form.addGroup('Replica exchange')
+        rGroup.addParam('remdType', params.EnumParam, default=0, label="Replica exchange type: ",
+                        choices=['Temperature', 'REST2'], display=params.EnumParam.DISPLAY_HLIST,
+                        help='Temperature: each replica is simulated at a different temperature.\n'
+                             'REST2: replica exchange with solute tempering. Every replica runs at the minimum '
+                             'temperature, but the interactions of the solute are scaled to its effective temperature. '
+                             'Only the solute is heated, so much fewer replicas are needed for solvated systems.')
+        rGroup.addParam('soluteResidues', params.StringParam, default='', condition='remdType==1',
+                        label="Solute residues: ",
+                        help='Residue ids of the solute to temper, as "1-20, 35". '
+                             'If empty, all the residues but water and ions are used.')
+        rGroup.addParam('nReplicas', params.IntParam, default=4, label="Number of replicas: ",
+                        help='Number of replicas (thermodynamic states) to simulate')
+        line = rGroup.addLine('Temperature range (K): ',
+                              help='Minimum and maximum (effective) temperatures of the replicas, which follow a '
+                                   'geometric ladder between them')
+        line.addParam('minTemp', params.FloatParam, default=300, label='Min: ')
+        line.addParam('maxTemp', params.FloatParam, default=400, label='Max: ')
+        rGroup.addParam('exchangeInterval', params.IntParam, default=500, label="Exchange interval (steps): ",
+                        help='Number of steps simulated by each replica between exchange attempts')
+        rGroup.addParam('nExchanges', params.IntParam, default=100, label="Number of exchange attempts: ",
+                        help='Number of exchange cycles. The total length of each replica is this number times the '
+                             'exchange interval')
+        rGroup.addParam('saveFrequency', params.IntParam, default=1, label="Save trajectory every (exchanges): ",
+                        help='Save a frame of the per replica and per temperature trajectories each x exchange cycles')
+
+        iGroup = form.addGroup('Integrator')
+        iGroup.addParam('stepSize', params.FloatParam, default=0.002, label="Step size for integration (ps): ",
+                        help='The step size with which to integrate the system (in picoseconds)')
+        iGroup.addParam('fricCoef', params.FloatParam, default=1, label="Friction coefficient (1/ps): ",
+                        help='The friction coefficient which couples the system to the heat bath (in inverse '
+                             'picoseconds)')
+        iGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
+                        choices=['None', 'HBonds', 'AllBonds', 'HAngles'],
+                        help='http://docs.openmm.org/latest/userguide/application/02_running_sims.html#constraints')
+
+        mGroup = form.addGroup('Minimization')
+        mGroup.addParam('addMinimization', params.BooleanParam, default=True, label="Add minimization: ",
+                        help='Add energy minimization before the simulation')
+        mGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        condition='addMinimization',
+                        help='This specifies how precisely the energy minimum must be located.')
+        mGroup.addParam('maxIter', params.IntParam, default=10000, label="Maximum iterations: ",
+                        condition='addMinimization', help='The maximum number of minimization iterations.')
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('replicaExchangeStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def replicaExchangeStep(self):
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(self.getSystemFilename()))
+        writeSystemParams(f, self.inputSystem.get())
+        f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
+
+        f.write('remdType :: {}\n'.format(self.getEnumText('remdType')))
+        f.write('soluteResidues :: {}\n'.format(self.soluteResidues.get()))
+        for pName in ['nReplicas', 'minTemp', 'maxTemp', 'exchangeInterval', 'nExchanges', 'saveFrequency',
+                      'stepSize', 'fricCoef', 'addMinimization', 'minimTol', 'maxIter']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+        f.write('temperature :: {}\n'.format(self.minTemp.get()))
+
+      # The replicas are distributed over all the free GPUs of the list
+      runScheduledScript(self, 'openmmReplicaExchange.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      inSystem = self.inputSystem.get()
+      nFrames = self.nExchanges.get() // self.saveFrequency.get()
+      nTime = self.nExchanges.get() * self.exchangeInterval.get() * self.stepSize.get()
+
+      outSystem = OpenMMSystem(filename=getStructureFile(self._getPath(self.getSystemName())),
+                               ff=inSystem.getForceField(), wff=inSystem.getWaterForceField(),
+                               nFrames=nFrames, nTime=nTime,
+                               nonbondedMethod=inSystem._nbMethod.get(), nonbondedCutoff=inSystem._nbCutoff.get(),
+                               constraints=self.getEnumText('constraints'),
+                               solventType=inSystem.getSolventType(), saltConc=inSystem.getSaltConcentration(),
+                               ligandFiles=inSystem._ligFiles.get(), ligandFF=inSystem.getLigandForceField())
+      outSystem.setOriStructFile(self.getSystemFilename())
+      outSystem.setTrajectoryFile(self._getPath('state_0.dcd'))
+
+      self._defineOutputs(outputSystem=outSystem)
+      self._defineSourceRelation(self.inputSystem, outSystem)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getStatsFile()):
+        stats = parseParamsFile(self.getStatsFile())
+        for k in range(self.nReplicas.get() - 1):
+          tKey = 'effectiveTemperature' if self.remdType.get() == 1 else 'temperature'
+          summary.append('Acceptance {:.1f}K - {:.1f}K: {:.2f}'.format(
+            float(stats[f'{tKey}_{k}']), float(stats[f'{tKey}_{k + 1}']), float(stats[f'acceptance_{k}_{k + 1}'])))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if self.nReplicas.get() < 2:
+        errors.append('At least two replicas are needed for replica exchange')
+      if self.minTemp.get() >= self.maxTemp.get():
+        errors.append('The maximum temperature must be higher than the minimum temperature')
+      return errors
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('replicaExchangeParams.txt'))
+
+    def getStatsFile(self):
+      return self._getPath('exchange_stats.txt')
+
+    def getSystemFilename(self):
+      return os.path.abspath(self.inputSystem.get().getFileName())
+
+    def getSystemName(self):
+      return self.inputSystem.get().getSystemName()
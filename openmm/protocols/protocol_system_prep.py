@@ -29,17 +29,89 @@
 """
 This module will prepare the system for the simulation
 """
-import os
+import os, shutil
 
 from pyworkflow.protocol import params
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 
-from pwchem.utils import getBaseName
+from pwchem.utils import getBaseName, convertToSdf
 
 from .. import Plugin
-from ..constants import OPENMM_DIC
+from ..constants import LIGAND_FFS
 from ..objects import OpenMMSystem
+from ..utils import writeLigandParams, hashInputs, storeInCache, isInCache, evictCache, parseParamsFile, \
+  getStructureFile, runScheduledScript
+
+
+def defineForceFieldParams(form, waterCondition='True'):
+  """Defines the parameters to choose the main and water force fields of a system. The water force field parameters
+  are only shown if waterCondition is met"""
+  ffGroup = form.addGroup('System force fields')
+  ffGroup.addParam('ffType', params.EnumParam, default=0, choices=['Amber14', 'CHARMM36', 'Old'],
+                   label="Main atomic force field: ", help='Main force field to use')
+  ffGroup.addParam('ffAmberType', params.EnumParam, default=0, expertLevel=params.LEVEL_ADVANCED,
+                   condition='ffType==0', label="Amber atomic force field: ",
+                   choices=['All', 'protein.ff14SB', 'protein.ff15ipq', 'DNA.OL15', 'DNA.bsc1', 'RNA.OL3', 'lipid17'],
+                   help='Amber main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amber14')
+  ffGroup.addParam('ffAmberWaterType', params.EnumParam, default=3, condition='ffType==0 and {}'.format(waterCondition),
+                   label="Amber water force field: ",
+                   choices=['SPCE', 'OPC', 'OPC3', 'tip3p', 'tip3pfb', 'tip4pew', 'tip4pfb'],
+                   help='Water amber force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amber14')
+
+  ffGroup.addParam('ffCHARMMWaterType', params.EnumParam, default=0, condition='ffType==1 and {}'.format(waterCondition),
+                   label="CHARMM water force field: ", expertLevel=params.LEVEL_ADVANCED,
+                   choices=['Water', 'SPCE', 'tip3p-pme-b', 'tip3p-pme-f', 'tip4pew', 'tip4p2005', 'tip5p', 'tip5pew'],
+                   help='Water CHARMM force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#charmm36')
+
+  # ffGroup.addParam('ffAMOEBAType', params.EnumParam, default=0, expertLevel=params.LEVEL_ADVANCED,
+  #                  choices=['2018', '2013', '2009'], condition='ffType==2', label="AMOEBA atomic force field: ",
+  #                  help='AMOEBA main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amoeba')
+  # ffGroup.addParam('useAMOEBAImplicit', params.BooleanParam, default=False,
+  #                  label='Use AMOEBA implicit solvent: ', condition='ffType==2',
+  #                  help='Whether to use the implicit or explicit AMOEBA solvent model')
+
+  ffGroup.addParam('ffOldType', params.EnumParam, default=0,
+                   choices=['amber96', 'amber99sb', 'amber99sbildn', 'amber99sbnmr', 'amber03', 'amber10', 'charmm_polar_2013'],
+                   condition='ffType==2', label="Older force field: ",
+                   help='Select an older main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#older-force-fields')
+
+  ffGroup.addParam('ffWaterType', params.EnumParam, default=0,
+                   choices=['tip3p', 'tip3pfb', 'tip4pew', 'tip4pfb', 'tip5p', 'spce', 'swm4ndp', 'opc', 'opc3'],
+                   condition='ffType==2 and {}'.format(waterCondition), label="Water force field: ",
+                   help='Select an water force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#water-models')
+
+
+def getForceFieldFiles(protocol, implicitModel=None):
+  """Returns the main and water force field files chosen in the params defined by defineForceFieldParams.
+  If an implicit solvent model is given, its file replaces the water force field"""
+  if protocol.ffType.get() == 0:
+    mFF = 'amber14-all.xml' if protocol.ffAmberType.get() == 0 \
+      else 'amber14/{}.xml'.format(protocol.getEnumText('ffAmberType'))
+    wFF = 'amber14/{}.xml'.format(protocol.getEnumText('ffAmberWaterType').lower())
+
+  elif protocol.ffType.get() == 1:
+    mFF = 'charmm36.xml'
+    wFF = 'charmm36/{}.xml'.format(protocol.getEnumText('ffCHARMMWaterType').lower())
+
+  # elif protocol.ffType.get() == 2:
+  #   mFF = 'amoeba{}.xml'.format(protocol.getEnumText('ffAMOEBAType'))
+  #   # wFF = '{}.xml'.format(protocol.getEnumText('ffWaterType'))
+  #   ffs = [mFF]
+
+  elif protocol.ffType.get() == 2:
+    mFF = '{}.xml'.format(protocol.getEnumText('ffOldType'))
+    wFF = '{}.xml'.format(protocol.getEnumText('ffWaterType'))
+
+  if implicitModel:
+    wFF = 'implicit/{}.xml'.format(implicitModel.lower())
+
+  return mFF, wFF
+
+def hasImplicitParameters(protocol):
+  """Whether the force field chosen in the params defined by defineForceFieldParams has implicit solvent
+  parameters (CHARMM force fields do not)"""
+  return not (protocol.ffType.get() == 1 or (protocol.ffType.get() == 2 and protocol.ffOldType.get() == 6))
 
 
 class ProtOpenMMSystemPrep(EMProtocol):
@@ -62,52 +134,40 @@ class ProtOpenMMSystemPrep(EMProtocol):
 
         """ Define the input parameters that will be used.
         """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=False,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The system is prepared (e.g. the membrane "
+                            "relaxed) on the first one not used by other OpenMM jobs of the node")
 
         form.addSection(label=Message.LABEL_INPUT)
         form.addParam('inputStructure', params.PointerParam, label="Input structure: ", allowsNull=False,
                       important=True, pointerClass='AtomStruct', help='Atom structure to convert to OpenMM system')
 
-        ffGroup = form.addGroup('System force fields')
-        ffGroup.addParam('ffType', params.EnumParam, default=0, choices=['Amber14', 'CHARMM36', 'Old'],
-                         label="Main atomic force field: ", help='Main force field to use')
-        ffGroup.addParam('ffAmberType', params.EnumParam, default=0, expertLevel=params.LEVEL_ADVANCED,
-                         condition='ffType==0', label="Amber atomic force field: ",
-                         choices=['All', 'protein.ff14SB', 'protein.ff15ipq', 'DNA.OL15', 'DNA.bsc1', 'RNA.OL3', 'lipid17'],
-                         help='Amber main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amber14')
-        ffGroup.addParam('ffAmberWaterType', params.EnumParam, default=3, condition='ffType==0', label="Amber water force field: ",
-                         choices=['SPCE', 'OPC', 'OPC3', 'tip3p', 'tip3pfb', 'tip4pew', 'tip4pfb'],
-                         help='Water amber force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amber14')
-
-        ffGroup.addParam('ffCHARMMWaterType', params.EnumParam, default=0, condition='ffType==1',
-                         label="CHARMM water force field: ", expertLevel=params.LEVEL_ADVANCED,
-                         choices=['Water', 'SPCE', 'tip3p-pme-b', 'tip3p-pme-f', 'tip4pew', 'tip4p2005', 'tip5p', 'tip5pew'],
-                         help='Water CHARMM force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#charmm36')
-
-        # ffGroup.addParam('ffAMOEBAType', params.EnumParam, default=0, expertLevel=params.LEVEL_ADVANCED,
-        #                  choices=['2018', '2013', '2009'], condition='ffType==2', label="AMOEBA atomic force field: ",
-        #                  help='AMOEBA main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#amoeba')
-        # ffGroup.addParam('useAMOEBAImplicit', params.BooleanParam, default=False,
-        #                  label='Use AMOEBA implicit solvent: ', condition='ffType==2',
-        #                  help='Whether to use the implicit or explicit AMOEBA solvent model')
-
-        ffGroup.addParam('ffOldType', params.EnumParam, default=0,
-                         choices=['amber96', 'amber99sb', 'amber99sbildn', 'amber99sbnmr', 'amber03', 'amber10', 'charmm_polar_2013'],
-                         condition='ffType==2', label="Older force field: ",
-                         help='Select an older main force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#older-force-fields')
-        # ffGroup.addParam('useOldImplicit', params.BooleanParam, default=False,
-        #                  label='Use implicit solvent: ', condition='ffType==3',
-        #                  help='Whether to use the implicit or explicit solvent model for Amber old force fields')
-
-        ffGroup.addParam('ffWaterType', params.EnumParam, default=0,
-                         choices=['tip3p', 'tip3pfb', 'tip4pew', 'tip4pfb', 'tip5p', 'spce', 'swm4ndp', 'opc', 'opc3'],
-                         condition='ffType==2', label="Water force field: ",
-                         help='Select an water force field to use. http://docs.openmm.org/latest/userguide/application/02_running_sims.html#water-models')
+        lGroup = form.addGroup('Ligands')
+        lGroup.addParam('addLigands', params.BooleanParam, default=False, label='Add ligands to the system: ',
+                        help='Add small molecules (e.g. docked ligands or cofactors) to the system, forming a complex. '
+                             'Their parameters are generated with the chosen ligand force field and stored in a '
+                             'persistent cache, so the same ligand is only parametrized once.')
+        lGroup.addParam('inputSmallMolecules', params.PointerParam, pointerClass='SetOfSmallMolecules',
+                        condition='addLigands', allowsNull=True, label='Input ligands: ',
+                        help='Small molecules to add to the system. Their coordinates must be placed in the '
+                             'structure frame and contain all hydrogens.')
+        lGroup.addParam('ligandFF', params.EnumParam, default=0, condition='addLigands', choices=LIGAND_FFS,
+                        label='Ligand force field: ',
+                        help='Force field used to parametrize the ligands: GAFF (with AM1-BCC charges) or '
+                             'SMIRNOFF (Open Force Field). https://github.com/openmm/openmmforcefields')
+
+        defineForceFieldParams(form, waterCondition='solventType==0')
 
         ffGroup = form.addGroup('Non bonded interactions')
         ffGroup.addParam('nonbondedMethod', params.EnumParam, default=0,
                          choices=['NoCutoff', 'CutoffNonPeriodic', 'CutoffPeriodic', 'Ewald', 'PME', 'LJPME'],
                          label="Non bonded method: ",
-                         help='Non bonded method to simulate the non bonded atom interactions')
+                         help='Non bonded method to simulate the non bonded atom interactions.\n'
+                              'Periodic methods are replaced by CutoffNonPeriodic for implicit solvent systems')
         ffGroup.addParam('nonbondedCutoff', params.FloatParam, default=1.0, expertLevel=params.LEVEL_ADVANCED,
                          label='Distance cutoff for non bonded interactions (nm): ', condition='nonbondedMethod!=0',
                          help='TThe cutoff distance to use for nonbonded interactions')
@@ -120,7 +180,35 @@ class ProtOpenMMSystemPrep(EMProtocol):
         # todo: allow the use of variants
 
         form.addSection(label='Solvent box')
-        sGroup = form.addGroup('Boundary box')
+        sGroup = form.addGroup('Solvent')
+        sGroup.addParam('solventType', params.EnumParam, label="Solvent type: ", default=0,
+                        choices=['Explicit', 'Implicit', 'Membrane'], display=params.EnumParam.DISPLAY_HLIST,
+                        help='Explicit: the system is solvated in a box of water molecules\n'
+                             'Implicit: the solvent is modelled as a continuum (Generalized Born). No water box is '
+                             'built, which greatly reduces the number of atoms and the cost of quick stability or '
+                             'refinement simulations. Not available for CHARMM force fields.\n'
+                             'Membrane: the structure is embedded in a lipid bilayer, placed on the XY plane, and '
+                             'solvated with explicit water. Needs a force field with lipid parameters (Amber14 "All" '
+                             'or CHARMM36)')
+        sGroup.addParam('implicitModel', params.EnumParam, label="Implicit solvent model: ", default=0,
+                        choices=['GBn2', 'GBn', 'OBC2', 'OBC1', 'HCT'], condition='solventType == 1',
+                        help='Generalized Born implicit solvent model. '
+                             'http://docs.openmm.org/latest/userguide/application/02_running_sims.html#implicit-solvent')
+
+        mGroup = form.addGroup('Membrane', condition='solventType == 2')
+        mGroup.addParam('lipidType', params.EnumParam, label="Lipid type: ", default=0,
+                        choices=['POPC', 'POPE', 'DLPC', 'DLPE', 'DMPC', 'DOPC', 'DPPC'],
+                        help='Lipid forming the membrane, built from a pre-equilibrated patch')
+        mGroup.addParam('memPadding', params.FloatParam, default=1.0, label='Minimum padding (nm): ',
+                        help='Minimum distance (nm) from the structure to the edges of the membrane in the XY plane')
+        mGroup.addParam('memCenterZ', params.FloatParam, default=0.0, label='Membrane center Z (nm): ',
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Position of the center of the membrane along the Z axis (nm), in the structure frame')
+        mGroup.addParam('orientProtein', params.BooleanParam, default=False, label='Orient structure along Z: ',
+                        help='Center the structure and align its longest principal axis with the membrane normal (Z). '
+                             'Leave it unset if the structure is already oriented (e.g. taken from OPM)')
+
+        sGroup = form.addGroup('Boundary box', condition='solventType == 0')
         sGroup.addParam('sizeType', params.EnumParam, label="System size type: ", default=1,
                         choices=['Absolute', 'Padding'], display=params.EnumParam.DISPLAY_HLIST,
                         help='Absolute: absolute size of the box (diameter)\n'
@@ -134,22 +222,45 @@ class ProtOpenMMSystemPrep(EMProtocol):
         sGroup.addParam('padDist', params.FloatParam, condition='sizeType == 1',
                         default=1.0, label='Padding distance: ',
                         help='Distance (nm) from the solute to the edge of the box.')
+        sGroup.addParam('boxShape', params.EnumParam, condition='sizeType == 1', default=0,
+                        choices=['Cube', 'Dodecahedron', 'Octahedron'], label='Box shape: ',
+                        help='Shape of the periodic box. For the same padding, a rhombic dodecahedron has 70.7% of the '
+                             'volume of a cube and a truncated octahedron 77.0%, so globular solutes need much less '
+                             'water. The resulting number of atoms and the estimated speedup over a cubic box are '
+                             'shown in the summary.')
+        sGroup.addParam('fastSolvation', params.BooleanParam, default=False, label='Fast solvation: ',
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Place the waters and ions with array operations instead of molecule by molecule. '
+                             'It builds the same kind of box, tens of times faster for boxes of hundreds of '
+                             'thousands of atoms')
 
         iGroup = form.addGroup('Ions')
         iGroup.addParam('saltConc', params.FloatParam, default=0, label='Salt concentration (M): ',
-                        help='Ionic strength to prepare the system')
+                        help='Ionic strength to prepare the system. For implicit solvent, the salt concentration '
+                             'of the continuum solvent')
 
         iGroup.addParam('neutralize', params.BooleanParam, default=True, label='Neutralize system: ',
-                        help='Whether to add ions to the system until neutralize.')
+                        condition='solventType != 1', help='Whether to add ions to the system until neutralize.')
 
-        iGroup.addParam('cationType', params.EnumParam,
+        iGroup.addParam('cationType', params.EnumParam, condition='solventType != 1',
                       label='Cation to add: ', choices=self._cations, default=3,
                       help='Which cation to add in the system')
 
-        iGroup.addParam('anionType', params.EnumParam,
+        iGroup.addParam('anionType', params.EnumParam, condition='solventType != 1',
                       label='Anions to add: ', choices=self._anions, default=0,
                       help='Which anion to add in the system')
 
+        cGroup = form.addGroup('Cache')
+        cGroup.addParam('useCache', params.BooleanParam, default=True, label='Reuse cached systems: ',
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Adding hydrogens and building the solvent box (or membrane) is expensive for large '
+                             'systems. Prepared systems are stored in a persistent cache shared by every project, '
+                             'keyed by the contents of the input files and the preparation parameters, so repeating '
+                             'a preparation reuses them instead of rebuilding. The least recently used systems are '
+                             'removed when the cache exceeds OPENMM_CACHE_SIZE (GB)')
+
+        form.addParallelSection(threads=4, mpi=1)
+
     def _insertAllSteps(self):
       self._insertFunctionStep('solvateStep')
       self._insertFunctionStep('createOutputStep')
@@ -157,6 +268,8 @@ class ProtOpenMMSystemPrep(EMProtocol):
 
     def solvateStep(self):
       inFile = self.getSystemFilename()
+      if self.addLigands.get():
+        self.convertLigands()
 
       with open(self.getParamsFile(), 'w') as f:
         f.write('inputFile :: {}\n'.format(inFile))
@@ -165,36 +278,129 @@ class ProtOpenMMSystemPrep(EMProtocol):
 
         wModel = self.getWaterModel(wFF)
         f.write('wModel :: {}\n'.format(wModel))
+        writeLigandParams(f, self.getLigandFiles(), self.getLigandFF())
 
         f.write('addH :: {}\n'.format(self.addH.get()))
         if self.addH.get():
           f.write('hPH :: {}\n'.format(self.hPH.get()))
 
+        f.write('solventType :: {}\n'.format(self.getEnumText('solventType')))
         if self.sizeType.get() == 0:
           f.write('boxSize :: {}, {}, {}\n'.format(self.distA.get(), self.distB.get(), self.distC.get()))
         else:
           f.write('padDist :: {}\n'.format(self.padDist.get()))
+          f.write('boxShape :: {}\n'.format(self.getEnumText('boxShape').lower()))
+        f.write('fastSolvation :: {}\n'.format(self.fastSolvation.get()))
 
         f.write('saltConc :: {}\n'.format(self.saltConc.get()))
         f.write('neutralize :: {}\n'.format(self.neutralize.get()))
         f.write('cationType :: {}\n'.format(self.getEnumText('cationType')))
         f.write('anionType :: {}\n'.format(self.getEnumText('anionType')))
 
-      Plugin.runScript(self, 'openmmPrepareSystem.py', args=self.getParamsFile(), env=OPENMM_DIC,
-                             cwd=self._getPath())
+        if self.isMembrane():
+          f.write('lipidType :: {}\n'.format(self.getEnumText('lipidType')))
+          f.write('memPadding :: {}\n'.format(self.memPadding.get()))
+          f.write('memCenterZ :: {}\n'.format(self.memCenterZ.get()))
+          f.write('orientProtein :: {}\n'.format(self.orientProtein.get()))
+
+      cacheDir = self.getPrepCacheDir() if self.useCache.get() else None
+      fromCache = cacheDir is not None and isInCache(cacheDir)
+      if fromCache:
+        cacheFile = getStructureFile(os.path.join(cacheDir, 'system'))
+        shutil.copy(cacheFile, self.getOutputSystemBase() + os.path.splitext(cacheFile)[1])
+        shutil.copy(os.path.join(cacheDir, 'solvationSummary.txt'), self.getSolvationSummaryFile())
+      else:
+        runScheduledScript(self, 'openmmPrepareSystem.py', self.getParamsFile(), cwd=self._getPath())
+        if cacheDir:
+          outFile = self.getOutputSystemFile()
+          storeInCache(cacheDir, {'system' + os.path.splitext(outFile)[1]: outFile,
+                                  'solvationSummary.txt': self.getSolvationSummaryFile()})
+          evictCache(os.path.dirname(cacheDir), Plugin.getCacheSizeLimit())
+
+      with open(self.getCacheInfoFile(), 'w') as f:
+        f.write('cacheEntry :: {}\nfromCache :: {}\n'.format(cacheDir and os.path.basename(cacheDir), fromCache))
 
 
     def createOutputStep(self):
-      systemBasename = self.getSystemName()
-      outSystemFile = self._getPath('{}_system.pdb'.format(systemBasename))
+      outSystemFile = self.getOutputSystemFile()
 
       mFF, wFF = self.getFFFiles()
       outSystem = OpenMMSystem(filename=outSystemFile, ff=mFF, wff=wFF,
-                               nonbondedMethod=self.getEnumText('nonbondedMethod'),
-                               nonbondedCutoff=self.nonbondedCutoff.get())
+                               nonbondedMethod=self.getNBMethod(), nonbondedCutoff=self.nonbondedCutoff.get(),
+                               solventType=self.getEnumText('solventType'), saltConc=self.saltConc.get(),
+                               ligandFiles=','.join(self.getLigandFiles()), ligandFF=self.getLigandFF())
 
       self._defineOutputs(outputSystem=outSystem)
       self._defineSourceRelation(self.inputStructure, outSystem)
+      if self.addLigands.get():
+        self._defineSourceRelation(self.inputSmallMolecules, outSystem)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getCacheInfoFile()):
+        cacheDic = parseParamsFile(self.getCacheInfoFile())
+        if cacheDic['fromCache'] == 'True':
+          summary.append('Prepared system reused from the cache (entry {})'.format(cacheDic['cacheEntry'][:12]))
+        elif cacheDic['cacheEntry'] != 'None':
+          summary.append('Prepared system built and stored in the cache (entry {})'.format(cacheDic['cacheEntry'][:12]))
+      if os.path.exists(self.getSolvationSummaryFile()):
+        sumDic = parseParamsFile(self.getSolvationSummaryFile())
+        summary.append('System atoms: {} ({} water molecules)'.format(sumDic['nAtoms'], sumDic['nWaters']))
+        if 'boxVolume' in sumDic:
+          summary.append('Box volume: {:.1f} nm^3'.format(float(sumDic['boxVolume'])))
+        if 'cubeAtoms' in sumDic and self.getEnumText('boxShape') != 'Cube':
+          summary.append('A cubic box with the same padding would contain ~{} atoms: estimated speedup x{:.2f}'.
+                         format(sumDic['cubeAtoms'], float(sumDic['cubeAtoms']) / float(sumDic['nAtoms'])))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if self.addLigands.get() and not self.inputSmallMolecules.get():
+        errors.append('Input ligands must be specified in order to add them to the system')
+      if self.isImplicit() and not hasImplicitParameters(self):
+        errors.append('Implicit solvent models are not available for CHARMM force fields')
+      if self.isMembrane() and not (self.ffType.get() == 1 or (self.ffType.get() == 0 and self.ffAmberType.get() == 0)):
+        errors.append('Membranes need a force field with protein and lipid parameters: Amber14 "All" or CHARMM36')
+      return errors
+
+    def isMembrane(self):
+      return self.solventType.get() == 2
+
+    def getPrepCacheDir(self):
+      """Cache entry of the prepared system, keyed by the contents of the input files and the preparation params.
+      The original ligand files are hashed, the converted SDFs have a timestamp in their header"""
+      inFiles = [self.getSystemFilename()] + self.getLigandInputFiles()
+      return Plugin.getCacheDir(os.path.join('systems', hashInputs(inFiles, self.getParamsFile())))
+
+    def getCacheInfoFile(self):
+      return self._getExtraPath('cacheInfo.txt')
+
+    def isImplicit(self):
+      return self.solventType.get() == 1
+
+    def getNBMethod(self):
+      nbMethod = self.getEnumText('nonbondedMethod')
+      if self.isImplicit() and self.nonbondedMethod.get() > 1:
+        nbMethod = 'CutoffNonPeriodic'
+      return nbMethod
+
+    def convertLigands(self):
+      for inFile, sdfFile in zip(self.getLigandInputFiles(), self.getLigandFiles()):
+        convertToSdf(self, inFile, sdfFile, overWrite=True)
+
+    def getLigandInputFiles(self):
+      if not self.addLigands.get():
+        return []
+      return [os.path.abspath(mol.getPoseFile() or mol.getFileName()) for mol in self.inputSmallMolecules.get()]
+
+    def getLigandFiles(self):
+      if not self.addLigands.get():
+        return []
+      return [os.path.abspath(self._getExtraPath('ligand_{}.sdf'.format(i + 1)))
+              for i in range(len(self.inputSmallMolecules.get()))]
+
+    def getLigandFF(self):
+      return self.getEnumText('ligandFF') if self.addLigands.get() else None
 
 
     def getWaterModel(self, wFF):
@@ -208,25 +414,7 @@ class ProtOpenMMSystemPrep(EMProtocol):
       return model
 
     def getFFFiles(self):
-      if self.ffType.get() == 0:
-        mFF = 'amber14-all.xml' if self.ffAmberType.get() == 0 \
-          else 'amber14/{}.xml'.format(self.getEnumText('ffAmberType'))
-        wFF = 'amber14/{}.xml'.format(self.getEnumText('ffAmberWaterType').lower())
-
-      elif self.ffType.get() == 1:
-        mFF = 'charmm36.xml'
-        wFF = 'charmm36/{}.xml'.format(self.getEnumText('ffCHARMMWaterType').lower())
-
-      # elif self.ffType.get() == 2:
-      #   mFF = 'amoeba{}.xml'.format(self.getEnumText('ffAMOEBAType'))
-      #   # wFF = '{}.xml'.format(self.getEnumText('ffWaterType'))
-      #   ffs = [mFF]
-
-      elif self.ffType.get() == 2:
-        mFF = '{}.xml'.format(self.getEnumText('ffOldType'))
-        wFF = '{}.xml'.format(self.getEnumText('ffWaterType'))
-
-      return mFF, wFF
+      return getForceFieldFiles(self, self.getEnumText('implicitModel') if self.isImplicit() else None)
 
     def getParamsFile(self):
       return os.path.abspath(self._getExtraPath('solvationParams.txt'))
@@ -236,3 +424,12 @@ class ProtOpenMMSystemPrep(EMProtocol):
 
     def getSystemName(self):
       return getBaseName(self.getSystemFilename())
+
+    def getSolvationSummaryFile(self):
+      return self._getPath('solvationSummary.txt')
+
+    def getOutputSystemBase(self):
+      return self._getPath('{}_system'.format(self.getSystemName()))
+
+    def getOutputSystemFile(self):
+      return getStructureFile(self.getOutputSystemBase())
@@ -29,17 +29,15 @@
 """
 This module will prepare the system for the simulation
 """
-import os
+import os, glob, shutil, threading
 
-from pyworkflow.protocol import params
+from pyworkflow.protocol import params, STEPS_PARALLEL
 from pyworkflow.utils import Message
 from pwem.protocols import EMProtocol
 
-from pwchem.utils import getBaseName
-
-from .. import Plugin
-from ..constants import OPENMM_DIC
 from ..objects import OpenMMSystem
+from ..utils import writeSystemParams, readTrajectoryIndex, runScheduledScript, getStructureFile, readMonitorLog, \
+  getSimulatedTime, readProfileReport, exportBinaryLog, readDeviceBenchmark
 
 
 class ProtOpenMMSystemSimulation(EMProtocol):
@@ -48,6 +46,11 @@ class ProtOpenMMSystemSimulation(EMProtocol):
     """
     _label = 'system simulation'
 
+    def __init__(self, **kwargs):
+      EMProtocol.__init__(self, **kwargs)
+      # The simulation step runs in a thread, while the main one publishes the growing output (_stepsCheck)
+      self.stepsExecutionMode = STEPS_PARALLEL
+      self._outputLock = threading.Lock()
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -58,17 +61,96 @@ class ProtOpenMMSystemSimulation(EMProtocol):
                        help="This protocol has both CPU and GPU implementation.\
                                                  Select the one you want to use.")
         form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
-                       help="Add a list of GPU devices that can be used")
+                       help="Add a list of GPU devices that can be used. The simulation waits until one of them "
+                            "is not used by other OpenMM jobs of the node and runs on it, or on the devices chosen "
+                            "in 'Devices usage'")
 
         form.addSection(label=Message.LABEL_INPUT)
         form.addParam('inputSystem', params.PointerParam, label="Input structure: ", allowsNull=False,
                       important=True, pointerClass='OpenMMSystem', help='OpenMMSystem to execute the simulation over')
         form.addParam('nSteps', params.IntParam, default=10000, label="Number of simualtion steps: ",
                       help='Number of steps for simulation')
+        form.addParam('continueState', params.BooleanParam, default=True, label="Continue from input state: ",
+                      help='If the input system comes from a simulation, start from its exact final state '
+                           '(positions, velocities and box) instead of its structure. No minimization is run then, '
+                           'and no re-equilibration is needed')
+
+        dGroup = form.addGroup('Devices')
+        dGroup.addParam('deviceMode', params.EnumParam, default=0, label="Devices usage: ",
+                        choices=['First free GPU', 'All free GPUs', 'Fastest'], expertLevel=params.LEVEL_ADVANCED,
+                        help='How the GPUs of the list are used by this single simulation.\n'
+                             'First free GPU: it runs on the first GPU of the list not used by other OpenMM jobs.\n'
+                             'All free GPUs: it runs spread over all the GPUs of the list not used by other OpenMM '
+                             'jobs (a single context over several devices), which only pays off for large systems.\n'
+                             'Fastest: after the minimization, a few steps are timed on each free GPU alone, on all '
+                             'of them together and on the CPU threads, and the simulation continues on the fastest '
+                             'configuration. All the free GPUs stay reserved for the simulation.\n'
+                             'If no GPU platform is available or the devices cannot be used, it runs on the CPU '
+                             'with the protocol threads')
+        dGroup.addParam('benchmarkSteps', params.IntParam, default=500, label="Benchmark steps: ",
+                        condition='deviceMode==2', expertLevel=params.LEVEL_ADVANCED,
+                        help='Number of steps timed on each configuration')
 
         tGroup = form.addGroup('Trajectory')
         tGroup.addParam('nTraj', params.IntParam, default=100, label="Steps interval: ",
                         help='Save the state of the system each x steps for the trajectory')
+        tGroup.addParam('saveEnergyGroups', params.BooleanParam, default=False, label="Save energy decomposition: ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Each force of the system is placed in its own force group and the potential energy of '
+                             'each of them is stored at every reporting interval. Useful to identify which term is '
+                             'responsible when a simulation explodes.')
+        tGroup.addParam('asyncTrajectory', params.BooleanParam, default=True, label="Write trajectory in background: ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='The trajectory frames are queued and written to disk by a background thread, so the '
+                             'simulation does not wait for slow (e.g. network) file systems. If the queue is full, '
+                             'the simulation waits for the writer. The trajectory is the same as the one written '
+                             'synchronously')
+        tGroup.addParam('textReport', params.BooleanParam, default=False, label="Export reporter as text: ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='The state of the system (energies, temperature and volume) is stored at every reporting '
+                             'interval in a binary log (md_log.bin). If set, it is also exported to a text CSV file '
+                             '(md_log.txt) when the simulation finishes')
+        tGroup.addParam('streamOutput', params.BooleanParam, default=False, label="Stream output: ",
+                        help='Publish the output system as soon as the first frames are written and update it while '
+                             'the simulation runs, so its trajectory can be analyzed before it finishes. The '
+                             'simulation runs in chunks, after which the trajectory and reporters are flushed')
+        tGroup.addParam('streamFrames', params.IntParam, default=100, label="Update output every (frames): ",
+                        condition='streamOutput',
+                        help='Number of trajectory frames of each chunk of the simulation')
+
+        mGroup = form.addGroup('Sanity monitor')
+        mGroup.addParam('useMonitor', params.BooleanParam, default=True, label="Monitor the simulation: ",
+                        help='Run the simulation in chunks and check after each of them that it has not exploded '
+                             '(non finite energies or coordinates, temperature or potential energy spikes). An '
+                             'exploded chunk is rolled back to the last good one and continued with half the step '
+                             'size; if it keeps exploding, the simulation is aborted early instead of wasting its '
+                             'remaining time. Not available for metadynamics, which is aborted directly')
+        mGroup.addParam('monitorInterval', params.IntParam, default=5000, label="Check every (steps): ",
+                        condition='useMonitor', help='Steps of each checked chunk, rounded to whole trajectory frames')
+        mGroup.addParam('maxTemperature', params.FloatParam, default=1000, label="Maximum temperature (K): ",
+                        condition='useMonitor', expertLevel=params.LEVEL_ADVANCED,
+                        help='A chunk ending above this temperature is considered exploded')
+        mGroup.addParam('maxRollbacks', params.IntParam, default=3, label="Maximum rollbacks: ",
+                        condition='useMonitor', expertLevel=params.LEVEL_ADVANCED,
+                        help='Number of times the simulation can be rolled back before being aborted')
+
+        pGroup = form.addGroup('Profiling')
+        pGroup.addParam('profile', params.BooleanParam, default=False, label="Profile the simulation: ",
+                        expertLevel=params.LEVEL_ADVANCED,
+                        help='Measure where the time of the simulation goes: python functions of the script, '
+                             'evaluation of each force group, integration steps, barostat moves and reporters '
+                             'writing. The report can be checked in the viewer of the output system')
+        pGroup.addParam('profiler', params.EnumParam, default=0, label="Python profiler: ", condition='profile',
+                        expertLevel=params.LEVEL_ADVANCED,
+                        choices=['cProfile', 'py-spy'], display=params.EnumParam.DISPLAY_HLIST,
+                        help='cProfile: deterministic profile of the python functions (profile.prof), whose top '
+                             'functions are included in the report.\npy-spy: sampling profiler with a lower overhead, '
+                             'writes a flame graph (profile.svg). It must be installed in the OpenMM environment, '
+                             'otherwise cProfile is used')
+        pGroup.addParam('profileSamples', params.IntParam, default=20, label="Timed evaluations: ",
+                        condition='profile', expertLevel=params.LEVEL_ADVANCED,
+                        help='Number of force evaluations and steps timed to estimate the cost of each force group, '
+                             'step and barostat move after the simulation')
 
         cGroup = form.addGroup('Constraints')
         cGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
@@ -119,9 +201,55 @@ class ProtOpenMMSystemSimulation(EMProtocol):
                       condition='addBarostat',
                       help='The frequency at which Monte Carlo pressure changes should be attempted (in time steps)')
 
+        eGroup = form.addGroup('Enhanced sampling')
+        eGroup.addParam('enhancedSampling', params.EnumParam, default=0, label="Enhanced sampling: ",
+                        choices=['None', 'aMD', 'Metadynamics'], display=params.EnumParam.DISPLAY_HLIST,
+                        help='Bias the simulation to sample rare events (e.g. cryptic pockets opening).\n'
+                             'aMD: accelerated MD, raises the energy of the basins below a threshold.\n'
+                             'Metadynamics: well-tempered metadynamics over a set of collective variables.\n'
+                             'The bias of each reported frame is stored so the reporter data can be reweighted.')
+        eGroup.addParam('amdType', params.EnumParam, default=2, label="Boosted potential: ",
+                        condition='enhancedSampling==1', choices=['Dihedral', 'Total', 'Dual'],
+                        display=params.EnumParam.DISPLAY_HLIST,
+                        help='Dihedral: boost the torsion energy. Total: boost the total potential energy. '
+                             'Dual: boost independently the torsion energy and the rest of the potential.')
+        eGroup.addParam('amdEstimateSteps', params.IntParam, default=5000, label="Steps to estimate the boost: ",
+                        condition='enhancedSampling==1',
+                        help='Number of steps of unboosted simulation run before the aMD to estimate the average '
+                             'energies, from which the boost thresholds are set with the usual heuristics: '
+                             'E = <V> + 3.5 kcal/mol per residue (dihedral), E = <V> + 0.16 kcal/mol per atom (total)')
+        eGroup.addParam('metaCVs', params.TextParam, default='', label="Collective variables: ",
+                        condition='enhancedSampling==2',
+                        help='Up to 3 collective variables, one per line, as: type | atoms | min | max | width\n'
+                             'type: distance (nm, between the centroids of two atom groups separated by ";"), '
+                             'dihedral (rad, 4 atoms, min and max are ignored) or rmsd (nm, to the initial '
+                             'positions).\nAtoms are 0-based indexes of the system, as "4, 10-12".\n'
+                             'width is the width of the deposited gaussians.\n'
+                             'e.g: distance | 10-20; 300-310 | 0.5 | 3.0 | 0.05')
+        eGroup.addParam('metaHeight', params.FloatParam, default=1.0, label="Gaussians height (kJ/mol): ",
+                        condition='enhancedSampling==2', help='Initial height of the deposited gaussians')
+        eGroup.addParam('metaBiasFactor', params.FloatParam, default=10.0, label="Bias factor: ",
+                        condition='enhancedSampling==2',
+                        help='Well-tempered bias factor: the sampled collective variables reach an effective '
+                             'temperature of bias factor times the simulation temperature')
+        eGroup.addParam('metaFrequency', params.IntParam, default=500, label="Deposition interval (steps): ",
+                        condition='enhancedSampling==2', help='A gaussian is deposited each x steps')
+        eGroup.addParam('continueBias', params.BooleanParam, default=False, label="Continue input bias: ",
+                        condition='enhancedSampling==2',
+                        help='If the input system comes from a metadynamics simulation, start from its bias grid to '
+                             'continue it. The collective variables must be the same')
+
+        form.addParallelSection(threads=2, mpi=1)
+
     def _insertAllSteps(self):
-      self._insertFunctionStep('simulateStep')
-      self._insertFunctionStep('createOutputStep')
+      simId = self._insertFunctionStep('simulateStep')
+      self._insertFunctionStep('createOutputStep', prerequisites=[simId])
+
+    def _stepsCheck(self):
+      if self.streamOutput.get() and os.path.exists(self.getIndexFile()):
+        index = readTrajectoryIndex(self.getIndexFile())
+        if index['frames'] > 0:
+          self.publishOutput(index['frames'])
 
 
     def simulateStep(self):
@@ -129,15 +257,13 @@ class ProtOpenMMSystemSimulation(EMProtocol):
 
       with open(self.getParamsFile(), 'w') as f:
         f.write('inputFile :: {}\n'.format(inFile))
-        mFF, wFF = self.getFFFiles()
-        f.write('mFF :: {}\nwFF :: {}\n'.format(mFF, wFF))
+        writeSystemParams(f, self.inputSystem.get())
         f.write('nSteps :: {}\n'.format(self.nSteps.get()))
+        if self.continuesState():
+          f.write('stateFile :: {}\n'.format(os.path.abspath(self.inputSystem.get().getStateFile())))
 
         f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
 
-        nbMethod, nbCutOff = self.getNBParams()
-        f.write('nbMethod :: {}\nnbCutoff :: {}\n'.format(nbMethod, nbCutOff))
-
         integrator = self.getEnumText('integrator')
         f.write('integrator :: {}\n'.format(integrator))
         if self.integrator.get() not in [0, 5]:
@@ -159,41 +285,179 @@ class ProtOpenMMSystemSimulation(EMProtocol):
           f.write('pressure :: {}\n'.format(self.pressure.get()))
           f.write('temperature :: {}\n'.format(self.temperature.get()))
 
-        f.write(f'nTraj :: {self.nTraj.get()}\n')
-        if getattr(self, params.USE_GPU).get():
-          f.write(f'gpus :: {getattr(self, params.GPU_LIST)}\n')
+        self.writeEnhancedSamplingParams(f)
 
-      Plugin.runScript(self, 'openmmSimulateSystem.py', args=self.getParamsFile(), env=OPENMM_DIC,
-                             cwd=self._getPath())
+        f.write(f'nTraj :: {self.nTraj.get()}\n')
+        f.write(f'energyGroups :: {self.saveEnergyGroups.get()}\n')
+        f.write(f'asyncTrajectory :: {self.asyncTrajectory.get()}\n')
+        if self.streamOutput.get():
+          f.write(f'streamFrames :: {self.streamFrames.get()}\n')
+        if self.useMonitor.get():
+          for pName in ['monitorInterval', 'maxTemperature', 'maxRollbacks']:
+            f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+        if self.deviceMode.get() == 2:
+          f.write('benchmarkDevices :: True\n')
+          f.write('benchmarkSteps :: {}\n'.format(self.benchmarkSteps.get()))
+        if self.profile.get():
+          f.write('profiler :: {}\n'.format(self.getEnumText('profiler')))
+          f.write('profileSamples :: {}\n'.format(self.profileSamples.get()))
+
+      if self.enhancedSampling.get() == 2:
+        self.prepareBiasDir()
+      try:
+        runScheduledScript(self, 'openmmSimulateSystem.py', self.getParamsFile(), cwd=self._getPath(),
+                           maxGpus=1 if self.deviceMode.get() == 0 else None)
+      except Exception:
+        monitorLog = self.getMonitorLog()
+        if monitorLog and monitorLog['status'] == 'aborted':
+          event = monitorLog['events'][-1]
+          raise Exception('The simulation exploded at step {} ({}) and was aborted after {} rollbacks. Check the '
+                          'system preparation or reduce the step size'.format(
+                          event['step'], event['reason'], len(monitorLog['events']) - 1))
+        raise
 
 
     def createOutputStep(self):
+      if self.textReport.get():
+        exportBinaryLog(self.getReportFile(), self._getPath('md_log.txt'))
+      self.publishOutput(self.nSteps.get() // self.nTraj.get())
+
+    def publishOutput(self, nFrames):
+      """Defines the output system with the frames of the trajectory available so far, or updates their number"""
+      with self._outputLock:
+        if hasattr(self, 'outputSystem'):
+          outSystem = self.outputSystem
+          if nFrames > outSystem._nFrames.get():
+            outSystem._nFrames.set(nFrames)
+            outSystem._nTime.set(self.getSimulatedTime(nFrames))
+            self._store(outSystem)
+        else:
+          self._defineOutputs(outputSystem=self.buildOutputSystem(nFrames))
+
+    def buildOutputSystem(self, nFrames):
       systemName = self.getSystemName()
-      outPdbFile, outDcdFile = self._getPath(f'{systemName}.pdb'), self._getPath(f'{systemName}.dcd')
+      outPdbFile, outDcdFile = getStructureFile(self._getPath(systemName)), self._getPath(f'{systemName}.dcd')
 
       mFF, wFF = self.getFFFiles()
       nbMethod, nbCutOff = self.getNBParams()
-      nFrames = self.nSteps.get() // self.nTraj.get()
-      nTime = nFrames * self.stepSize.get()
-      outSystem = OpenMMSystem(filename=outPdbFile, repFile=self._getPath('md_log.txt'),
+      nTime = self.getSimulatedTime(nFrames)
+      outSystem = OpenMMSystem(filename=outPdbFile, repFile=self.getReportFile(),
                                ff=mFF, wff=wFF, nFrames=nFrames, nTime=nTime,
-                               nonbondedMethod=nbMethod, nonbondedCutoff=nbCutOff)
+                               nonbondedMethod=nbMethod, nonbondedCutoff=nbCutOff,
+                               constraints=self.getEnumText('constraints'),
+                               solventType=self.inputSystem.get().getSolventType(),
+                               saltConc=self.inputSystem.get().getSaltConcentration(),
+                               ligandFiles=self.inputSystem.get()._ligFiles.get(),
+                               ligandFF=self.inputSystem.get().getLigandForceField())
       outSystem.setOriStructFile(self.getSystemFilename())
       outSystem.setTrajectoryFile(outDcdFile)
-
-      self._defineOutputs(outputSystem=outSystem)
-
+      outSystem.setStateFile(self._getPath(f'{systemName}_state.xml'))
+      if self.saveEnergyGroups.get():
+        outSystem.setEnergyGroupsFile(self._getPath('energy_groups.bin'))
+      if self.enhancedSampling.get() != 0:
+        outSystem.setBiasFile(self._getPath('bias.bin'))
+      if self.enhancedSampling.get() == 2:
+        outSystem.setBiasDir(self.getBiasDir())
+      if self.streamOutput.get():
+        outSystem.setTrajectoryIndexFile(self.getIndexFile())
+      if self.useMonitor.get():
+        outSystem.setMonitorFile(self.getMonitorFile())
+      if self.profile.get():
+        outSystem.setProfileFile(self.getProfileFile())
+      return outSystem
+
+    def _summary(self):
+      summary = []
+      monitorLog = self.getMonitorLog()
+      if monitorLog:
+        for event in monitorLog['events']:
+          action = 'aborted' if event['action'] == 'abort' else 'rolled back to step {}'.format(event['checkpointStep'])
+          summary.append('Step {}: {}, {}'.format(event['step'], event['reason'], action))
+        if monitorLog['events'] and 'stepSize' in monitorLog['events'][-1]:
+          summary.append('Final step size: {} ps'.format(monitorLog['events'][-1]['stepSize']))
+      if os.path.exists(self.getBenchmarkFile()):
+        best = readDeviceBenchmark(self.getBenchmarkFile())['best']
+        devices = ' on GPUs {}'.format(', '.join(best['devices'])) if best['devices'] else ''
+        summary.append('Fastest configuration: {}{} ({:.1f} ns/day)'.format(best['platform'], devices,
+                                                                           best['nsPerDay']))
+      if os.path.exists(self.getProfileFile()):
+        report = readProfileReport(self.getProfileFile())
+        groupTimes = {name: t for name, t in report['forceGroups'].items() if name != 'All'}
+        summary.append('Performance: {:.1f} ns/day ({}). Most expensive force group: {}'.format(
+          report['nsPerDay'], report['platform'], max(groupTimes, key=groupTimes.get)))
+      return summary
+
+
+    def _validate(self):
+      errors = []
+      if self.addBarostat.get() and self.inputSystem.get().isImplicit():
+        errors.append('A barostat cannot be used with an implicit solvent system, which is not periodic')
+
+      if self.enhancedSampling.get() == 1 and self.integrator.get() != 2:
+        errors.append('aMD is run with its own LangevinMiddle integrator, choose LangevinMiddle as integrator')
+      elif self.enhancedSampling.get() == 2:
+        if self.integrator.get() not in [1, 2, 3, 4]:
+          errors.append('Metadynamics needs an integrator with a defined temperature')
+        cvLines = self.getCVLines()
+        if not 0 < len(cvLines) <= 3:
+          errors.append('Metadynamics needs between 1 and 3 collective variables')
+        for cvLine in cvLines:
+          fields = [field.strip() for field in cvLine.split('|')]
+          if len(fields) != 5 or fields[0].lower() not in ['distance', 'dihedral', 'rmsd']:
+            errors.append(f'Wrong collective variable definition: {cvLine}')
+        if len({'dihedral' in cvLine.lower() for cvLine in cvLines}) > 1:
+          errors.append('Periodic (dihedral) and non periodic collective variables cannot be mixed')
+        if self.continueBias.get() and not self.inputSystem.get().getBiasDir():
+          errors.append('The input system has no bias grid to continue')
+
+      if self.deviceMode.get() != 0 and not getattr(self, params.USE_GPU).get():
+        errors.append('Running on several GPUs or choosing the fastest devices needs the GPU execution')
+
+      if self.streamOutput.get() and self.numberOfThreads.get() < 2:
+        errors.append('Streaming the output needs at least 2 threads: one runs the simulation while the other '
+                      'publishes its frames')
+      return errors
 
     def _warnings(self):
       ws = []
       if self.constraints.get() == 0:
         ws.append('Running the simulation without restraints might lead to errors in the simulation.\n')
 
-      if not self.addMinimization.get():
+      if not self.addMinimization.get() and not self.continuesState():
         ws.append('Running the simulation without a prior minimization might lead to errors in the simulation.\n')
       return ws
 
 
+    def continuesState(self):
+      stateFile = self.inputSystem.get().getStateFile()
+      return self.continueState.get() and bool(stateFile) and os.path.exists(stateFile)
+
+    def writeEnhancedSamplingParams(self, f):
+      f.write('enhancedSampling :: {}\n'.format(self.getEnumText('enhancedSampling')))
+      if self.enhancedSampling.get() == 1:
+        f.write('amdType :: {}\n'.format(self.getEnumText('amdType')))
+        f.write('amdEstimateSteps :: {}\n'.format(self.amdEstimateSteps.get()))
+      elif self.enhancedSampling.get() == 2:
+        for i, cvLine in enumerate(self.getCVLines()):
+          f.write('cv_{} :: {}\n'.format(i + 1, cvLine))
+        f.write('metaHeight :: {}\n'.format(self.metaHeight.get()))
+        f.write('metaBiasFactor :: {}\n'.format(self.metaBiasFactor.get()))
+        f.write('metaFrequency :: {}\n'.format(self.metaFrequency.get()))
+        f.write('biasDir :: {}\n'.format(self.getBiasDir()))
+
+    def prepareBiasDir(self):
+      """Creates the bias directory, with the bias grid files of the input system if it is continued"""
+      os.makedirs(self.getBiasDir(), exist_ok=True)
+      if self.continueBias.get():
+        for biasFile in glob.glob(os.path.join(self.inputSystem.get().getBiasDir(), 'bias_*.npy')):
+          shutil.copy(biasFile, self.getBiasDir())
+
+    def getCVLines(self):
+      return [line.strip() for line in (self.metaCVs.get() or '').split('\n') if line.strip()]
+
+    def getBiasDir(self):
+      return os.path.abspath(self._getPath('bias'))
+
     def getWaterModel(self, wFF):
       model = 'tip3p'
       if 'spce' in wFF:
@@ -215,6 +479,30 @@ class ProtOpenMMSystemSimulation(EMProtocol):
     def getParamsFile(self):
       return os.path.abspath(self._getExtraPath('simulationParams.txt'))
 
+    def getReportFile(self):
+      return self._getPath('md_log.bin')
+
+    def getIndexFile(self):
+      return self._getPath('trajectory_index.json')
+
+    def getMonitorFile(self):
+      return self._getPath('monitor.json')
+
+    def getMonitorLog(self):
+      return readMonitorLog(self.getMonitorFile()) if os.path.exists(self.getMonitorFile()) else None
+
+    def getBenchmarkFile(self):
+      return self._getPath('device_benchmark.json')
+
+    def getProfileFile(self):
+      return self._getPath('profile.json')
+
+    def getSimulatedTime(self, nFrames):
+      """Simulated time (ps) up to a frame, with the step size reductions of the monitor rollbacks"""
+      monitorLog = self.getMonitorLog()
+      return getSimulatedTime(nFrames * self.nTraj.get(), self.stepSize.get(),
+                              monitorLog['events'] if monitorLog else ())
+
     def getSystemFilename(self):
       return os.path.abspath(self.inputSystem.get().getFileName())
 
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This module will run a steered MD and umbrella sampling along a pulling coordinate of a system
+"""
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.utils import Message
+from pwem.protocols import EMProtocol
+
+from ..objects import OpenMMSystem
+from ..utils import writeSystemParams, parseParamsFile, readBinaryLog, readBinaryLogHeader, runScheduledScript
+
+
+class ProtOpenMMUmbrellaSampling(EMProtocol):
+    """
+    This protocol computes the potential of mean force (PMF) along the distance between the centroids of two
+    selections of an OpenMMSystem. First, a steered MD pulls the distance at constant velocity with a moving harmonic
+    bias. Then, the starting frames of a set of umbrella windows are harvested from its trajectory, and the windows
+    are run in parallel. The PMF is computed with WHAM or MBAR in the viewer, optionally with the 2kT*ln(r)
+    Jacobian correction of the distance.
+    """
+    _label = 'umbrella sampling'
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        """
+        form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
+                       label="Use GPU for execution: ",
+                       help="This protocol has both CPU and GPU implementation.\
+                                                 Select the one you want to use.")
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                       help="Add a list of GPU devices that can be used. The windows are distributed "
+                            "among those not used by other OpenMM jobs of the node")
+
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputSystem', params.PointerParam, label="Input system: ", allowsNull=False,
+                      important=True, pointerClass='OpenMMSystem', help='OpenMMSystem to pull')
+        form.addParam('pullResidues', params.StringParam, default='', label="Pulled residues: ",
+                      help='Residue ids of the pulled selection, as "1-20, 35, B:40". '
+                           'If empty, the non standard residues (ligands) are used.')
+        form.addParam('refResidues', params.StringParam, default='', label="Reference residues: ",
+                      help='Residue ids of the reference selection (e.g. the pocket), as "1-20, 35, B:40". '
+                           'The distance between the centroids of both selections is the pulling coordinate')
+
+        smdGroup = form.addGroup('Steered MD')
+        smdGroup.addParam('finalDistance', params.FloatParam, default=3.0, label="Final distance (nm): ",
+                          help='The distance is pulled from its initial value to this one')
+        smdGroup.addParam('pullK', params.FloatParam, default=1000, label="Pulling force constant (kJ/mol/nm^2): ",
+                          help='Force constant of the moving harmonic bias')
+        smdGroup.addParam('smdSteps', params.IntParam, default=100000, label="Pulling steps: ",
+                          help='Number of steps of the steered MD, which sets the pulling velocity')
+
+        uGroup = form.addGroup('Umbrella sampling')
+        uGroup.addParam('nWindows', params.IntParam, default=20, label="Number of windows: ",
+                        help='Number of umbrella windows, evenly spaced between the initial and final distances')
+        uGroup.addParam('umbrellaK', params.FloatParam, default=1000, label="Window force constant (kJ/mol/nm^2): ",
+                        help='Force constant of the harmonic bias of each window. The sampled distributions of '
+                             'neighbour windows must overlap')
+        uGroup.addParam('windowEquilSteps', params.IntParam, default=5000, label="Window equilibration steps: ")
+        uGroup.addParam('windowSteps', params.IntParam, default=100000, label="Window sampling steps: ")
+        uGroup.addParam('cvInterval', params.IntParam, default=100, label="Save distance every (steps): ",
+                        help='Interval at which the distance is stored in the windows and the steered MD '
+                             '(frames of the steered MD trajectory too)')
+
+        sGroup = form.addGroup('Simulation')
+        sGroup.addParam('temperature', params.FloatParam, default=300, label="Temperature (K): ")
+        sGroup.addParam('stepSize', params.FloatParam, default=0.002, label="Step size for integration (ps): ")
+        sGroup.addParam('fricCoef', params.FloatParam, default=1, label="Friction coefficient (1/ps): ")
+        sGroup.addParam('constraints', params.EnumParam, default=1, label="Constraints: ",
+                        choices=['None', 'HBonds', 'AllBonds', 'HAngles'],
+                        help='http://docs.openmm.org/latest/userguide/application/02_running_sims.html#constraints')
+        sGroup.addParam('minimTol', params.FloatParam, default=10, label="Minimization tolerance (kJ/mol): ",
+                        expertLevel=params.LEVEL_ADVANCED)
+        sGroup.addParam('maxIter', params.IntParam, default=1000, label="Minimization maximum iterations: ",
+                        expertLevel=params.LEVEL_ADVANCED)
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    def _insertAllSteps(self):
+      self._insertFunctionStep('umbrellaStep')
+      self._insertFunctionStep('createOutputStep')
+
+    def umbrellaStep(self):
+      with open(self.getParamsFile(), 'w') as f:
+        f.write('inputFile :: {}\n'.format(self.getSystemFilename()))
+        writeSystemParams(f, self.inputSystem.get())
+        f.write('constraints :: {}\n'.format(self.getEnumText('constraints')))
+        for pName in ['pullResidues', 'refResidues', 'finalDistance', 'pullK', 'smdSteps', 'nWindows', 'umbrellaK',
+                      'windowEquilSteps', 'windowSteps', 'cvInterval', 'temperature', 'stepSize', 'fricCoef',
+                      'minimTol', 'maxIter']:
+          f.write('{} :: {}\n'.format(pName, getattr(self, pName).get()))
+
+      runScheduledScript(self, 'openmmUmbrella.py', self.getParamsFile(), cwd=self._getPath(), maxGpus=None)
+
+    def createOutputStep(self):
+      inSystem = self.inputSystem.get()
+      nFrames = self.smdSteps.get() // self.cvInterval.get()
+      outSystem = OpenMMSystem()
+      outSystem.copy(inSystem, copyId=False)
+      outSystem.setTrajectoryFile(self._getPath('smd.dcd'))
+      outSystem._nFrames.set(nFrames)
+      outSystem._nTime.set(self.smdSteps.get() * self.stepSize.get())
+
+      self._defineOutputs(outputSystem=outSystem)
+      self._defineSourceRelation(self.inputSystem, outSystem)
+
+    def _summary(self):
+      summary = []
+      if os.path.exists(self.getWindowsFile()):
+        wDic = parseParamsFile(self.getWindowsFile())
+        nWindows = int(wDic['nWindows'])
+        summary.append('{} umbrella windows from {:.3f} nm to {:.3f} nm'.format(
+          nWindows, float(wDic['center_0']), float(wDic[f'center_{nWindows - 1}'])))
+      return summary
+
+    def _validate(self):
+      errors = []
+      if not self.refResidues.get():
+        errors.append('The reference residues must be defined')
+      if self.smdSteps.get() < self.cvInterval.get() or self.windowSteps.get() < self.cvInterval.get():
+        errors.append('The number of steps must be larger than the interval to save the distance')
+      return errors
+
+    # -------------------------- UTILS functions ----------------------
+    def getWindowsData(self):
+      """Returns the distances sampled in each umbrella window and their centers, force constants and temperature"""
+      nWindows = int(parseParamsFile(self.getWindowsFile())['nWindows'])
+      cvs, centers, ks = [], [], []
+      for w in range(nWindows):
+        header = readBinaryLogHeader(self.getWindowFile(w))
+        cvs.append(readBinaryLog(self.getWindowFile(w))[1][:, 1])
+        centers.append(header['center'])
+        ks.append(header['k'])
+      return cvs, centers, ks, header['temperature']
+
+    def getParamsFile(self):
+      return os.path.abspath(self._getExtraPath('umbrellaParams.txt'))
+
+    def getWindowsFile(self):
+      return self._getPath('umbrella_windows.txt')
+
+    def getWindowFile(self, w):
+      return self._getPath(f'umbrella_{w}.bin')
+
+    def getSMDFile(self):
+      return self._getPath('smd_cv.bin')
+
+    def getSystemFilename(self):
+      return os.path.abspath(self.inputSystem.get().getFileName())
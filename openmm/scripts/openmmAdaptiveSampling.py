@@ -0,0 +1,278 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, os, json, multiprocessing
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField, DCDFile
+from openmm import Context, LangevinMiddleIntegrator, MonteCarloBarostat, LocalEnergyMinimizer, XmlSerializer
+from openmm.unit import kelvin, picoseconds, kilojoules_per_mole, nanometer, bar
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, getSelectedAtoms, getWorkerPlatform, \
+  readDCD, setFramePositions, ContextCache, systemHash, readStructure
+
+STATE_FILE = 'adaptive_state.json'
+
+
+################# State store #################
+# The campaign is stored in a json file, updated (atomically) each time a trajectory finishes, so it can be resumed
+# from the last finished trajectory: the seeds of each round are stored before running it
+
+def loadState():
+  if os.path.exists(STATE_FILE):
+    with open(STATE_FILE) as f:
+      return json.load(f)
+  return {'round': 0, 'trajectories': [], 'clusterCounts': []}
+
+def saveState(state):
+  with open(STATE_FILE + '.tmp', 'w') as f:
+    json.dump(state, f, indent=1)
+  os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+
+################# Featurization #################
+
+def getDihedralQuads(topology, selection=''):
+  """Returns the atom indexes of the phi and psi backbone dihedrals of the selected residues"""
+  selected = set(getSelectedAtoms(topology, selection))
+  quads = []
+  for chain in topology.chains():
+    residues = [{atom.name: atom.index for atom in res.atoms()} for res in chain.residues()]
+    for prevRes, res, nextRes in zip([{}] + residues[:-1], residues, residues[1:] + [{}]):
+      for names, atomsRes in [(['C', 'N', 'CA', 'C'], [prevRes, res, res, res]),
+                              (['N', 'CA', 'C', 'N'], [res, res, res, nextRes])]:
+        if all(name in atoms for name, atoms in zip(names, atomsRes)) and res.get('CA') in selected:
+          quads.append([atoms[name] for name, atoms in zip(names, atomsRes)])
+  return np.array(quads, dtype=int).reshape(-1, 4)
+
+def getContactPairs(topology, selection='', minSeparation=3):
+  """Returns the atom indexes of the pairs of alpha carbons of the selected residues separated by at least
+  minSeparation residues in the sequence"""
+  selected = set(getSelectedAtoms(topology, selection))
+  cas = [atom for atom in topology.atoms() if atom.name == 'CA' and atom.index in selected]
+  return np.array([[a1.index, a2.index] for i, a1 in enumerate(cas) for a2 in cas[i + 1:]
+                   if a1.residue.chain != a2.residue.chain or
+                   abs(a1.residue.index - a2.residue.index) >= minSeparation], dtype=int).reshape(-1, 2)
+
+def computeDihedrals(coords, quads):
+  """Computes the dihedrals (radians) of the atom quads for all the frames at once. coords: (nFrames, nAtoms, 3)"""
+  p0, p1, p2, p3 = [coords[:, quads[:, i]] for i in range(4)]
+  b0, b1, b2 = p0 - p1, p2 - p1, p3 - p2
+  b1 /= np.linalg.norm(b1, axis=-1, keepdims=True)
+  v = b0 - np.sum(b0 * b1, axis=-1, keepdims=True) * b1
+  w = b2 - np.sum(b2 * b1, axis=-1, keepdims=True) * b1
+  return np.arctan2(np.sum(np.cross(b1, v) * w, axis=-1), np.sum(v * w, axis=-1))
+
+def featurize(coords, pDic, featAtoms):
+  """Featurizes a trajectory: sine and cosine of the backbone dihedrals or the contact map of the alpha carbons"""
+  if pDic['features'] == 'Contact map':
+    distances = np.linalg.norm(coords[:, featAtoms[:, 0]] - coords[:, featAtoms[:, 1]], axis=-1)
+    return (distances < float(pDic['contactCutoff'])).astype(np.float32)
+  dihedrals = computeDihedrals(coords, featAtoms)
+  return np.concatenate([np.sin(dihedrals), np.cos(dihedrals)], axis=1).astype(np.float32)
+
+
+################# Clustering #################
+
+def kmeans(X, k, centers=None, maxIter=100, rng=None):
+  """Clusters the rows of X with k-means. The previous centers are used as initialization if given (and their number
+  matches), else they are initialized with k-means++. Returns the centers and the labels of X"""
+  rng = rng if rng is not None else np.random.default_rng()
+  k = min(k, len(X))
+  sqNorms = np.sum(X ** 2, axis=1)
+  sqDistances = lambda C: np.maximum(sqNorms[:, None] - 2 * X @ C.T + np.sum(C ** 2, axis=1)[None, :], 0)
+
+  if centers is None or len(centers) != k:
+    centers = X[[rng.integers(len(X))]]
+    for _ in range(1, k):
+      d2 = sqDistances(centers).min(axis=1)
+      probs = d2 / d2.sum() if d2.sum() > 0 else None
+      centers = np.vstack([centers, X[rng.choice(len(X), p=probs)]])
+
+  labels = None
+  for _ in range(maxIter):
+    d2 = sqDistances(centers)
+    newLabels = np.argmin(d2, axis=1)
+    if labels is not None and np.array_equal(labels, newLabels):
+      break
+    labels = newLabels
+    for c in range(k):
+      members = labels == c
+      # Empty clusters are moved to the point farthest from its center
+      centers[c] = X[members].mean(axis=0) if members.any() else X[np.argmax(d2[np.arange(len(X)), labels])]
+  return centers, labels
+
+def chooseSeeds(labels, frameIndex, nClusters, nSeeds, rng):
+  """Chooses the starting frames of the next round from the least visited clusters (random frame in each of them).
+  frameIndex: (trajectory name, frame) of each clustered sample"""
+  counts = np.bincount(labels, minlength=nClusters)
+  visited = np.where(counts > 0)[0]
+  # Least visited first, ties broken randomly
+  order = visited[np.lexsort((rng.random(len(visited)), counts[visited]))]
+  seeds = []
+  for i in range(nSeeds):
+    members = np.where(labels == order[i % len(order)])[0]
+    seeds.append(frameIndex[rng.choice(members)])
+  return seeds, counts
+
+
+################# Parallel trajectories #################
+# The System is built and serialized once in the main process, each worker deserializes it and runs its trajectories,
+# reusing the same Context: the integrator noise keeps running, while the velocities are seeded for each trajectory
+WORKER = {}
+
+def initWorker(systemXml, topologyFile, featAtoms, deviceQueue, nThreads):
+  WORKER['system'] = XmlSerializer.deserialize(systemXml)
+  WORKER['topology'] = readStructure(topologyFile).topology
+  WORKER['featAtoms'] = featAtoms
+  WORKER['systemKey'] = systemHash(WORKER['system'])
+  WORKER['contexts'] = ContextCache(*getWorkerPlatform(deviceQueue.get(), nThreads))
+
+def createIntegrator(pDic, randomSeed):
+  integrator = LangevinMiddleIntegrator(float(pDic['temperature']) * kelvin, float(pDic['fricCoef']) / picoseconds,
+                                        float(pDic['stepSize']) * picoseconds)
+  integrator.setRandomNumberSeed(randomSeed)
+  return integrator
+
+def runTrajectory(args):
+  name, (seedTraj, seedFrame), randomSeed, pDic = args
+  _, coords, boxes = readDCD(f'{seedTraj}.dcd')
+
+  context = WORKER['contexts'].getContext(WORKER['systemKey'], lambda: WORKER['system'],
+                                          lambda: createIntegrator(pDic, randomSeed))
+  integrator = context.getIntegrator()
+  setFramePositions(context, np.array(coords[seedFrame]), boxes[seedFrame] if boxes else None)
+  context.setVelocitiesToTemperature(float(pDic['temperature']) * kelvin, randomSeed)
+
+  interval = int(pDic['saveInterval'])
+  with open(f'{name}.dcd', 'wb') as f:
+    dcd = DCDFile(f, WORKER['topology'], float(pDic['stepSize']) * picoseconds, interval=interval)
+    for _ in range(int(pDic['nSteps']) // interval):
+      integrator.step(interval)
+      state = context.getState(getPositions=True)
+      dcd.writeModel(state.getPositions(), periodicBoxVectors=state.getPeriodicBoxVectors())
+
+  # Each trajectory is featurized once, all its frames in a vectorized batch
+  _, coords, _ = readDCD(f'{name}.dcd')
+  np.save(f'{name}_features.npy', featurize(np.array(coords), pDic, WORKER['featAtoms']))
+  return name
+
+
+def writeStartFrame(system, pdb, pDic, platform):
+  """Minimizes the input structure and stores it as the single frame trajectory seeding the first round"""
+  integrator = LangevinMiddleIntegrator(float(pDic['temperature']) * kelvin, float(pDic['fricCoef']) / picoseconds,
+                                        float(pDic['stepSize']) * picoseconds)
+  context = Context(system, integrator, *platform)
+  context.setPositions(pdb.positions)
+  if eval(pDic['addMinimization']):
+    LocalEnergyMinimizer.minimize(context, float(pDic['minimTol']) * kilojoules_per_mole / nanometer,
+                                  int(pDic['maxIter']))
+  state = context.getState(getPositions=True)
+  with open('start.dcd', 'wb') as f:
+    DCDFile(f, pdb.topology, float(pDic['stepSize']) * picoseconds).\
+      writeModel(state.getPositions(), periodicBoxVectors=state.getPeriodicBoxVectors())
+
+def writeJoinedTrajectory(state, topology, pDic):
+  """Concatenates the trajectories of all the rounds in a single DCD"""
+  with open('adaptive.dcd', 'wb') as f:
+    dcd = DCDFile(f, topology, float(pDic['stepSize']) * picoseconds, interval=int(pDic['saveInterval']))
+    for traj in state['trajectories']:
+      _, coords, boxes = readDCD(f'{traj["name"]}.dcd')
+      for i, frame in enumerate(coords):
+        dcd.writeModel(np.array(frame) * nanometer, periodicBoxVectors=boxes[i] if boxes else None)
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+  nRounds, nTrajs, nClusters = int(pDic['nRounds']), int(pDic['nTrajs']), int(pDic['nClusters'])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+  system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+  if eval(pDic['addBarostat']):
+    system.addForce(MonteCarloBarostat(float(pDic['pressure']) * bar, float(pDic['temperature']) * kelvin))
+
+  if pDic['features'] == 'Contact map':
+    featAtoms = getContactPairs(pdb.topology, pDic.get('featureResidues', ''))
+  else:
+    featAtoms = getDihedralQuads(pdb.topology, pDic.get('featureResidues', ''))
+
+  gpus = [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()]
+  nThreads = int(pDic.get('nThreads', 1))
+  state = loadState()
+  if not os.path.exists('start.dcd'):
+    writeStartFrame(system, pdb, pDic, getWorkerPlatform(gpus[0] if gpus else None, nThreads))
+
+  # Trajectories run in parallel in one worker per GPU, or in CPU workers sharing the available threads
+  nWorkers = min(len(gpus) if gpus else nThreads, nTrajs)
+  mpContext = multiprocessing.get_context('spawn')
+  deviceQueue = mpContext.Manager().Queue()
+  for i in range(nWorkers):
+    deviceQueue.put(gpus[i] if gpus else None)
+
+  rng = np.random.default_rng(int(pDic['randomSeed']) + state['round'])
+  centers = np.load('cluster_centers.npy') if os.path.exists('cluster_centers.npy') else None
+  with mpContext.Pool(nWorkers, initializer=initWorker,
+                      initargs=(XmlSerializer.serialize(system), pDic['inputFile'], featAtoms, deviceQueue,
+                                max(1, nThreads // nWorkers))) as pool:
+    while state['round'] < nRounds:
+      r = state['round']
+      # Seeds of the round are planned once, so a resumed campaign continues the same round
+      if not any(traj['round'] == r for traj in state['trajectories']):
+        if r == 0:
+          seeds = nTrajs * [('start', 0)]
+        else:
+          frameIndex = [(traj['name'], i) for traj in state['trajectories'] for i in range(traj['nFrames'])]
+          seeds, _ = chooseSeeds(np.load('cluster_labels.npy'), frameIndex, nClusters, nTrajs, rng)
+        state['trajectories'] += [{'name': f'traj_{r}_{i}', 'round': r, 'seed': list(seed), 'done': False,
+                                   'randomSeed': int(rng.integers(2 ** 30))} for i, seed in enumerate(seeds)]
+        saveState(state)
+
+      pending = [traj for traj in state['trajectories'] if traj['round'] == r and not traj['done']]
+      print(f'Round {r}: running {len(pending)} trajectories')
+      sys.stdout.flush()
+      trajDic = {traj['name']: traj for traj in pending}
+      for name in pool.imap_unordered(runTrajectory, [(traj['name'], traj['seed'], traj['randomSeed'], pDic)
+                                                      for traj in pending]):
+        trajDic[name]['done'] = True
+        trajDic[name]['nFrames'] = len(np.load(f'{name}_features.npy', mmap_mode='r'))
+        saveState(state)
+
+      # Cluster all the accumulated data, starting from the previous centers
+      features = np.concatenate([np.load(f'{traj["name"]}_features.npy') for traj in state['trajectories']])
+      centers, labels = kmeans(features, nClusters, centers, rng=rng)
+      np.save('cluster_centers.npy', centers), np.save('cluster_labels.npy', labels)
+      state['clusterCounts'] = np.bincount(labels, minlength=len(centers)).tolist()
+      state['round'] += 1
+      saveState(state)
+      print(f'Round {r} finished: {np.count_nonzero(state["clusterCounts"])} of {len(centers)} clusters visited')
+      sys.stdout.flush()
+
+  writeJoinedTrajectory(state, pdb.topology, pDic)
@@ -0,0 +1,238 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, multiprocessing
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField
+from openmm import LangevinMiddleIntegrator, NonbondedForce, CustomNonbondedForce, CustomCentroidBondForce, \
+  LocalEnergyMinimizer, XmlSerializer
+from openmm.unit import kelvin, picoseconds, kilojoules_per_mole, nanometer, MOLAR_GAS_CONSTANT_R
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, BinaryLogWriter, getLigandAtoms, \
+  getSelectedAtoms, getWorkerPlatform, ContextCache, systemHash, readStructure
+
+LAMBDA_ELEC, LAMBDA_STERICS = 'lambda_electrostatics', 'lambda_sterics'
+# Force groups: the electrostatics (NonbondedForce) and the softcore sterics are the only ones depending on lambda
+CONSTANT_GROUP, ELEC_GROUP, STERICS_GROUP = 0, 1, 2
+
+SOFTCORE_LJ = 'lambdaEff*4*epsilon*x*(x-1); x = sigma^6/reff6; ' \
+              'reff6 = softcoreAlpha*(1-lambdaEff)*sigma^6 + r^6; ' \
+              f'lambdaEff = select(alch1*alch2, 1, {LAMBDA_STERICS}); ' \
+              'sigma = 0.5*(sigma1+sigma2); epsilon = sqrt(epsilon1*epsilon2)'
+
+
+def getLambdaSchedule(elecLambdas, stericsLambdas):
+  """Returns the (electrostatics, sterics) lambdas of the alchemical states: charges are turned off first, with the
+  full sterics, and then the softcore sterics"""
+  return [(le, 1.0) for le in elecLambdas] + [(0.0, ls) for ls in stericsLambdas if ls != 1.0]
+
+def addAlchemicalForces(system, alchAtoms, softcoreAlpha=0.5):
+  """Modifies the system so the interactions of the alchemical atoms with the rest are controlled by the global
+  parameters lambda_electrostatics (charges scaled, annihilated) and lambda_sterics (softcore Lennard-Jones, decoupled:
+  the sterics between alchemical atoms are kept)"""
+  alchAtoms = set(alchAtoms)
+  nbForce = [force for force in system.getForces() if isinstance(force, NonbondedForce)][0]
+
+  softcore = CustomNonbondedForce(SOFTCORE_LJ)
+  softcore.addGlobalParameter(LAMBDA_STERICS, 1.0)
+  softcore.addGlobalParameter('softcoreAlpha', softcoreAlpha)
+  for parName in ['sigma', 'epsilon', 'alch']:
+    softcore.addPerParticleParameter(parName)
+
+  nbForce.addGlobalParameter(LAMBDA_ELEC, 1.0)
+  for i in range(nbForce.getNumParticles()):
+    charge, sigma, epsilon = nbForce.getParticleParameters(i)
+    softcore.addParticle([sigma, epsilon, float(i in alchAtoms)])
+    if i in alchAtoms:
+      # Charge = lambda * charge, the Lennard-Jones of the alchemical atoms is moved to the softcore force
+      nbForce.setParticleParameters(i, 0.0, sigma, 0.0)
+      nbForce.addParticleParameterOffset(LAMBDA_ELEC, i, charge, 0.0, 0.0)
+
+  for i in range(nbForce.getNumExceptions()):
+    p1, p2, _, _, _ = nbForce.getExceptionParameters(i)
+    softcore.addExclusion(p1, p2)
+
+  # Only the pairs involving alchemical atoms are computed by the softcore force
+  softcore.addInteractionGroup(alchAtoms, set(range(system.getNumParticles())) - alchAtoms)
+  softcore.addInteractionGroup(alchAtoms, alchAtoms)
+  if nbForce.getNonbondedMethod() == NonbondedForce.NoCutoff:
+    softcore.setNonbondedMethod(CustomNonbondedForce.NoCutoff)
+  elif nbForce.getNonbondedMethod() == NonbondedForce.CutoffNonPeriodic:
+    softcore.setNonbondedMethod(CustomNonbondedForce.CutoffNonPeriodic)
+  else:
+    softcore.setNonbondedMethod(CustomNonbondedForce.CutoffPeriodic)
+  softcore.setCutoffDistance(nbForce.getCutoffDistance())
+  softcore.setUseSwitchingFunction(nbForce.getUseSwitchingFunction())
+  softcore.setSwitchingDistance(nbForce.getSwitchingDistance())
+  softcore.setUseLongRangeCorrection(nbForce.getUseDispersionCorrection())
+
+  for force in system.getForces():
+    force.setForceGroup(CONSTANT_GROUP)
+  nbForce.setForceGroup(ELEC_GROUP)
+  softcore.setForceGroup(STERICS_GROUP)
+  system.addForce(softcore)
+
+def addCentroidRestraint(system, atoms1, atoms2, radius, k):
+  """Flat bottom harmonic restraint between the centroids of two groups of atoms"""
+  restraint = CustomCentroidBondForce(2, '0.5*restraintK*step(distance(g1, g2)-restraintR)*'
+                                         '(distance(g1, g2)-restraintR)^2')
+  restraint.addGlobalParameter('restraintK', k)
+  restraint.addGlobalParameter('restraintR', radius)
+  restraint.addBond([restraint.addGroup(atoms1), restraint.addGroup(atoms2)])
+  restraint.setUsesPeriodicBoundaryConditions(system.usesPeriodicBoundaryConditions())
+  restraint.setForceGroup(CONSTANT_GROUP)
+  system.addForce(restraint)
+
+def getRestraintCorrection(radius, k, temperature, standardVolume=1.66054):
+  """Free energy (kJ/mol) of releasing the decoupled ligand from the flat bottom restraint to the standard volume
+  (nm^3, 1 M). To be added to the binding free energy"""
+  kT = (MOLAR_GAS_CONSTANT_R * temperature * kelvin).value_in_unit(kilojoules_per_mole)
+  r = np.linspace(0, radius + 10 * np.sqrt(kT / k), 10000)
+  energies = 0.5 * k * np.clip(r - radius, 0, None) ** 2
+  # Trapezoid rule written out: np.trapz was removed in NumPy 2 (np.trapezoid does not exist in NumPy < 2)
+  density = 4 * np.pi * r ** 2 * np.exp(-energies / kT)
+  restrainedVolume = np.sum((density[1:] + density[:-1]) * np.diff(r)) / 2
+  return kT * np.log(standardVolume / restrainedVolume)
+
+
+def getReducedPotentials(context, states, kT):
+  """Reduced potentials (without the lambda independent terms) of the current configuration at every state.
+  The electrostatics are quadratic in the charge scaling, so three evaluations of the NonbondedForce are enough for
+  all the states, while the softcore force, which only involves the alchemical atoms, is evaluated once per
+  sterics lambda"""
+  getEnergy = lambda group: context.getState(getEnergy=True, groups={group}).getPotentialEnergy().\
+    value_in_unit(kilojoules_per_mole)
+  oriElec, oriSterics = context.getParameter(LAMBDA_ELEC), context.getParameter(LAMBDA_STERICS)
+
+  elecEnergies = []
+  for lambdaElec in [0.0, 0.5, 1.0]:
+    context.setParameter(LAMBDA_ELEC, lambdaElec)
+    elecEnergies.append(getEnergy(ELEC_GROUP))
+  e0, eHalf, e1 = elecEnergies
+  c2 = 2 * (e1 - 2 * eHalf + e0)
+  c1 = e1 - e0 - c2
+
+  stericsEnergies = {}
+  for lambdaSterics in set(ls for _, ls in states):
+    context.setParameter(LAMBDA_STERICS, lambdaSterics)
+    stericsEnergies[lambdaSterics] = getEnergy(STERICS_GROUP)
+
+  context.setParameter(LAMBDA_ELEC, oriElec)
+  context.setParameter(LAMBDA_STERICS, oriSterics)
+  return [(e0 + c1 * le + c2 * le ** 2 + stericsEnergies[ls]) / kT for le, ls in states]
+
+
+################# Parallel windows #################
+# The System is built and serialized once in the main process, each worker deserializes it and runs its windows,
+# reusing the same Context (only the lambdas, positions and box change between windows)
+WORKER = {}
+
+def initWorker(systemXml, positions, deviceQueue, nThreads):
+  WORKER['system'] = XmlSerializer.deserialize(systemXml)
+  WORKER['systemKey'] = systemHash(WORKER['system'])
+  WORKER['positions'] = positions
+  WORKER['contexts'] = ContextCache(*getWorkerPlatform(deviceQueue.get(), nThreads))
+
+def runWindow(args):
+  k, states, pDic = args
+  temperature = float(pDic['temperature'])
+  kT = (MOLAR_GAS_CONSTANT_R * temperature * kelvin).value_in_unit(kilojoules_per_mole)
+
+  context = WORKER['contexts'].getContext(
+    WORKER['systemKey'], lambda: WORKER['system'],
+    lambda: LangevinMiddleIntegrator(temperature * kelvin, float(pDic['fricCoef']) / picoseconds,
+                                     float(pDic['stepSize']) * picoseconds))
+  integrator = context.getIntegrator()
+  if WORKER['system'].usesPeriodicBoundaryConditions():
+    context.setPeriodicBoxVectors(*WORKER['system'].getDefaultPeriodicBoxVectors())
+  context.setPositions(WORKER['positions'])
+  context.setParameter(LAMBDA_ELEC, states[k][0])
+  context.setParameter(LAMBDA_STERICS, states[k][1])
+
+  LocalEnergyMinimizer.minimize(context, float(pDic['minimTol']) * kilojoules_per_mole / nanometer,
+                                int(pDic['maxIter']))
+  context.setVelocitiesToTemperature(temperature * kelvin)
+  integrator.step(int(pDic['nEquilSteps']))
+
+  nSteps = int(pDic['stepsPerIteration'])
+  uLog = BinaryLogWriter(f'window_{k}.bin', ['step'] + [f'u_{l}' for l in range(len(states))],
+                         metadata={'state': k, 'temperature': temperature,
+                                   'electrostatics': [le for le, _ in states], 'sterics': [ls for _, ls in states]})
+  for it in range(int(pDic['nIterations'])):
+    integrator.step(nSteps)
+    uLog.append([(it + 1) * nSteps] + getReducedPotentials(context, states, kT))
+  uLog.close()
+  print(f'Window {k} (electrostatics: {states[k][0]}, sterics: {states[k][1]}) finished')
+  sys.stdout.flush()
+  return k
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+  states = getLambdaSchedule([float(l) for l in pDic['elecLambdas'].split(',')],
+                             [float(l) for l in pDic['stericsLambdas'].split(',')])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+  system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+
+  alchAtoms = getLigandAtoms(pdb.topology, pDic.get('alchResidues', ''))
+  print(f'Building {len(states)} alchemical states for {len(alchAtoms)} atoms')
+  addAlchemicalForces(system, alchAtoms, float(pDic['softcoreAlpha']))
+
+  restrain = eval(pDic.get('restrainLigand', 'False'))
+  if restrain:
+    receptorAtoms = getSelectedAtoms(pdb.topology, pDic['pocketResidues'])
+    addCentroidRestraint(system, alchAtoms, receptorAtoms, float(pDic['restraintRadius']),
+                         float(pDic['restraintK']))
+
+  # Windows run in parallel in one worker per GPU, or in CPU workers sharing the available threads
+  gpus = [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()]
+  nThreads = int(pDic.get('nThreads', 1))
+  nWorkers = min(len(gpus) if gpus else nThreads, len(states))
+
+  mpContext = multiprocessing.get_context('spawn')
+  deviceQueue = mpContext.Manager().Queue()
+  for i in range(nWorkers):
+    deviceQueue.put(gpus[i] if gpus else None)
+
+  with mpContext.Pool(nWorkers, initializer=initWorker,
+                      initargs=(XmlSerializer.serialize(system), pdb.positions, deviceQueue,
+                                max(1, nThreads // nWorkers))) as pool:
+    for _ in pool.imap_unordered(runWindow, [(k, states, pDic) for k in range(len(states))]):
+      pass
+
+  with open('alchemical_states.txt', 'w') as f:
+    f.write(f'nStates :: {len(states)}\n')
+    if restrain:
+      correction = getRestraintCorrection(float(pDic['restraintRadius']), float(pDic['restraintK']),
+                                          float(pDic['temperature']))
+      f.write(f'restraintCorrection :: {correction}\n')
@@ -0,0 +1,63 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys
+
+# Openmm imports
+from openmm.app import ForceField
+from openmm import Context, VerletIntegrator
+from openmm.unit import picoseconds
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, assignForceGroups, getGroupEnergies, \
+  BinaryLogWriter, readDCD, setFramePositions, readStructure, parseDevices, getWorkerPlatform
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+  stride = int(pDic['stride'])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+
+  system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+  groupNames = assignForceGroups(system)
+
+  # A single context is reused for every frame, only positions and box are updated
+  gpus, nThreads = parseDevices(pDic)
+  platform, properties = getWorkerPlatform(gpus[0] if gpus else None, nThreads)
+  context = Context(system, VerletIntegrator(0.001 * picoseconds), platform, properties)
+  steps, coords, boxes = readDCD(pDic['trajFile'])
+  print(f'Evaluating {len(groupNames)} force groups over {len(range(0, len(steps), stride))} frames')
+  sys.stdout.flush()
+
+  egLog = BinaryLogWriter(pDic['outputFile'], ['step'] + groupNames)
+  for i in range(0, len(steps), stride):
+    setFramePositions(context, coords[i], boxes[i] if boxes else None)
+    egLog.append([steps[i]] + getGroupEnergies(context, len(groupNames)))
+  egLog.close()
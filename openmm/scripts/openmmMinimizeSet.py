@@ -0,0 +1,139 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, os, multiprocessing
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField, Modeller
+from openmm import VerletIntegrator, LocalEnergyMinimizer, CustomExternalForce
+from openmm.unit import kilojoules_per_mole, nanometer
+
+from openmmUtils import parseParams, getSystemKwargs, getWorkerPlatform, BinaryLogWriter, ContextCache, topologyHash, \
+  isPDBxFile, readStructure, writeStructure
+
+CONTEXT_CACHE_SIZE = 8
+RESTRAINT_GROUP = 31
+
+
+def addHeavyAtomsRestraint(system, topology, k):
+  """Restrains the heavy atoms to reference positions (per particle parameters, set for each structure). The
+  restraint is placed in its own force group, excluded from the reported energies"""
+  force = CustomExternalForce('0.5*restraintK*((x-x0)^2 + (y-y0)^2 + (z-z0)^2)')
+  force.addGlobalParameter('restraintK', k)
+  for par in ['x0', 'y0', 'z0']:
+    force.addPerParticleParameter(par)
+  for atom in topology.atoms():
+    if atom.element is not None and atom.element.symbol != 'H':
+      force.addParticle(atom.index, [0, 0, 0])
+  force.setForceGroup(RESTRAINT_GROUP)
+  system.addForce(force)
+
+def setRestraintReference(context, positions):
+  force = [f for f in context.getSystem().getForces() if f.getForceGroup() == RESTRAINT_GROUP][0]
+  for i in range(force.getNumParticles()):
+    atomIdx, _ = force.getParticleParameters(i)
+    force.setParticleParameters(i, atomIdx, positions[atomIdx])
+  force.updateParametersInContext(context)
+
+
+################# Parallel minimizations #################
+# Each worker keeps a single ForceField and the Contexts of the last topologies it has seen: structures with the
+# same topology (e.g. models of the same sequence) reuse the System and Context, only updating the positions
+WORKER = {}
+
+def initWorker(pDic, deviceQueue, nThreads):
+  WORKER['forcefield'] = ForceField(pDic['mFF'], pDic['wFF'])
+  cacheSize = CONTEXT_CACHE_SIZE if eval(pDic['reuseContexts']) else 0
+  WORKER['contexts'] = ContextCache(*getWorkerPlatform(deviceQueue.get(), nThreads), maxSize=cacheSize)
+
+def createSystem(topology, pDic):
+  system = WORKER['forcefield'].createSystem(topology, **getSystemKwargs(pDic))
+  if eval(pDic['restrainHeavy']):
+    addHeavyAtomsRestraint(system, topology, float(pDic['restraintK']))
+  return system
+
+def minimizeStructure(args):
+  idx, inFile, outFile, pDic = args
+  pdb = readStructure(inFile)
+  modeller = Modeller(pdb.topology, pdb.positions)
+  if eval(pDic['addH']):
+    modeller.addHydrogens(WORKER['forcefield'], pH=float(pDic['hPH']))
+
+  context = WORKER['contexts'].getContext(topologyHash(modeller.topology),
+                                          lambda: createSystem(modeller.topology, pDic),
+                                          lambda: VerletIntegrator(0.001))
+  positions = np.array(modeller.positions.value_in_unit(nanometer))
+  context.setPositions(positions * nanometer)
+  if eval(pDic['restrainHeavy']):
+    setRestraintReference(context, positions)
+
+  energyGroups = set(range(32)) - {RESTRAINT_GROUP}
+  initEnergy = context.getState(getEnergy=True, groups=energyGroups).getPotentialEnergy()\
+    .value_in_unit(kilojoules_per_mole)
+  LocalEnergyMinimizer.minimize(context, float(pDic['minimTol']) * kilojoules_per_mole / nanometer,
+                                int(pDic['maxIter']))
+  state = context.getState(getEnergy=True, getPositions=True, groups=energyGroups)
+  finalEnergy = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+  finalPositions = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+
+  # The output keeps the format of the input structure
+  writeStructure(modeller.topology, finalPositions * nanometer, os.path.splitext(outFile)[0], keepIds=True,
+                 pdbx=isPDBxFile(outFile))
+  heavy = [atom.index for atom in modeller.topology.atoms() if atom.element is not None and atom.element.symbol != 'H']
+  rmsd = np.sqrt(np.mean(np.sum((finalPositions[heavy] - positions[heavy]) ** 2, axis=1)))
+  return [idx, initEnergy, finalEnergy, rmsd]
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+  inFiles = pDic['inputFiles'].split(',')
+  outFiles = [os.path.join(pDic['outputDir'], 'min_{}_{}'.format(i + 1, os.path.basename(inFile)))
+              for i, inFile in enumerate(inFiles)]
+
+  gpus = [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()]
+  nThreads = int(pDic.get('nThreads', 1))
+  # Structures are minimized in parallel in one worker per GPU, or in CPU workers sharing the available threads
+  nWorkers = min(len(gpus) if gpus else nThreads, len(inFiles))
+
+  mpContext = multiprocessing.get_context('spawn')
+  deviceQueue = mpContext.Manager().Queue()
+  for i in range(nWorkers):
+    deviceQueue.put(gpus[i] if gpus else None)
+
+  energiesLog = BinaryLogWriter('minimization.bin', ['structure', 'initialEnergy', 'finalEnergy', 'heavyRMSD'])
+  with mpContext.Pool(nWorkers, initializer=initWorker, initargs=(pDic, deviceQueue, max(1, nThreads // nWorkers))) \
+          as pool:
+    # Consecutive structures go to the same worker, so those sharing topology tend to reuse its contexts
+    chunkSize = max(1, min(16, len(inFiles) // (4 * nWorkers)))
+    for row in pool.imap_unordered(minimizeStructure, [(i, inFile, outFiles[i], pDic)
+                                                       for i, inFile in enumerate(inFiles)], chunksize=chunkSize):
+      energiesLog.append(row)
+      print('Structure {}: {:.1f} -> {:.1f} kJ/mol'.format(int(row[0]) + 1, row[1], row[2]))
+      sys.stdout.flush()
+  energiesLog.close()
@@ -0,0 +1,317 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, copy, hashlib, multiprocessing
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField
+from openmm import LangevinMiddleIntegrator, LocalEnergyMinimizer, XmlSerializer, NonbondedForce, \
+  CustomNonbondedForce, CustomExternalForce
+from openmm.unit import kelvin, picoseconds, kilojoules_per_mole, nanometer, nanometers
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, getSelectedAtoms, getWorkerPlatform, \
+  BinaryLogWriter, ContextCache, SOLVENT_RESIDUES, readStructure
+
+INTERACTION_GROUP, INTERACTION_SCALE = 31, 'interactionScale'
+ONE_4PI_EPS0 = 138.935456
+RF_DIELECTRIC = 78.5
+
+
+################# Receptor - ligand systems #################
+
+def mergeLigandSystem(system, ligandSystem):
+  """Appends the particles, constraints and forces of a ligand System (built with the same force field options) to
+  a receptor System. The ligand forces are added to the receptor forces of the same class"""
+  offset = system.getNumParticles()
+  for i in range(ligandSystem.getNumParticles()):
+    system.addParticle(ligandSystem.getParticleMass(i))
+  for i in range(ligandSystem.getNumConstraints()):
+    p1, p2, dist = ligandSystem.getConstraintParameters(i)
+    system.addConstraint(p1 + offset, p2 + offset, dist)
+
+  forces = {}
+  for force in system.getForces():
+    forces.setdefault(force.__class__.__name__, force)
+
+  for ligForce in ligandSystem.getForces():
+    name = ligForce.__class__.__name__
+    if name == 'CMMotionRemover':
+      continue
+    if name not in forces:
+      raise ValueError(f'The ligand {name} has no counterpart in the receptor system')
+    force = forces[name]
+
+    if name == 'HarmonicBondForce':
+      for i in range(ligForce.getNumBonds()):
+        p1, p2, *pars = ligForce.getBondParameters(i)
+        force.addBond(p1 + offset, p2 + offset, *pars)
+    elif name == 'HarmonicAngleForce':
+      for i in range(ligForce.getNumAngles()):
+        p1, p2, p3, *pars = ligForce.getAngleParameters(i)
+        force.addAngle(p1 + offset, p2 + offset, p3 + offset, *pars)
+    elif name == 'PeriodicTorsionForce':
+      for i in range(ligForce.getNumTorsions()):
+        p1, p2, p3, p4, *pars = ligForce.getTorsionParameters(i)
+        force.addTorsion(p1 + offset, p2 + offset, p3 + offset, p4 + offset, *pars)
+    elif name == 'NonbondedForce':
+      for i in range(ligForce.getNumParticles()):
+        force.addParticle(*ligForce.getParticleParameters(i))
+      for i in range(ligForce.getNumExceptions()):
+        p1, p2, *pars = ligForce.getExceptionParameters(i)
+        force.addException(p1 + offset, p2 + offset, *pars)
+    elif name == 'GBSAOBCForce':
+      for i in range(ligForce.getNumParticles()):
+        force.addParticle(*ligForce.getParticleParameters(i))
+    elif name == 'CustomGBForce':
+      for i in range(ligForce.getNumParticles()):
+        force.addParticle(ligForce.getParticleParameters(i))
+      for i in range(ligForce.getNumExclusions()):
+        p1, p2 = ligForce.getExclusionParticles(i)
+        force.addExclusion(p1 + offset, p2 + offset)
+    else:
+      raise ValueError(f'Merging {name} forces is not supported')
+  return offset
+
+def getClashingWaters(ligandPositions, clearance):
+  """Returns the indexes of the atoms of the waters of the receptor clashing with the ligand (any atom closer than
+  clearance, in nm)"""
+  positions = WORKER['positions']
+  ghosts = []
+  for res in WORKER['waters']:
+    idxs = [atom.index for atom in res.atoms()]
+    diff = positions[idxs][:, None, :] - ligandPositions[None, :, :]
+    if WORKER['box'] is not None:
+      diff -= np.round(diff / WORKER['box']) * WORKER['box']
+    if np.min(np.linalg.norm(diff, axis=-1)) < clearance:
+      ghosts += idxs
+  return ghosts
+
+def ghostWaters(system, ghosts):
+  """Turns off the nonbonded interactions of the clashing waters, as they cannot be removed from the prebuilt System"""
+  nonbonded = [f for f in system.getForces() if isinstance(f, NonbondedForce)][0]
+  for i in ghosts:
+    nonbonded.setParticleParameters(i, 0.0, 1.0, 0.0)
+
+def addInteractionForce(system, ligandAtoms, envAtoms):
+  """Adds the Lennard-Jones and Coulomb (reaction field if a cutoff is used) interaction between the ligand and
+  its environment, scaled by a global parameter set to 0 so it does not act on the dynamics. Its value is obtained
+  as the energy derivative respect to that parameter"""
+  nonbonded = [f for f in system.getForces() if isinstance(f, NonbondedForce)][0]
+  expression = f'{INTERACTION_SCALE}*(4*epsilon*((sigma/r)^12-(sigma/r)^6) + {ONE_4PI_EPS0}*q1*q2*(1/r + krf*r^2 - crf));' \
+               'sigma=0.5*(sigma1+sigma2); epsilon=sqrt(epsilon1*epsilon2)'
+  force = CustomNonbondedForce(expression)
+  force.addGlobalParameter(INTERACTION_SCALE, 0.0)
+  force.addEnergyParameterDerivative(INTERACTION_SCALE)
+  for par in ['q', 'sigma', 'epsilon']:
+    force.addPerParticleParameter(par)
+  for i in range(nonbonded.getNumParticles()):
+    q, sigma, epsilon = nonbonded.getParticleParameters(i)
+    force.addParticle([q, sigma, epsilon])
+  # Exclusions must match the nonbonded exceptions, although the interaction group never contains them
+  for i in range(nonbonded.getNumExceptions()):
+    force.addExclusion(*nonbonded.getExceptionParameters(i)[:2])
+
+  krf, crf = 0.0, 0.0
+  if nonbonded.getNonbondedMethod() == NonbondedForce.NoCutoff:
+    force.setNonbondedMethod(CustomNonbondedForce.NoCutoff)
+  else:
+    cutoff = nonbonded.getCutoffDistance().value_in_unit(nanometer)
+    krf = (RF_DIELECTRIC - 1) / (2 * RF_DIELECTRIC + 1) / cutoff ** 3
+    crf = 3 * RF_DIELECTRIC / (2 * RF_DIELECTRIC + 1) / cutoff
+    force.setNonbondedMethod(CustomNonbondedForce.CutoffPeriodic if system.usesPeriodicBoundaryConditions()
+                             else CustomNonbondedForce.CutoffNonPeriodic)
+    force.setCutoffDistance(cutoff)
+  force.addGlobalParameter('krf', krf)
+  force.addGlobalParameter('crf', crf)
+
+  force.addInteractionGroup(ligandAtoms, envAtoms)
+  force.setForceGroup(INTERACTION_GROUP)
+  system.addForce(force)
+
+def addReceptorRestraint(system, atoms, positions, k):
+  """Restrains the receptor heavy atoms to their initial positions with a harmonic force (kJ/mol/nm^2)"""
+  expression = 'periodicdistance(x, y, z, x0, y0, z0)^2' if system.usesPeriodicBoundaryConditions() \
+    else '(x-x0)^2 + (y-y0)^2 + (z-z0)^2'
+  force = CustomExternalForce(f'0.5*restraintK*{expression}')
+  force.addGlobalParameter('restraintK', k)
+  for par in ['x0', 'y0', 'z0']:
+    force.addPerParticleParameter(par)
+  for i in atoms:
+    force.addParticle(i, positions[i])
+  system.addForce(force)
+
+
+################# Stability metrics #################
+
+def superpose(mobile, reference):
+  """Returns the rotation and translations (Kabsch) superposing the mobile coordinates to the reference"""
+  mCenter, rCenter = mobile.mean(axis=0), reference.mean(axis=0)
+  u, _, vt = np.linalg.svd((mobile - mCenter).T @ (reference - rCenter))
+  d = np.sign(np.linalg.det(u @ vt))
+  rotation = u @ np.diag([1, 1, d]) @ vt
+  return rotation, mCenter, rCenter
+
+def ligandRMSD(frame, reference, alignAtoms, ligandAtoms):
+  """RMSD (nm) of the ligand atoms after superposing the frame on the reference by the alignment atoms (if any)"""
+  moved = frame[ligandAtoms]
+  if len(alignAtoms) >= 3:
+    rotation, mCenter, rCenter = superpose(frame[alignAtoms], reference[alignAtoms])
+    moved = (moved - mCenter) @ rotation + rCenter
+  return np.sqrt(np.mean(np.sum((moved - reference[ligandAtoms]) ** 2, axis=1)))
+
+
+################# Parallel poses #################
+# The receptor System is built and serialized once in the main process. Each worker deserializes it once and, for
+# each pose, appends to a copy of it the prebuilt ligand System, so no force field is applied in the workers.
+# Poses of the same ligand clashing with the same waters give identical Systems, which reuse their Context
+WORKER = {}
+
+def initWorker(receptorXml, receptorFile, deviceQueue, nThreads):
+  pdb = readStructure(receptorFile)
+  WORKER['system'] = XmlSerializer.deserialize(receptorXml)
+  WORKER['positions'] = np.array(pdb.positions.value_in_unit(nanometer))
+  box = pdb.topology.getUnitCellDimensions()
+  WORKER['box'] = np.array(box.value_in_unit(nanometer)) if box is not None else None
+  WORKER['waters'] = [res for res in pdb.topology.residues() if res.name in ['HOH', 'WAT']]
+  WORKER['receptorAtoms'] = getSelectedAtoms(pdb.topology)
+  WORKER['heavyAtoms'] = [atom.index for atom in pdb.topology.atoms()
+                          if atom.index in set(WORKER['receptorAtoms']) and atom.element is not None
+                          and atom.element.symbol != 'H']
+  WORKER['cas'] = [atom.index for atom in pdb.topology.atoms() if atom.name == 'CA'
+                   and atom.residue.name not in SOLVENT_RESIDUES]
+  WORKER['contexts'] = ContextCache(*getWorkerPlatform(deviceQueue.get(), nThreads))
+
+def createPoseSystem(ligandXml, ghosts, pDic):
+  system = copy.deepcopy(WORKER['system'])
+  offset = mergeLigandSystem(system, XmlSerializer.deserialize(ligandXml))
+  ghostWaters(system, ghosts)
+  envAtoms = [i for i in range(offset) if i not in set(ghosts)]
+  addInteractionForce(system, list(range(offset, system.getNumParticles())), envAtoms)
+  if eval(pDic['restrainReceptor']):
+    addReceptorRestraint(system, WORKER['heavyAtoms'], WORKER['positions'], float(pDic['restraintK']))
+  return system
+
+def createIntegrator(pDic):
+  integrator = LangevinMiddleIntegrator(float(pDic['temperature']) * kelvin, float(pDic['fricCoef']) / picoseconds,
+                                        float(pDic['stepSize']) * picoseconds)
+  integrator.setIntegrationForceGroups(set(range(32)) - {INTERACTION_GROUP})
+  return integrator
+
+def runPose(args):
+  poseIdx, ligandXml, ligandPositions, ligandHeavy, pDic = args
+  offset = WORKER['system'].getNumParticles()
+  ghosts = []
+  if WORKER['waters']:
+    ghosts = getClashingWaters(ligandPositions, float(pDic['waterClearance']))
+
+  key = hashlib.sha1((ligandXml + str(ghosts)).encode()).hexdigest()
+  context = WORKER['contexts'].getContext(key, lambda: createPoseSystem(ligandXml, ghosts, pDic),
+                                          lambda: createIntegrator(pDic))
+  integrator = context.getIntegrator()
+  if WORKER['box'] is not None:
+    context.setPeriodicBoxVectors(*context.getSystem().getDefaultPeriodicBoxVectors())
+  reference = np.concatenate([WORKER['positions'], ligandPositions])
+  context.setPositions(reference * nanometers)
+  LocalEnergyMinimizer.minimize(context, float(pDic['minimTol']) * kilojoules_per_mole / nanometer,
+                                int(pDic['maxIter']))
+  context.setVelocitiesToTemperature(float(pDic['temperature']) * kelvin)
+
+  # Receptor alpha carbons around the docked pose define the frame to measure the ligand displacement
+  ligHeavy = offset + np.array(ligandHeavy)
+  cas = np.array(WORKER['cas'] or WORKER['heavyAtoms'], dtype=int)
+  pocketCAs = cas[np.linalg.norm(reference[cas][:, None] - reference[ligHeavy][None], axis=-1).min(axis=1, initial=np.inf)
+                  < 1.0]
+  alignAtoms = pocketCAs if len(pocketCAs) >= 3 else cas
+
+  rows, interval = [], int(pDic['saveInterval'])
+  for step in range(0, int(pDic['nSteps']) + 1, interval):
+    if step > 0:
+      integrator.step(interval)
+    state = context.getState(getPositions=True, getParameterDerivatives=True, enforcePeriodicBox=False,
+                             groups={INTERACTION_GROUP})
+    frame = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+    rows.append([poseIdx, step, ligandRMSD(frame, reference, alignAtoms, ligHeavy),
+                 state.getEnergyParameterDerivatives()[INTERACTION_SCALE]])
+  return rows
+
+
+def loadPoses(pDic):
+  """Returns the openff molecules of the docked poses"""
+  from openff.toolkit.topology import Molecule
+  return [Molecule.from_file(poseFile, allow_undefined_stereo=True) for poseFile in pDic['poseFiles'].split(',')]
+
+def iterPoseArgs(poses, forcefield, box, pDic):
+  """Yields the arguments of each pose: its ligand System, built with the receptor force field options, and its
+  coordinates. The ligand template generator keeps the parameters of each molecule, so the poses of the same
+  molecule are only parametrized once"""
+  from openff.units.openmm import to_openmm
+  for i, mol in enumerate(poses):
+    topology = mol.to_topology().to_openmm()
+    topology.setPeriodicBoxVectors(box)
+    ligandSystem = forcefield.createSystem(topology, **getSystemKwargs(pDic))
+    positions = np.array(to_openmm(mol.conformers[0]).value_in_unit(nanometer))
+    heavy = [j for j, atom in enumerate(mol.atoms) if atom.atomic_number > 1]
+    yield i, XmlSerializer.serialize(ligandSystem), positions, heavy, pDic
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+  receptorSystem = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+
+  poses = loadPoses(pDic)
+  registerLigandTemplates(forcefield, {'ligandFiles': pDic['poseFiles'], 'ligandFF': pDic['poseFF'],
+                                       'ligandCache': pDic['poseCache']})
+
+  gpus = [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()]
+  nThreads = int(pDic.get('nThreads', 1))
+  # Poses run in parallel in one worker per GPU, or in CPU workers sharing the available threads
+  nWorkers = min(len(gpus) if gpus else nThreads, len(poses))
+
+  mpContext = multiprocessing.get_context('spawn')
+  deviceQueue = mpContext.Manager().Queue()
+  for i in range(nWorkers):
+    deviceQueue.put(gpus[i] if gpus else None)
+
+  metricsLog = BinaryLogWriter('pose_metrics.bin', ['pose', 'step', 'ligandRMSD', 'interactionEnergy'],
+                               metadata={'nPoses': len(poses), 'temperature': float(pDic['temperature'])})
+  with mpContext.Pool(nWorkers, initializer=initWorker,
+                      initargs=(XmlSerializer.serialize(receptorSystem), pDic['inputFile'], deviceQueue,
+                                max(1, nThreads // nWorkers))) as pool:
+    for rows in pool.imap_unordered(runPose, iterPoseArgs(poses, forcefield, pdb.topology.getPeriodicBoxVectors(),
+                                                           pDic)):
+      for row in rows:
+        metricsLog.append(row)
+      print(f'Pose {int(rows[0][0])} finished: final ligand RMSD {10 * rows[-1][2]:.2f} A, '
+            f'interaction energy {rows[-1][3]:.1f} kJ/mol')
+      sys.stdout.flush()
+  metricsLog.close()
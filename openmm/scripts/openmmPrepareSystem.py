@@ -30,41 +30,67 @@ from openmm.app import *
 from openmm import *
 from openmm.unit import *
 
-def parseParams(paramsFile):
-  paramsDic = {}
-  with open(paramsFile) as f:
-    for line in f:
-      key, value = line.strip().split('::')
-      paramsDic[key.strip()] = value.strip()
-  return paramsDic
+import numpy as np
+
+from openmmUtils import parseParams, isImplicit, registerLigandTemplates, addLigands, orientAlongZ, \
+  readStructure, writeStructure, addSolventFast, parseDevices, setDefaultPlatform
+
+
+def writeSolvationSummary(topology, summaryFile):
+  """Writes the number of atoms of the system and, if periodic, the volume of the box and an estimation of the atoms
+  a cubic box with the same padding would contain"""
+  waterAtoms = [len(res) for res in topology.residues() if res.name == 'HOH']
+  with open(summaryFile, 'w') as f:
+    f.write('nAtoms :: {}\nnWaters :: {}\n'.format(topology.getNumAtoms(), len(waterAtoms)))
+
+    boxVectors = topology.getPeriodicBoxVectors()
+    if boxVectors is not None:
+      boxVectors = np.array(boxVectors.value_in_unit(nanometers))
+      boxVolume, cubeVolume = np.linalg.det(boxVectors), np.linalg.norm(boxVectors[0]) ** 3
+      cubeAtoms = topology.getNumAtoms() + sum(waterAtoms) / boxVolume * (cubeVolume - boxVolume)
+      f.write('boxVolume :: {}\ncubeAtoms :: {}\n'.format(boxVolume, int(cubeAtoms)))
 
 
 if __name__ == "__main__":
     pDic = parseParams(sys.argv[1])
+    setDefaultPlatform(*parseDevices(pDic))
     sysName = os.path.splitext(os.path.basename(pDic['inputFile']))[0]
 
-    pdb = PDBFile(pDic['inputFile'])
+    pdb = readStructure(pDic['inputFile'])
     forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+    ligands = registerLigandTemplates(forcefield, pDic)
 
     modeller = Modeller(pdb.topology, pdb.positions)
     if eval(pDic['addH']):
       modeller.addHydrogens(forcefield, pH=float(pDic['hPH']))
+    addLigands(modeller, ligands)
 
     # todo: infer model arg from wFF
     if 'boxSize' in pDic:
       bSize = list(map(float, pDic['boxSize'].split(',')))
       kwargs = {"boxSize": Vec3(bSize[0], bSize[1], bSize[2])*nanometers}
     else:
-      kwargs = {"padding": float(pDic['padDist'])}
+      kwargs = {"padding": float(pDic['padDist']), "boxShape": pDic['boxShape']}
 
     kwargs.update({"ionicStrength": float(pDic['saltConc'])*molar, "neutralize": eval(pDic['neutralize']),
                    "positiveIon": pDic['cationType'], "negativeIon": pDic['anionType']})
 
-    modeller.addSolvent(forcefield, model=pDic['wModel'], **kwargs)
-
-    PDBFile.writeFile(modeller.topology, modeller.positions,
-                      open('{}_system.pdb'.format(sysName), 'w'))
-
-
-
+    if pDic['solventType'] == 'Membrane':
+      if eval(pDic['orientProtein']):
+        orientAlongZ(modeller)
+      for sizeKey in ['boxSize', 'padding', 'boxShape']:
+        kwargs.pop(sizeKey, None)
+      modeller.addMembrane(forcefield, lipidType=pDic['lipidType'], minimumPadding=float(pDic['memPadding'])*nanometers,
+                           membraneCenterZ=float(pDic['memCenterZ'])*nanometers, **kwargs)
+    # Implicit solvent systems are not solvated, the solvent is included in the force field
+    # The fast solvation places the waters and ions with array operations, for very large boxes
+    elif not isImplicit(pDic) and eval(pDic.get('fastSolvation', 'False')):
+      kwargs.update({'ionicStrength': float(pDic['saltConc'])})
+      if 'boxSize' in pDic:
+        kwargs['boxSize'] = bSize
+      addSolventFast(modeller, forcefield, model=pDic['wModel'], **kwargs)
+    elif not isImplicit(pDic):
+      modeller.addSolvent(forcefield, model=pDic['wModel'], **kwargs)
 
+    writeStructure(modeller.topology, modeller.positions, '{}_system'.format(sysName))
+    writeSolvationSummary(modeller.topology, 'solvationSummary.txt')
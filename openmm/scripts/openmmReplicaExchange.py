@@ -0,0 +1,237 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, os
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField, DCDFile
+from openmm import Context, LangevinMiddleIntegrator, NonbondedForce, PeriodicTorsionForce, CustomTorsionForce, \
+  LocalEnergyMinimizer
+from openmm.unit import kelvin, picoseconds, kilojoules_per_mole, nanometer, MOLAR_GAS_CONSTANT_R
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, BinaryLogWriter, \
+  getSelectedAtoms, readStructure, writeStructure, parseDevices, getWorkerPlatform
+
+REST_SCALE, REST_SQRT = 'restScale', 'restSqrt'
+
+
+def getTemperatureLadder(tMin, tMax, nReplicas):
+  """Geometric ladder of temperatures, which gives similar acceptances between neighbours"""
+  return tMin * (tMax / tMin) ** (np.arange(nReplicas) / (nReplicas - 1))
+
+def addRESTForces(system, soluteAtoms):
+  """Modifies the system so the interactions of the solute atoms are scaled by the REST2 global parameters:
+  restScale = lambda - 1 (solute-solute) and restSqrt = sqrt(lambda) - 1 (solute-solvent).
+  The same System can then be shared by all the replicas, which only differ in the value of these parameters"""
+  soluteAtoms = set(soluteAtoms)
+  for force in system.getForces():
+    if isinstance(force, NonbondedForce):
+      force.addGlobalParameter(REST_SCALE, 0.0)
+      force.addGlobalParameter(REST_SQRT, 0.0)
+      for i in soluteAtoms:
+        charge, sigma, epsilon = force.getParticleParameters(i)
+        force.addParticleParameterOffset(REST_SQRT, i, charge, 0.0, 0.0)
+        force.addParticleParameterOffset(REST_SCALE, i, 0.0, 0.0, epsilon)
+
+      for i in range(force.getNumExceptions()):
+        p1, p2, chargeProd, sigma, epsilon = force.getExceptionParameters(i)
+        nSolute = (p1 in soluteAtoms) + (p2 in soluteAtoms)
+        if nSolute > 0 and (chargeProd._value != 0 or epsilon._value != 0):
+          force.addExceptionParameterOffset(REST_SCALE if nSolute == 2 else REST_SQRT, i, chargeProd, 0.0, epsilon)
+
+    elif isinstance(force, PeriodicTorsionForce):
+      restTorsions = CustomTorsionForce(f'(1 + full*{REST_SCALE} + (1-full)*{REST_SQRT})'
+                                        '*k*(1+cos(periodicity*theta-phase))')
+      for parName in ['periodicity', 'phase', 'k', 'full']:
+        restTorsions.addPerTorsionParameter(parName)
+      restTorsions.addGlobalParameter(REST_SCALE, 0.0)
+      restTorsions.addGlobalParameter(REST_SQRT, 0.0)
+
+      for i in range(force.getNumTorsions()):
+        p1, p2, p3, p4, periodicity, phase, k = force.getTorsionParameters(i)
+        nSolute = sum([p in soluteAtoms for p in [p1, p2, p3, p4]])
+        if nSolute > 0:
+          restTorsions.addTorsion(p1, p2, p3, p4, [periodicity, phase, k, float(nSolute == 4)])
+          force.setTorsionParameters(i, p1, p2, p3, p4, periodicity, phase, 0.0)
+      system.addForce(restTorsions)
+
+def setRESTState(context, restLambda):
+  context.setParameter(REST_SCALE, restLambda - 1)
+  context.setParameter(REST_SQRT, np.sqrt(restLambda) - 1)
+
+
+class ReplicaExchange(object):
+  """Replica exchange in a single process: one context per thermodynamic state, all of them built from the same
+  System. Configurations are exchanged between neighbour states at fixed intervals.
+  platforms: (platform, properties) of the context of each state"""
+
+  def __init__(self, system, topology, temperatures, restLambdas=None, stepSize=0.002, fricCoef=1.0, platforms=None):
+    self.topology, self.nStates = topology, len(temperatures)
+    self.temperatures, self.restLambdas = np.array(temperatures), restLambdas
+    self.betas = 1 / (MOLAR_GAS_CONSTANT_R.value_in_unit(kilojoules_per_mole / kelvin) * self.temperatures)
+
+    self.contexts = []
+    for k, temp in enumerate(temperatures):
+      integrator = LangevinMiddleIntegrator(temp * kelvin, fricCoef / picoseconds, stepSize * picoseconds)
+      context = Context(system, integrator, *platforms[k]) if platforms else Context(system, integrator)
+      if restLambdas is not None:
+        setRESTState(context, restLambdas[k])
+      self.contexts.append(context)
+
+    # stateReplicas[k]: replica (configuration) currently simulated in state k
+    self.stateReplicas = np.arange(self.nStates)
+    self.nAttempts, self.nAccepted = np.zeros(self.nStates - 1), np.zeros(self.nStates - 1)
+    self.nCycles = 0
+
+  def initialize(self, positions, boxVectors=None, minimize=True, tolerance=10, maxIter=0):
+    for context, temp in zip(self.contexts, self.temperatures):
+      if boxVectors is not None:
+        context.setPeriodicBoxVectors(*boxVectors)
+      context.setPositions(positions)
+    if minimize:
+      LocalEnergyMinimizer.minimize(self.contexts[0], tolerance * kilojoules_per_mole / nanometer, maxIter)
+      minState = self.contexts[0].getState(getPositions=True)
+      for context in self.contexts[1:]:
+        context.setPositions(minState.getPositions())
+
+    for context, temp in zip(self.contexts, self.temperatures):
+      context.setVelocitiesToTemperature(temp * kelvin)
+
+  def propagate(self, nSteps):
+    for context in self.contexts:
+      context.getIntegrator().step(nSteps)
+
+  def getReducedEnergies(self):
+    """Returns the matrix u[i, j]: reduced potential of the configuration in state i evaluated in state j"""
+    energies = np.array([c.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+                         for c in self.contexts])
+    if self.restLambdas is None:
+      return np.outer(energies, self.betas), energies
+
+    uMatrix = np.zeros((self.nStates, self.nStates))
+    for i, context in enumerate(self.contexts):
+      for j in range(self.nStates):
+        if j == i:
+          uMatrix[i, j] = self.betas[j] * energies[i]
+        else:
+          setRESTState(context, self.restLambdas[j])
+          uMatrix[i, j] = self.betas[j] * context.getState(getEnergy=True).getPotentialEnergy().\
+            value_in_unit(kilojoules_per_mole)
+      setRESTState(context, self.restLambdas[i])
+    return uMatrix, energies
+
+  def attemptExchanges(self):
+    """Attempts the exchanges between the neighbour pairs (k, k+1) starting at an even or odd state, alternatively.
+    The acceptance of all the pairs is evaluated at once over the reduced energies matrix"""
+    uMatrix, energies = self.getReducedEnergies()
+    firsts = np.arange(self.nCycles % 2, self.nStates - 1, 2)
+    seconds = firsts + 1
+    logAcc = uMatrix[firsts, firsts] + uMatrix[seconds, seconds] - uMatrix[firsts, seconds] - uMatrix[seconds, firsts]
+    accepted = np.log(np.random.random(len(firsts))) < logAcc
+
+    self.nAttempts[firsts] += 1
+    self.nAccepted[firsts[accepted]] += 1
+    for k in firsts[accepted]:
+      self.swapConfigurations(k, k + 1)
+    self.nCycles += 1
+    return energies
+
+  def swapConfigurations(self, k1, k2):
+    states = [c.getState(getPositions=True, getVelocities=True) for c in [self.contexts[k1], self.contexts[k2]]]
+    for context, state, (tOld, tNew) in zip([self.contexts[k2], self.contexts[k1]], states,
+                                            [(self.temperatures[k1], self.temperatures[k2]),
+                                             (self.temperatures[k2], self.temperatures[k1])]):
+      context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+      context.setPositions(state.getPositions())
+      context.setVelocities(state.getVelocities() * np.sqrt(tNew / tOld))
+    self.stateReplicas[[k1, k2]] = self.stateReplicas[[k2, k1]]
+
+  def getStateSnapshots(self):
+    return [c.getState(getPositions=True, enforcePeriodicBox=True) for c in self.contexts]
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+  sysName = os.path.splitext(os.path.basename(pDic['inputFile']))[0]
+  nReplicas, exInterval, nCycles = int(pDic['nReplicas']), int(pDic['exchangeInterval']), int(pDic['nExchanges'])
+  saveFreq, stepSize = int(pDic['saveFrequency']), float(pDic['stepSize'])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+  system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+
+  temperatures = getTemperatureLadder(float(pDic['minTemp']), float(pDic['maxTemp']), nReplicas)
+  restLambdas = None
+  if pDic['remdType'] == 'REST2':
+    # Every replica runs at the minimum temperature, with the solute scaled to its effective temperature
+    addRESTForces(system, getSelectedAtoms(pdb.topology, pDic['soluteResidues']))
+    restLambdas, temperatures = temperatures[0] / temperatures, np.full(nReplicas, temperatures[0])
+
+  # The contexts of the states are distributed over the leased GPUs, or run on the CPU threads
+  gpus, nThreads = parseDevices(pDic)
+  platforms = [getWorkerPlatform(gpus[k % len(gpus)] if gpus else None, nThreads) for k in range(nReplicas)]
+  remd = ReplicaExchange(system, pdb.topology, temperatures, restLambdas, stepSize, float(pDic['fricCoef']),
+                         platforms)
+  remd.initialize(pdb.positions, pdb.topology.getPeriodicBoxVectors(), eval(pDic['addMinimization']),
+                  float(pDic['minimTol']), int(pDic['maxIter']))
+
+  dcdKwargs = {'dt': stepSize * picoseconds, 'firstStep': exInterval * saveFreq, 'interval': exInterval * saveFreq}
+  stateDcds = [DCDFile(open(f'state_{k}.dcd', 'wb'), pdb.topology, **dcdKwargs) for k in range(nReplicas)]
+  replicaDcds = [DCDFile(open(f'replica_{r}.dcd', 'wb'), pdb.topology, **dcdKwargs) for r in range(nReplicas)]
+  energiesLog = BinaryLogWriter('state_energies.bin', ['step'] + [f'state_{k}' for k in range(nReplicas)])
+  replicasLog = BinaryLogWriter('state_replicas.bin', ['step'] + [f'state_{k}' for k in range(nReplicas)])
+
+  print(f'Running {nCycles} exchange cycles of {exInterval} steps with {nReplicas} replicas')
+  sys.stdout.flush()
+  for cycle in range(1, nCycles + 1):
+    remd.propagate(exInterval)
+    energies = remd.attemptExchanges()
+
+    step = cycle * exInterval
+    energiesLog.append([step] + list(energies))
+    replicasLog.append([step] + list(remd.stateReplicas))
+    if cycle % saveFreq == 0:
+      for k, snapshot in enumerate(remd.getStateSnapshots()):
+        box = snapshot.getPeriodicBoxVectors()
+        stateDcds[k].writeModel(snapshot.getPositions(), periodicBoxVectors=box)
+        replicaDcds[remd.stateReplicas[k]].writeModel(snapshot.getPositions(), periodicBoxVectors=box)
+
+  energiesLog.close()
+  replicasLog.close()
+  groundState = remd.contexts[0].getState(getPositions=True)
+  writeStructure(pdb.topology, groundState.getPositions(), sysName)
+
+  with open('exchange_stats.txt', 'w') as f:
+    for k in range(nReplicas):
+      f.write(f'temperature_{k} :: {temperatures[k]}\n')
+      if restLambdas is not None:
+        f.write(f'effectiveTemperature_{k} :: {temperatures[0] / restLambdas[k]}\n')
+    for k in range(nReplicas - 1):
+      f.write(f'acceptance_{k}_{k + 1} :: {remd.nAccepted[k] / max(remd.nAttempts[k], 1)}\n')
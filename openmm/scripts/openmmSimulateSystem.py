@@ -29,36 +29,53 @@
 import sys, os
 
 # Openmm imports
-from openmm.app import PDBFile, ForceField, Simulation, StateDataReporter,\
-  DCDReporter, NoCutoff, HBonds
+from openmm.app import ForceField, StateDataReporter, DCDReporter, Metadynamics
 from openmm import *
 from openmm.unit import *
 
-def parseParams(paramsFile):
-  paramsDic = {}
-  with open(paramsFile) as f:
-    for line in f:
-      key, value = line.strip().split('::')
-      paramsDic[key.strip()] = value.strip()
-  return paramsDic
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, assignForceGroups, ForceGroupReporter, \
+	BiasReporter, getBiasVariables, getMetadynamicsBias, assignAMDForceGroups, getAMDBoosts, getAMDIntegrator, estimateAMDParameters, \
+	setAMDParameters, flushReporters, writeTrajectoryIndex, loadStateFile, readStructure, writeStructure, fitsInPDB, SimulationMonitor, \
+	SimulationProfiler, StateReporter, AsyncDCDReporter, parseDevices, createSimulation, benchmarkDevices
+
+INDEX_FILE = 'trajectory_index.json'
+REPORT_FILE = 'md_log.bin'
+MONITOR_FILE = 'monitor.json'
+PROFILE_FILE, PROFILE_STATS_FILE = 'profile.json', 'profile.prof'
+BENCHMARK_FILE = 'device_benchmark.json'
 
 
 if __name__ == "__main__":
 	pDic = parseParams(sys.argv[1])
 	sysName = os.path.splitext(os.path.basename(pDic['inputFile']))[0]
 	nTraj = int(pDic['nTraj'])
-
-	pdb = PDBFile(pDic['inputFile'])
+	enhancedSampling = pDic.get('enhancedSampling', 'None')
+	for fileName in [INDEX_FILE, MONITOR_FILE, PROFILE_FILE, BENCHMARK_FILE]:
+		if os.path.exists(fileName):
+			os.remove(fileName)
+	if 'profiler' in pDic:
+		profiler = SimulationProfiler(PROFILE_FILE, PROFILE_STATS_FILE, pDic['profiler'])
+
+	pdb = readStructure(pDic['inputFile'])
 	forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+	registerLigandTemplates(forcefield, pDic)
 
-	sysKwargs = {"nonbondedMethod": eval(pDic['nbMethod'])}
-	sysKwargs.update({"nonbondedCutoff": float(pDic['nbCutoff']) * nanometer})
-	sysKwargs.update({"constraints": eval(pDic['constraints'])})
-	system = forcefield.createSystem(pdb.topology, **sysKwargs)
+	system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+	groupNames = assignForceGroups(system)
 
 	if eval(pDic['addBarostat']):
 		system.addForce(MonteCarloBarostat(float(pDic['pressure']) * bar, float(pDic['temperature']) * kelvin))
 
+	if enhancedSampling == 'Metadynamics':
+		# Bias files already in biasDir (from a previous run) are loaded to continue their bias
+		variables, cvNames = getBiasVariables(pDic, pdb.positions)
+		metaFreq = int(pDic['metaFrequency'])
+		meta = Metadynamics(system, variables, float(pDic['temperature']) * kelvin, float(pDic['metaBiasFactor']),
+												float(pDic['metaHeight']) * kilojoules_per_mole, metaFreq,
+												saveFrequency=metaFreq, biasDir=pDic['biasDir'])
+		# The bias force was just added by Metadynamics, in a force group of its own
+		metaGroup = system.getForce(system.getNumForces() - 1).getForceGroup()
+
 	intArgs = []
 	intClass = eval('{}Integrator'.format(pDic['integrator']))
 	if pDic['integrator'] in ['Langevin', 'LangevinMiddle', 'NoseHoover', 'Brownian', 'VariableLangevin']:
@@ -70,32 +87,134 @@ if __name__ == "__main__":
 	if pDic['integrator'] not in ['VariableVerlet', 'VariableLangevin']:
 		intArgs.append(float(pDic['stepSize']) * picoseconds)
 
-	integrator = intClass(*intArgs)
-
-	properties = {}
-	if 'gpus' in pDic:
-		properties.update({'DeviceIndex': pDic['gpus'].strip()})
-	simulation = Simulation(pdb.topology, system, integrator, platformProperties=properties)
+	if enhancedSampling == 'aMD':
+		groupNames = assignAMDForceGroups(system)
+		amdBoosts = getAMDBoosts(pDic['amdType'])
+		integrator = getAMDIntegrator(amdBoosts, float(pDic['temperature']), float(pDic['fricCoef']),
+																	float(pDic['stepSize']))
+	else:
+		integrator = intClass(*intArgs)
+
+	# The leased GPUs run a single context spread over all of them, or the CPU threads if they cannot be used
+	gpus, nThreads = parseDevices(pDic)
+	simulation = createSimulation(pdb.topology, system, integrator, gpus, nThreads)
 	simulation.context.setPositions(pdb.positions)
+	# Continuing the exact state (positions, velocities and box) of a previous simulation, it is not minimized
+	continueState = 'stateFile' in pDic
+	if continueState:
+		loadStateFile(simulation.context, pDic['stateFile'])
 
-	if eval(pDic['addMinimization']):
+	if eval(pDic['addMinimization']) and not continueState:
 		print('Running {} minimization steps or until <= {} kJ/mol'.format(pDic['maxIter'], pDic['minimTol']))
 		sys.stdout.flush()
-		simulation.reporters.append(StateDataReporter(sys.stdout, nTraj, step=True,
-																									potentialEnergy=True, temperature=True, volume=True))
-		simulation.reporters.append(StateDataReporter("min_log.txt", nTraj, step=True,
-																									potentialEnergy=True, temperature=True, volume=True))
 		simulation.minimizeEnergy(tolerance=float(pDic['minimTol'])*kilojoules_per_mole/nanometer,
 															maxIterations=int(pDic['maxIter']))
+		minEnergy = simulation.context.getState(getEnergy=True).getPotentialEnergy()
+		print('Minimized potential energy: {}'.format(minEnergy.in_units_of(kilojoules_per_mole)))
 
-	# Set up the reporters to report energies every 1000 steps.
-	simulation.reporters.append(DCDReporter(f'{sysName}.dcd', nTraj))
-	simulation.reporters.append(StateDataReporter("md_log.txt", nTraj, step=True,
-																								potentialEnergy=True, temperature=True, volume=True))
-	# run simulation
-	print('Running {} steps simulation'.format(pDic['nSteps']))
-	sys.stdout.flush()
-	simulation.step(int(pDic['nSteps']))
+	if eval(pDic.get('benchmarkDevices', 'False')):
+		# Each GPU alone, all of them together and the CPU are timed from the minimized state, and the fastest is kept
+		simulation = benchmarkDevices(simulation, gpus, nThreads, int(pDic['benchmarkSteps']), BENCHMARK_FILE)
 
+	if enhancedSampling == 'aMD':
+		print('Estimating aMD parameters from a {} steps unboosted simulation'.format(pDic['amdEstimateSteps']))
+		sys.stdout.flush()
+		amdParams = estimateAMDParameters(simulation, amdBoosts, pdb.topology, pDic['amdType'],
+																			int(pDic['amdEstimateSteps']))
+		setAMDParameters(simulation.integrator, amdParams)
+		print('aMD (E, alpha) parameters (kJ/mol): {}'.format(amdParams))
+		simulation.currentStep = 0
+
+	# Set up the reporters to report every nTraj steps. The state log is binary, to keep text formatting out of the loop
+	asyncTrajectory = eval(pDic.get('asyncTrajectory', 'False'))
+	dcdClass = AsyncDCDReporter if asyncTrajectory else DCDReporter
+	dcdReporter = dcdClass(f'{sysName}.dcd', nTraj)
+	simulation.reporters.append(dcdReporter)
+	stateReporter = StateReporter(REPORT_FILE, nTraj)
+	simulation.reporters.append(stateReporter)
+	# Progress in the log, only about 10 lines per run (whole frames)
+	progressInterval = max(nTraj, int(pDic['nSteps']) // 10 // nTraj * nTraj)
+	simulation.reporters.append(StateDataReporter(sys.stdout, progressInterval, step=True, progress=True,
+																								totalSteps=int(pDic['nSteps']), potentialEnergy=True,
+																								temperature=True, speed=True))
+	if eval(pDic.get('energyGroups', 'False')):
+		egReporter = ForceGroupReporter('energy_groups.bin', nTraj, groupNames)
+		simulation.reporters.append(egReporter)
+
+	if enhancedSampling != 'None':
+		biasMetadata = {'temperature': float(pDic['temperature']), 'method': enhancedSampling}
+		if enhancedSampling == 'aMD':
+			biasReporter = BiasReporter('bias.bin', nTraj, ['bias', 'rbias'], metadata=biasMetadata,
+																	biasFunc=lambda sim: 2 * [sim.integrator.getGlobalVariableByName('boost')])
+		else:
+			biasReporter = BiasReporter('bias.bin', nTraj, ['bias', 'rbias'] + cvNames, metadata=biasMetadata,
+																	biasFunc=lambda sim: getMetadynamicsBias(meta, sim, float(pDic['temperature']), metaGroup))
+		simulation.reporters.append(biasReporter)
+	if 'profiler' in pDic:
+		profiler.timeReporters(simulation)
+
+	# run simulation. When streaming, it runs in chunks of streamFrames frames, after which the reporters are flushed
+	# and the frame index updated. The starting structure is written first, as topology of the growing trajectory.
+	# When monitored, it runs in chunks of monitorInterval steps (whole frames), each of them checked and either
+	# checkpointed or rolled back
+	nSteps = int(pDic['nSteps'])
+	streamFrames = int(pDic.get('streamFrames', 0))
+	monitorSteps = int(pDic.get('monitorInterval', 0))
+	if monitorSteps:
+		monitorSteps = max(nTraj, monitorSteps // nTraj * nTraj)
+	chunkSteps = min([nSteps] + [chunk for chunk in [streamFrames * nTraj, monitorSteps] if chunk])
+	stepSize = float(pDic.get('stepSize', 0))
+	if streamFrames:
+		positions = simulation.context.getState(getPositions=True).getPositions()
+		writeStructure(simulation.topology, positions, sysName)
+
+	stepFunc = (lambda steps: meta.step(simulation, steps)) if enhancedSampling == 'Metadynamics' else simulation.step
+	if monitorSteps:
+		# The metadynamics bias cannot be rolled back, those simulations are aborted instead
+		monitor = SimulationMonitor(simulation, MONITOR_FILE, maxTemperature=float(pDic['maxTemperature']),
+																maxRollbacks=int(pDic['maxRollbacks']), rollback=enhancedSampling != 'Metadynamics')
+
+	print('Running {} steps simulation'.format(nSteps))
+	sys.stdout.flush()
+	if 'profiler' in pDic:
+		profiler.startRun(simulation)
+	# Frames and simulated time (ps) of the streamed trajectory index
+	nFrames, simTime = 0, 0.0
+	while simulation.currentStep < nSteps:
+		steps = min(chunkSteps, nSteps - simulation.currentStep)
+		if not monitorSteps:
+			stepFunc(steps)
+		elif not monitor.step(steps, stepFunc):
+			continue
+
+		if streamFrames:
+			flushReporters(simulation)
+			nFrames = simulation.currentStep // nTraj
+			simTime = monitor.time if monitorSteps else nFrames * nTraj * stepSize
+			writeTrajectoryIndex(INDEX_FILE, f'{sysName}.dcd', nFrames, nFrames * nTraj, simTime)
+
+	if 'profiler' in pDic:
+		profiler.stopRun(simulation)
+		profiler.timeSimulation(simulation, groupNames, int(pDic['profileSamples']))
+
+	if asyncTrajectory:
+		dcdReporter.close()
+	stateReporter.close()
+	if eval(pDic.get('energyGroups', 'False')):
+		egReporter.close()
+	if enhancedSampling != 'None':
+		biasReporter.close()
+
+	# Final state: structure (PDB if it fits), full precision structure (PDBx) and serialized State with velocities
+	# and box to continue it
 	positions = simulation.context.getState(getPositions=True).getPositions()
-	PDBFile.writeFile(simulation.topology, positions, open(f'{sysName}.pdb', 'w'))
+	if fitsInPDB(simulation.topology):
+		writeStructure(simulation.topology, positions, sysName)
+	writeStructure(simulation.topology, positions, sysName, keepIds=True, pdbx=True)
+	simulation.saveState(f'{sysName}_state.xml')
+	if monitorSteps:
+		monitor.close()
+	if streamFrames:
+		writeTrajectoryIndex(INDEX_FILE, f'{sysName}.dcd', nFrames, nFrames * nTraj, simTime, finished=True)
+	if 'profiler' in pDic:
+		profiler.close()
@@ -0,0 +1,175 @@
+#Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# # -*- coding: utf-8 -*-
+# # # **************************************************************************
+# # # *
+# # # * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# # # *
+# # # *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+# General imports
+import sys, multiprocessing
+import numpy as np
+
+# Openmm imports
+from openmm.app import ForceField, DCDFile
+from openmm import Context, LangevinMiddleIntegrator, CustomCVForce, CustomCentroidBondForce, LocalEnergyMinimizer, \
+  XmlSerializer
+from openmm.unit import kelvin, picoseconds, kilojoules_per_mole, nanometer
+
+from openmmUtils import parseParams, getSystemKwargs, registerLigandTemplates, BinaryLogWriter, getLigandAtoms, \
+  getSelectedAtoms, getWorkerPlatform, readDCD, setFramePositions, ContextCache, systemHash, readStructure
+
+CENTER, FORCE_K = 'umbrellaCenter', 'umbrellaK'
+
+
+def addUmbrellaForce(system, atoms1, atoms2):
+  """Adds a harmonic bias on the distance between the centroids of two groups of atoms, whose center and force
+  constant are the global parameters umbrellaCenter and umbrellaK. Returns the force, which also gives the value of
+  the distance (collective variable)"""
+  distance = CustomCentroidBondForce(2, 'distance(g1, g2)')
+  distance.addBond([distance.addGroup(atoms1), distance.addGroup(atoms2)])
+  distance.setUsesPeriodicBoundaryConditions(system.usesPeriodicBoundaryConditions())
+
+  umbrella = CustomCVForce(f'0.5*{FORCE_K}*(d-{CENTER})^2')
+  umbrella.addCollectiveVariable('d', distance)
+  umbrella.addGlobalParameter(CENTER, 0.0)
+  umbrella.addGlobalParameter(FORCE_K, 0.0)
+  system.addForce(umbrella)
+  return umbrella
+
+def getCV(umbrella, context):
+  return umbrella.getCollectiveVariableValues(context)[0]
+
+def createIntegrator(pDic):
+  return LangevinMiddleIntegrator(float(pDic['temperature']) * kelvin, float(pDic['fricCoef']) / picoseconds,
+                                  float(pDic['stepSize']) * picoseconds)
+
+
+def runSteeredMD(system, umbrella, positions, topology, pDic, platform):
+  """Pulls the centroids distance at constant velocity from its initial value to the final distance, moving the
+  center of the harmonic bias. Stores the trajectory and the distance of each saved frame"""
+  context = Context(system, createIntegrator(pDic), *platform)
+  context.setPositions(positions)
+  LocalEnergyMinimizer.minimize(context, float(pDic['minimTol']) * kilojoules_per_mole / nanometer,
+                                int(pDic['maxIter']))
+  context.setVelocitiesToTemperature(float(pDic['temperature']) * kelvin)
+
+  startDistance, finalDistance = getCV(umbrella, context), float(pDic['finalDistance'])
+  nSteps, interval = int(pDic['smdSteps']), int(pDic['cvInterval'])
+  context.setParameter(FORCE_K, float(pDic['pullK']))
+  print(f'Pulling from {startDistance:.3f} nm to {finalDistance:.3f} nm in {nSteps} steps')
+  sys.stdout.flush()
+
+  cvLog = BinaryLogWriter('smd_cv.bin', ['step', 'center', 'distance'])
+  with open('smd.dcd', 'wb') as f:
+    dcd = DCDFile(f, topology, float(pDic['stepSize']) * picoseconds, interval=interval)
+    for step in range(0, nSteps, interval):
+      center = startDistance + (finalDistance - startDistance) * (step + interval) / nSteps
+      context.setParameter(CENTER, center)
+      context.getIntegrator().step(interval)
+
+      state = context.getState(getPositions=True)
+      dcd.writeModel(state.getPositions(), periodicBoxVectors=state.getPeriodicBoxVectors())
+      cvLog.append([step + interval, center, getCV(umbrella, context)])
+  cvLog.close()
+  return startDistance, finalDistance
+
+def harvestWindows(startDistance, finalDistance, nWindows):
+  """Returns the centers of the umbrella windows and the steered MD frames to start them from: the frames whose
+  distance is closest to each center"""
+  centers = np.linspace(startDistance, finalDistance, nWindows)
+  cvData = np.fromfile('smd_cv.bin', dtype='<f8').reshape(-1, 3)
+  frames = [int(np.argmin(np.abs(cvData[:, 2] - center))) for center in centers]
+  return centers, frames
+
+
+################# Parallel windows #################
+# The System is built and serialized once in the main process, each worker deserializes it and runs its windows,
+# reusing the same Context
+WORKER = {}
+
+def initWorker(systemXml, deviceQueue, nThreads):
+  WORKER['system'] = XmlSerializer.deserialize(systemXml)
+  WORKER['systemKey'] = systemHash(WORKER['system'])
+  WORKER['umbrella'] = WORKER['system'].getForce(WORKER['system'].getNumForces() - 1)
+  WORKER['contexts'] = ContextCache(*getWorkerPlatform(deviceQueue.get(), nThreads))
+
+def runWindow(args):
+  w, center, frame, pDic = args
+  steps, coords, boxes = readDCD('smd.dcd')
+  context = WORKER['contexts'].getContext(WORKER['systemKey'], lambda: WORKER['system'],
+                                          lambda: createIntegrator(pDic))
+  setFramePositions(context, np.array(coords[frame]), boxes[frame] if boxes else None)
+  context.setParameter(CENTER, center)
+  context.setParameter(FORCE_K, float(pDic['umbrellaK']))
+  context.setVelocitiesToTemperature(float(pDic['temperature']) * kelvin)
+
+  integrator, interval = context.getIntegrator(), int(pDic['cvInterval'])
+  integrator.step(int(pDic['windowEquilSteps']))
+
+  cvLog = BinaryLogWriter(f'umbrella_{w}.bin', ['step', 'distance'],
+                          metadata={'center': center, 'k': float(pDic['umbrellaK']),
+                                    'temperature': float(pDic['temperature'])})
+  for step in range(0, int(pDic['windowSteps']), interval):
+    integrator.step(interval)
+    cvLog.append([step + interval, getCV(WORKER['umbrella'], context)])
+  cvLog.close()
+  print(f'Window {w} (center {center:.3f} nm) finished')
+  sys.stdout.flush()
+  return w
+
+
+if __name__ == "__main__":
+  pDic = parseParams(sys.argv[1])
+
+  pdb = readStructure(pDic['inputFile'])
+  forcefield = ForceField(pDic['mFF'], pDic['wFF'])
+  registerLigandTemplates(forcefield, pDic)
+  system = forcefield.createSystem(pdb.topology, **getSystemKwargs(pDic))
+
+  pullAtoms = getLigandAtoms(pdb.topology, pDic.get('pullResidues', ''))
+  refAtoms = getSelectedAtoms(pdb.topology, pDic['refResidues'])
+  umbrella = addUmbrellaForce(system, pullAtoms, refAtoms)
+
+  gpus = [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()]
+  nThreads = int(pDic.get('nThreads', 1))
+  smdPlatform = getWorkerPlatform(gpus[0] if gpus else None, nThreads)
+  startDistance, finalDistance = runSteeredMD(system, umbrella, pdb.positions, pdb.topology, pDic, smdPlatform)
+  centers, frames = harvestWindows(startDistance, finalDistance, int(pDic['nWindows']))
+
+  # Windows run in parallel in one worker per GPU, or in CPU workers sharing the available threads
+  nWorkers = min(len(gpus) if gpus else nThreads, len(centers))
+
+  mpContext = multiprocessing.get_context('spawn')
+  deviceQueue = mpContext.Manager().Queue()
+  for i in range(nWorkers):
+    deviceQueue.put(gpus[i] if gpus else None)
+
+  with mpContext.Pool(nWorkers, initializer=initWorker,
+                      initargs=(XmlSerializer.serialize(system), deviceQueue, max(1, nThreads // nWorkers))) as pool:
+    for _ in pool.imap_unordered(runWindow, [(w, centers[w], frames[w], pDic) for w in range(len(centers))]):
+      pass
+
+  with open('umbrella_windows.txt', 'w') as f:
+    f.write(f'nWindows :: {len(centers)}\n')
+    for w, (center, frame) in enumerate(zip(centers, frames)):
+      f.write(f'center_{w} :: {center}\nstartFrame_{w} :: {frame}\n')
@@ -0,0 +1,1392 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo Gómez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Helpers shared by the scripts executed inside the OpenMM environment.
+This module must only depend on the packages installed in that environment (OpenMM, numpy, openmmforcefields).
+"""
+
+# General imports
+import sys, os, copy, json, fcntl, tempfile, contextlib, struct, hashlib, time, shutil, subprocess, signal, cProfile, pstats, threading, queue, atexit
+from collections import OrderedDict
+import numpy as np
+
+# Openmm imports
+from openmm import app, Vec3, Platform, Context, XmlSerializer, CustomIntegrator, CustomCentroidBondForce, \
+  CustomTorsionForce, RMSDForce, NonbondedForce, CMMotionRemover, OpenMMException
+from openmm.unit import kilojoules_per_mole, nanometers, picoseconds, kelvin, dalton, elementary_charge, \
+  MOLAR_GAS_CONSTANT_R
+from openmm.app.internal.unitcell import computePeriodicBoxVectors, computeLengthsAndAngles
+
+DCD_HEADER_SIZE = 276
+MAX_FORCE_GROUPS = 32
+
+
+def parseParams(paramsFile):
+  paramsDic = {}
+  with open(paramsFile) as f:
+    for line in f:
+      key, value = line.strip().split('::')
+      paramsDic[key.strip()] = value.strip()
+  return paramsDic
+
+
+def isImplicit(pDic):
+  return pDic.get('solventType') == 'Implicit'
+
+def getSystemKwargs(pDic):
+  """Returns the arguments for ForceField.createSystem specified in the params file.
+  Implicit solvent systems are not periodic, so periodic nonbonded methods are replaced by CutoffNonPeriodic"""
+  nbMethod = getattr(app, pDic['nbMethod'])
+  if isImplicit(pDic) and nbMethod not in [app.NoCutoff, app.CutoffNonPeriodic]:
+    nbMethod = app.CutoffNonPeriodic
+
+  constraints = pDic.get('constraints', 'None')
+  sysKwargs = {"nonbondedMethod": nbMethod, "nonbondedCutoff": float(pDic['nbCutoff']) * nanometers,
+               "constraints": None if constraints == 'None' else getattr(app, constraints)}
+  if isImplicit(pDic):
+    sysKwargs["implicitSolventKappa"] = getImplicitSolventKappa(float(pDic['implicitSalt']),
+                                                                float(pDic.get('temperature', 300)))
+  return sysKwargs
+
+def getImplicitSolventKappa(saltConc, temperature, solventDielectric=78.5):
+  """Debye screening parameter (1/nm) of the implicit solvent for a salt concentration (M), as computed by OpenMM
+  for Amber files: includes the 0.73 ion exclusion factor"""
+  return 7.3 * 50.33355 * np.sqrt(saltConc / solventDielectric / temperature) / nanometers
+
+
+def orientAlongZ(modeller):
+  """Centers the modeller positions in the origin and rotates them to align their longest principal axis with Z"""
+  positions = np.array(modeller.positions.value_in_unit(nanometers))
+  positions -= positions.mean(axis=0)
+  axis = np.linalg.eigh(np.cov(positions.T))[1][:, -1]
+
+  # Rodrigues rotation taking the principal axis to Z
+  z = np.array([0.0, 0.0, 1.0])
+  v, c = np.cross(axis, z), np.dot(axis, z)
+  if np.linalg.norm(v) > 1e-8:
+    vx = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
+    positions = positions @ (np.identity(3) + vx + vx @ vx / (1 + c)).T
+  elif c < 0:
+    positions[:, 1:] *= -1
+  modeller.positions = [Vec3(*pos) for pos in positions] * nanometers
+
+
+SOLVENT_RESIDUES = ['HOH', 'WAT', 'NA', 'CL', 'K', 'LI', 'CS', 'RB', 'BR', 'F', 'I']
+
+def parseResidueIds(selection):
+  """Parses a residue selection as "1-20, 35, B:40-42" into a set of (chain id, residue id). The chain is None for
+  the items without chain prefix"""
+  resIds = set()
+  for item in selection.split(','):
+    chain, item = item.strip().split(':', 1) if ':' in item else (None, item.strip())
+    if '-' in item[1:]:
+      start, end = item.split('-', 1)
+      resIds.update((chain, str(i)) for i in range(int(start), int(end) + 1))
+    elif item:
+      resIds.add((chain, item))
+  return resIds
+
+def getSelectedAtoms(topology, selection=''):
+  """Returns the indexes of the atoms of the selected residues (residue ids as "1-20, 35, B:40"), skipping water and
+  ions, whose ids are usually repeated. If no selection is given, the atoms of all the residues but water and ions
+  are returned"""
+  resIds = parseResidueIds(selection)
+  isSelected = lambda res: not resIds or (None, res.id) in resIds or (res.chain.id, res.id) in resIds
+  return [atom.index for atom in topology.atoms()
+          if atom.residue.name not in SOLVENT_RESIDUES and isSelected(atom.residue)]
+
+
+STANDARD_RESIDUES = SOLVENT_RESIDUES + \
+  ['ALA', 'ARG', 'ASN', 'ASP', 'ASH', 'CYS', 'CYX', 'GLN', 'GLU', 'GLH', 'GLY', 'HIS', 'HID', 'HIE', 'HIP', 'ILE', 'LEU',
+   'LYS', 'LYN', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'ACE', 'NME', 'NH2',
+   'A', 'C', 'G', 'U', 'DA', 'DC', 'DG', 'DT']
+
+def getLigandAtoms(topology, selection=''):
+  """Returns the indexes of the atoms of the selected residues (residue ids as "1-20, 35, B:40").
+  If no selection is given, the atoms of the non standard residues (ligands) are returned"""
+  if parseResidueIds(selection):
+    return getSelectedAtoms(topology, selection)
+  return [atom.index for atom in topology.atoms() if atom.residue.name not in STANDARD_RESIDUES]
+
+
+################# Platforms #################
+# A list of GPU devices means a single context spread over all of them (DeviceIndex "0,1"). The scripts running
+# several independent contexts (workers, replicas) place each of them on one device instead. Without GPU platform, or
+# if the devices cannot be used, the context runs on the CPU platform with the leased threads
+GPU_PLATFORMS = ['CUDA', 'HIP', 'OpenCL']
+
+def getPlatformNames():
+  return [Platform.getPlatform(i).getName() for i in range(Platform.getNumPlatforms())]
+
+def parseDevices(pDic):
+  """GPU devices (indexes) and CPU threads leased to a script"""
+  return [gpu.strip() for gpu in pDic.get('gpus', '').split(',') if gpu.strip()], int(pDic.get('nThreads', 1))
+
+def getPlatformCandidates(devices=(), nThreads=1):
+  """Platforms (names) and properties to run a context on some GPU devices, spread over all of them, in order of
+  preference. The last one is the CPU (or Reference) fallback on nThreads threads"""
+  names, candidates = getPlatformNames(), []
+  if devices:
+    candidates += [(name, {'DeviceIndex': ','.join(map(str, devices))}) for name in GPU_PLATFORMS if name in names]
+  candidates.append(('CPU', {'Threads': str(nThreads)}) if 'CPU' in names else ('Reference', {}))
+  return candidates
+
+def getWorkerPlatform(device=None, nThreads=1):
+  """Returns the platform and its properties for a worker running on a GPU device (index) or, if None, on nThreads
+  CPU threads"""
+  name, properties = getPlatformCandidates([] if device is None else [device], nThreads)[0]
+  return Platform.getPlatformByName(name), properties
+
+def setDefaultPlatform(devices=(), nThreads=1):
+  """Makes the contexts created without an explicit platform (e.g. by Modeller.addMembrane) run on the leased
+  resources: the GPU devices or, if none, nThreads CPU threads"""
+  name, properties = getPlatformCandidates(devices, nThreads)[0]
+  os.environ['OPENMM_DEFAULT_PLATFORM'] = name
+  platform = Platform.getPlatformByName(name)
+  for key, value in properties.items():
+    platform.setPropertyDefaultValue(key, value)
+
+def createSimulation(topology, system, integrator, devices=(), nThreads=1):
+  """Creates a Simulation on the first platform of getPlatformCandidates where its context can be created. The
+  platforms failing (e.g. a device that does not exist) are reported and the next one is tried. The simulation
+  gets a copy of the integrator"""
+  candidates = getPlatformCandidates(devices, nThreads)
+  if devices and len(candidates) == 1:
+    print('No GPU platform available for the devices {}'.format(', '.join(map(str, devices))))
+  for name, properties in candidates:
+    try:
+      simulation = app.Simulation(topology, system, copy.deepcopy(integrator), Platform.getPlatformByName(name),
+                                  properties)
+    except OpenMMException as e:
+      print('Cannot run on {} {}: {}'.format(name, properties, e))
+      continue
+    print('Running on {} {}'.format(name, properties))
+    sys.stdout.flush()
+    return simulation
+  raise SimulationError('No platform available to run the simulation')
+
+def moveSimulation(simulation, name, properties):
+  """New Simulation with the system, integrator (copy), state and reporters of another one, on another platform"""
+  state = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True,
+                                      getIntegratorParameters=True)
+  newSimulation = app.Simulation(simulation.topology, simulation.system, copy.deepcopy(simulation.integrator),
+                                 Platform.getPlatformByName(name), properties)
+  newSimulation.context.setState(state)
+  newSimulation.currentStep, newSimulation.reporters = simulation.currentStep, simulation.reporters
+  return newSimulation
+
+def benchmarkDevices(simulation, devices, nThreads, nSteps, reportFile):
+  """Times nSteps steps of the simulation, from its current state, on each device alone, on all of them in a single
+  context and on the CPU threads. Returns the simulation moved to the fastest configuration (ns/day), and stores the
+  results in the JSON reportFile"""
+  configurations = [[device] for device in devices] + ([list(devices)] if len(devices) > 1 else []) + [[]]
+  state = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True,
+                                      getIntegratorParameters=True)
+  stepSize = simulation.integrator.getStepSize().value_in_unit(picoseconds)
+  results = []
+  for configDevices in configurations:
+    # The first candidate of a GPU configuration is its GPU platform, if any
+    name, properties = getPlatformCandidates(configDevices, nThreads)[0]
+    result = {'devices': configDevices, 'platform': name, 'properties': properties}
+    if configDevices and name not in GPU_PLATFORMS:
+      results.append({**result, 'platform': None, 'error': 'No GPU platform available'})
+      continue
+    try:
+      integrator = copy.deepcopy(simulation.integrator)
+      context = Context(simulation.system, integrator, Platform.getPlatformByName(name), properties)
+      context.setState(state)
+      # Kernels compilation and neighbor lists are not timed
+      timeSteps(context, integrator, 10)
+      result['nsPerDay'] = stepSize / 1000 * 86400 / timeSteps(context, integrator, nSteps)
+      del context, integrator
+    except (OpenMMException, ValueError) as e:
+      result['error'] = str(e)
+    print('Benchmark {} {}: {}'.format(name, properties, result.get('nsPerDay', result.get('error'))))
+    results.append(result)
+
+  timed = [result for result in results if 'nsPerDay' in result]
+  if not timed:
+    raise SimulationError('The simulation could not run on any of the devices: {}'.format(
+      '; '.join(result['error'] for result in results)))
+  best = max(timed, key=lambda result: result['nsPerDay'])
+  writeJSON(reportFile, {'steps': nSteps, 'atoms': simulation.system.getNumParticles(), 'results': results,
+                         'best': best})
+  print('Running on the fastest configuration: {} {}'.format(best['platform'], best['properties']))
+  sys.stdout.flush()
+  return moveSimulation(simulation, best['platform'], best['properties'])
+
+
+################# Structure files #################
+# The fixed width fields of the PDB format hold up to 99999 atoms and 9999 residues. Larger systems are written as
+# PDBx/mmCIF, which has no such limits
+PDB_MAX_ATOMS, PDB_MAX_RESIDUES = 99999, 9999
+PDBX_EXTENSIONS = ['.cif', '.mmcif', '.pdbx']
+
+def isPDBxFile(fileName):
+  return os.path.splitext(fileName)[1].lower() in PDBX_EXTENSIONS
+
+def fitsInPDB(topology):
+  return topology.getNumAtoms() <= PDB_MAX_ATOMS and topology.getNumResidues() <= PDB_MAX_RESIDUES
+
+def readStructure(fileName):
+  """Reads a PDB or PDBx/mmCIF structure file, depending on its extension"""
+  return app.PDBxFile(fileName) if isPDBxFile(fileName) else app.PDBFile(fileName)
+
+def writeStructure(topology, positions, baseName, keepIds=False, pdbx=None):
+  """Writes the structure to <baseName>.pdb or, if it does not fit in the PDB format (or pdbx is True),
+  to <baseName>.cif. Returns the written file"""
+  if pdbx is None:
+    pdbx = not fitsInPDB(topology)
+  fileName = baseName + ('.cif' if pdbx else '.pdb')
+  writer = app.PDBxFile if pdbx else app.PDBFile
+  with open(fileName, 'w') as f:
+    writer.writeFile(topology, positions, f, keepIds=keepIds)
+  return fileName
+
+
+################# Fast solvation #################
+# Vectorized version of Modeller.addSolvent for very large boxes. The box is filled tiling the same pre-equilibrated
+# water box, and the waters clashing with the solute or with the periodic images of other waters are found with a
+# cell list over arrays, instead of molecule by molecule. The ions replace random waters in batches
+VDW_RADIUS_PER_SIGMA = 0.5612310241546864907
+WATER_SIGMAS = {'tip3p': 0.31507524065751241, 'spce': 0.31657195050398818, 'tip4pew': 0.315365, 'tip5p': 0.312,
+                'swm4ndp': 0.318395}
+POSITIVE_IONS = {'Cs+': 'Cs', 'K+': 'K', 'Li+': 'Li', 'Na+': 'Na', 'Rb+': 'Rb'}
+NEGATIVE_IONS = {'Cl-': 'Cl', 'Br-': 'Br', 'F-': 'F', 'I-': 'I'}
+WATER_MOLARITY = 55.4
+
+def getSolventBoxVectors(positions, boxSize=None, padding=None, boxShape='cube'):
+  """Periodic box vectors (nm) of a box of fixed size or with some padding around the solute, as Modeller does"""
+  if boxSize is not None:
+    return np.diag(boxSize).astype(float)
+
+  radius = 0
+  if len(positions):
+    center = 0.5 * (positions.min(axis=0) + positions.max(axis=0))
+    radius = np.linalg.norm(positions - center, axis=1).max()
+  width = max(2 * radius + padding, 2 * padding)
+  if boxShape == 'cube':
+    return np.eye(3) * width
+  elif boxShape == 'dodecahedron':
+    return np.array([[1, 0, 0], [0, 1, 0], [0.5, 0.5, 0.5 * np.sqrt(2)]]) * width
+  elif boxShape == 'octahedron':
+    return np.array([[1, 0, 0], [1 / 3, 2 * np.sqrt(2) / 3, 0], [-1 / 3, np.sqrt(2) / 3, np.sqrt(6) / 3]]) * width
+  raise ValueError('Illegal box shape: {}'.format(boxShape))
+
+def wrapPositions(positions, vectors, lower):
+  """Wraps the positions into the rectangular box starting at lower with the diagonal of the (reduced) box vectors,
+  which is a unit cell of the same lattice"""
+  rel = positions - lower
+  for i in [2, 1, 0]:
+    rel -= np.outer(np.floor(rel[:, i] / vectors[i][i]), vectors[i])
+  return rel + lower
+
+def getPeriodicImages(positions, vectors, lower, upper, margin):
+  """Returns the periodic images (but the identity) of the positions that fall within margin of the box
+  [lower, upper], and the indexes of the positions they come from"""
+  images, indexes = [np.zeros((0, 3))], [np.zeros(0, dtype=int)]
+  for shift in np.ndindex(3, 3, 3):
+    if shift == (1, 1, 1):
+      continue
+    shifted = positions + np.dot(np.array(shift) - 1, vectors)
+    inside = np.all((shifted > lower - margin) & (shifted < upper + margin), axis=1)
+    images.append(shifted[inside])
+    indexes.append(np.nonzero(inside)[0])
+  return np.concatenate(images), np.concatenate(indexes)
+
+def findClosePairs(points, queries, cutoff):
+  """Returns the pairs (query index, point index) closer than the cutoff (a value or one per query), found with a
+  cell list of the points"""
+  cutoffs = np.broadcast_to(cutoff, (len(queries),))
+  if not len(points) or not len(queries):
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+  # Cells indexes, with an empty layer around so that the neighbour cells of every query exist
+  cellSize = cutoffs.max()
+  origin = np.minimum(points.min(axis=0), queries.min(axis=0))
+  pCells = np.floor((points - origin) / cellSize).astype(np.int64) + 1
+  qCells = np.floor((queries - origin) / cellSize).astype(np.int64) + 1
+  dims = np.maximum(pCells.max(axis=0), qCells.max(axis=0)) + 2
+  cellKey = lambda cells: (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+  order = np.argsort(cellKey(pCells), kind='stable')
+  sortedKeys = cellKey(pCells)[order]
+  qIdxs, pIdxs = [], []
+  for offset in np.ndindex(3, 3, 3):
+    keys = cellKey(qCells + np.array(offset) - 1)
+    starts, ends = np.searchsorted(sortedKeys, keys, 'left'), np.searchsorted(sortedKeys, keys, 'right')
+    counts = ends - starts
+    qIdx = np.repeat(np.arange(len(queries)), counts)
+    pIdx = order[np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    close = np.sum((queries[qIdx] - points[pIdx]) ** 2, axis=1) < cutoffs[qIdx] ** 2
+    qIdxs.append(qIdx[close])
+    pIdxs.append(pIdx[close])
+  return np.concatenate(qIdxs), np.concatenate(pIdxs)
+
+def pickSeparatedPositions(positions, n, minDistance, rng=None):
+  """Returns the indexes of n random positions, at least minDistance from each other"""
+  rng = rng or np.random.default_rng()
+  order, picked, start = rng.permutation(len(positions)), np.zeros(0, dtype=int), 0
+  while len(picked) < n:
+    if start >= len(order):
+      raise ValueError('Could not add more than {} ions to the system'.format(len(picked)))
+    candidates = order[start:start + 2 * (n - len(picked)) + 16]
+    start += len(candidates)
+    clashing = findClosePairs(positions[picked], positions[candidates], minDistance)[0]
+    candidates = np.delete(candidates, clashing)
+
+    # Candidates of the batch are accepted in order, unless they are close to an accepted one
+    qIdx, pIdx = findClosePairs(positions[candidates], positions[candidates], minDistance)
+    sortIdx = np.argsort(qIdx, kind='stable')
+    neighbours = np.split(pIdx[sortIdx], np.searchsorted(qIdx[sortIdx], np.arange(1, len(candidates))))
+    blocked = np.zeros(len(candidates), dtype=bool)
+    accepted = []
+    for i in range(len(candidates)):
+      if not blocked[i] and len(picked) + len(accepted) < n:
+        accepted.append(candidates[i])
+        blocked[neighbours[i]] = True
+    picked = np.concatenate([picked, np.array(accepted, dtype=int)])
+  return picked
+
+def addSolventFast(modeller, forcefield, model='tip3p', boxSize=None, padding=None, boxShape='cube',
+                   positiveIon='Na+', negativeIon='Cl-', ionicStrength=0, neutralize=True, ionCutoff=0.5):
+  """Solvates the modeller with the same residues, chains and box as Modeller.addSolvent, placing the waters and the
+  ions with array operations. Distances in nm, ionic strength in molar"""
+  if model not in WATER_SIGMAS:
+    raise ValueError('Unknown water model: {}'.format(model))
+  if positiveIon not in POSITIVE_IONS or negativeIon not in NEGATIVE_IONS:
+    raise ValueError('Illegal ions: {}, {}'.format(positiveIon, negativeIon))
+  waterRadius = WATER_SIGMAS[model] * VDW_RADIUS_PER_SIGMA
+  waterBox = app.PDBFile(os.path.join(os.path.dirname(app.__file__), 'data', '{}.pdb'.format(model)))
+  waterResidues = list(waterBox.topology.residues())
+  waterAtoms = np.array([[atom.index for atom in res.atoms()] for res in waterResidues])
+  waterBoxPositions = np.array(waterBox.positions.value_in_unit(nanometers))
+  waterBoxSize = np.array(waterBox.topology.getUnitCellDimensions().value_in_unit(nanometers))
+  # Atom positions of each water molecule relative to its oxygen (first atom)
+  waterOffsets = waterBoxPositions[waterAtoms] - waterBoxPositions[waterAtoms[:, :1]]
+
+  solute = np.array(modeller.positions.value_in_unit(nanometers)).reshape(-1, 3)
+  vectors = getSolventBoxVectors(solute, boxSize, padding, boxShape)
+  box = np.diag(vectors)
+  center = 0.5 * (solute.min(axis=0) + solute.max(axis=0)) if len(solute) else np.zeros(3)
+  lower = center - box / 2
+
+  # Exclusion radius of the solute atoms from their Lennard-Jones sigma, and total charge
+  system = forcefield.createSystem(modeller.topology)
+  nonbonded = [force for force in system.getForces() if isinstance(force, NonbondedForce)]
+  if not nonbonded:
+    raise ValueError('The ForceField does not specify a NonbondedForce')
+  nbParams = np.array([[charge.value_in_unit(elementary_charge), sigma.value_in_unit(nanometers),
+                        epsilon.value_in_unit(kilojoules_per_mole)]
+                       for charge, sigma, epsilon in map(nonbonded[0].getParticleParameters,
+                                                         range(nonbonded[0].getNumParticles()))]).reshape(-1, 3)
+  cutoffs = waterRadius + np.where(nbParams[:, 2] != 0, nbParams[:, 1] * VDW_RADIUS_PER_SIGMA, 0)
+
+  # Oxygen positions of the tiled water boxes within the box
+  nBoxes = np.ceil(box / waterBoxSize).astype(int)
+  shifts = np.array(list(np.ndindex(*nBoxes))) * waterBoxSize
+  oxygens = (waterBoxPositions[waterAtoms[:, 0]][np.newaxis] + shifts[:, np.newaxis]).reshape(-1, 3)
+  resIdxs = np.tile(np.arange(len(waterResidues)), len(shifts))
+  inside = np.all(oxygens <= box, axis=1)
+  oxygens, resIdxs = oxygens[inside] + lower, resIdxs[inside]
+
+  # Waters clashing with the solute or its periodic images
+  keep = np.ones(len(oxygens), dtype=bool)
+  if len(solute):
+    wrapped = wrapPositions(solute, vectors, lower)
+    images, imageIdxs = getPeriodicImages(wrapped, vectors, lower, lower + box, cutoffs.max())
+    soluteIdxs = np.concatenate([np.arange(len(solute)), imageIdxs])
+    keep[findClosePairs(oxygens, np.concatenate([wrapped, images]), cutoffs[soluteIdxs])[1]] = False
+
+  # Waters at the upper edges clashing with the periodic images of those at the lower edges
+  upperSkin = keep & np.any(oxygens > lower + box - waterRadius, axis=1)
+  lowerSkin = np.nonzero(keep & np.any(oxygens < lower + waterRadius, axis=1))[0]
+  images, _ = getPeriodicImages(oxygens[lowerSkin], vectors, lower, lower + box, waterRadius)
+  clashing = findClosePairs(oxygens, images, waterRadius)[1]
+  keep[clashing[upperSkin[clashing]]] = False
+  oxygens, resIdxs = oxygens[keep], resIdxs[keep]
+
+  # Number of ions, as Modeller: neutralizing ones plus the pairs for the ionic strength
+  totalCharge = int(np.floor(0.5 + nbParams[:, 0].sum()))
+  nPositive, nNegative = (max(0, -totalCharge), max(0, totalCharge)) if neutralize else (0, 0)
+  if nPositive + nNegative > len(oxygens):
+    raise ValueError('Cannot neutralize the system because the charge is greater than the number of available '
+                     'positions for ions')
+  nPairs = int(np.floor((len(oxygens) - nPositive - nNegative) * ionicStrength / WATER_MOLARITY + 0.5))
+  nPositive, nNegative = nPositive + nPairs, nNegative + nPairs
+  ionIdxs = pickSeparatedPositions(oxygens, nPositive + nNegative, ionCutoff)
+  isWater = np.ones(len(oxygens), dtype=bool)
+  isWater[ionIdxs] = False
+
+  # New topology with a copy of the solute, the waters chain and the ions chain
+  solvated = app.Modeller(app.Topology(), [])
+  solvated.add(modeller.topology, modeller.positions)
+  topology = solvated.topology
+  topology.setPeriodicBoxVectors([Vec3(*vector) for vector in vectors] * nanometers)
+  waterChain = topology.addChain()
+  for resIdx in resIdxs[isWater]:
+    residue = waterResidues[resIdx]
+    newResidue = topology.addResidue(residue.name, waterChain)
+    newAtoms = [topology.addAtom(atom.name, atom.element, newResidue) for atom in residue.atoms()]
+    for atom in newAtoms[1:]:
+      if atom.element == app.element.hydrogen:
+        topology.addBond(newAtoms[0], atom)
+  waterPositions = oxygens[isWater][:, np.newaxis] + waterOffsets[resIdxs[isWater]]
+
+  ionChain = topology.addChain()
+  for i in range(len(ionIdxs)):
+    symbol = POSITIVE_IONS[positiveIon] if i < nPositive else NEGATIVE_IONS[negativeIon]
+    ionResidue = topology.addResidue(symbol.upper(), ionChain)
+    topology.addAtom(symbol, app.element.get_by_symbol(symbol), ionResidue)
+
+  positions = np.concatenate([solute, waterPositions.reshape(-1, 3), oxygens[ionIdxs]])
+  modeller.topology = topology
+  modeller.positions = [Vec3(*pos) for pos in positions] * nanometers
+
+
+################# Context reuse #################
+
+def topologyHash(topology):
+  """Hash of the atoms (residue and atom names, by chain) and bonds of a topology"""
+  sha = hashlib.sha1()
+  for chain in topology.chains():
+    sha.update(b'|')
+    for res in chain.residues():
+      sha.update(res.name.encode() + b':' + ','.join(atom.name for atom in res.atoms()).encode() + b';')
+  for a1, a2 in topology.bonds():
+    sha.update(f'{a1.index}-{a2.index};'.encode())
+  return sha.hexdigest()
+
+def systemHash(system):
+  """Hash of the serialized System (particles, forces and their parameters)"""
+  return hashlib.sha1(XmlSerializer.serialize(system).encode()).hexdigest()
+
+class ContextCache(object):
+  """LRU cache of Contexts keyed by a hash of the topology or System they simulate. Short jobs on inputs with an
+  identical topology reuse a Context, only setting its positions, box vectors and velocities, instead of creating
+  the System and Context again (which on GPU platforms includes compiling the kernels).
+  A maxSize of 0 disables the reuse"""
+
+  def __init__(self, platform, properties=None, maxSize=4):
+    self.platform, self.properties = platform, properties or {}
+    self.maxSize = maxSize
+    self.contexts = OrderedDict()
+    self.hits, self.misses = 0, 0
+
+  def getContext(self, key, systemFunc, integratorFunc):
+    """Returns the Context stored for key or, if missing, creates it with the System and integrator returned by
+    systemFunc and integratorFunc (only called on misses)"""
+    if key in self.contexts:
+      self.hits += 1
+      self.contexts.move_to_end(key)
+      return self.contexts[key]
+
+    self.misses += 1
+    context = Context(systemFunc(), integratorFunc(), self.platform, self.properties)
+    if self.maxSize > 0:
+      self.contexts[key] = context
+      if len(self.contexts) > self.maxSize:
+        self.contexts.popitem(last=False)
+    return context
+
+
+################# Ligands #################
+
+def loadLigands(pDic):
+  """Returns the openff molecules of the ligands specified in the params file"""
+  if not pDic.get('ligandFiles'):
+    return []
+
+  from openff.toolkit.topology import Molecule
+  return [Molecule.from_file(ligFile, allow_undefined_stereo=True) for ligFile in pDic['ligandFiles'].split(',')]
+
+# The ligand parameters cache (a TinyDB JSON file) is shared by all the jobs of the node, but TinyDB does not lock it.
+# Each process works on a private copy, refreshed from the shared cache before looking for a template and merged back
+# after generating a new one, both under an exclusive lock of the shared cache. The charges are computed unlocked
+
+@contextlib.contextmanager
+def lockedFile(fileName):
+  """Holds an exclusive (fcntl) lock of a file, as a <fileName>.lock file, released by the kernel if the job dies"""
+  with open(fileName + '.lock', 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def readTinyDB(fileName):
+  if not os.path.exists(fileName) or os.path.getsize(fileName) == 0:
+    return {}
+  with open(fileName) as f:
+    return json.load(f)
+
+def refreshLigandCache(sharedCache, privateCache):
+  with lockedFile(sharedCache):
+    if os.path.exists(sharedCache):
+      shutil.copyfile(sharedCache, privateCache)
+
+def mergeLigandCache(privateCache, sharedCache):
+  """Adds to the shared cache the molecules (smiles) of the private copy it does not have yet"""
+  with lockedFile(sharedCache):
+    shared = readTinyDB(sharedCache)
+    for tableName, records in readTinyDB(privateCache).items():
+      table = shared.setdefault(tableName, {})
+      smiles = {record['smiles'] for record in table.values()}
+      nextId = max(map(int, table), default=0) + 1
+      for record in records.values():
+        if record['smiles'] not in smiles:
+          table[str(nextId)], nextId = record, nextId + 1
+          smiles.add(record['smiles'])
+    writeJSON(sharedCache, shared)
+
+def getCachedGenerator(generator, sharedCache, privateCache):
+  """Template generator working on the private copy of the shared ligands cache"""
+  def cachedGenerator(forcefield, residue):
+    refreshLigandCache(sharedCache, privateCache)
+    generated = generator.generator(forcefield, residue)
+    if generated:
+      mergeLigandCache(privateCache, sharedCache)
+    return generated
+  return cachedGenerator
+
+def registerLigandTemplates(forcefield, pDic):
+  """Registers in the force field a template generator for the ligands specified in the params file.
+  The generated parameters are stored in an on-disk cache keyed by the molecule identity, so the expensive charge
+  calculation is only run the first time a ligand is seen. Returns the ligand molecules"""
+  molecules = loadLigands(pDic)
+  if molecules:
+    if pDic['ligandFF'].startswith('gaff'):
+      from openmmforcefields.generators import GAFFTemplateGenerator as TemplateGenerator
+    else:
+      from openmmforcefields.generators import SMIRNOFFTemplateGenerator as TemplateGenerator
+
+    fd, privateCache = tempfile.mkstemp(suffix='.json', prefix='ligandCache_')
+    os.close(fd)
+    atexit.register(lambda: os.path.exists(privateCache) and os.remove(privateCache))
+    generator = TemplateGenerator(molecules=molecules, forcefield=pDic['ligandFF'], cache=privateCache)
+    forcefield.registerTemplateGenerator(getCachedGenerator(generator, pDic['ligandCache'], privateCache))
+  return molecules
+
+def addLigands(modeller, molecules):
+  """Adds the ligand molecules, with the coordinates of their first conformer, to the modeller"""
+  if not molecules:
+    return
+
+  from openff.units.openmm import to_openmm
+  for mol in molecules:
+    modeller.add(mol.to_topology().to_openmm(), to_openmm(mol.conformers[0]))
+
+
+################# Force groups #################
+
+def assignForceGroups(system):
+  """Places each force of the system in its own force group and returns the names of the groups.
+  If there are more forces than available groups, the remaining ones share the last group"""
+  groupNames, nameCounts = [], {}
+  for i, force in enumerate(system.getForces()):
+    group = min(i, MAX_FORCE_GROUPS - 1)
+    force.setForceGroup(group)
+
+    name = force.__class__.__name__
+    nameCounts[name] = nameCounts.get(name, 0) + 1
+    if nameCounts[name] > 1:
+      name = f'{name}_{nameCounts[name]}'
+
+    if group < len(groupNames):
+      groupNames[group] = 'OtherForces'
+    else:
+      groupNames.append(name)
+  return groupNames
+
+def getGroupEnergies(context, nGroups):
+  """Returns the potential energy (kJ/mol) of each of the first nGroups force groups"""
+  return [context.getState(getEnergy=True, groups={g}).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+          for g in range(nGroups)]
+
+
+################# Binary columnar logs #################
+
+class BinaryLogWriter(object):
+  """Columnar log of float64 values. Rows are buffered in a preallocated array and appended in blocks to a raw
+  little-endian binary file, described by a JSON header (<fileName>.json) with the column names and any extra
+  metadata."""
+
+  def __init__(self, fileName, columns, blockSize=100, metadata=None):
+    self.fileName, self.columns = fileName, list(columns)
+    self._buffer = np.zeros((blockSize, len(self.columns)), dtype='<f8')
+    self._nBuffered = 0
+
+    with open(fileName + '.json', 'w') as f:
+      json.dump({'columns': self.columns, 'dtype': '<f8', **(metadata or {})}, f)
+    self._out = open(fileName, 'wb')
+
+  def append(self, row):
+    self._buffer[self._nBuffered] = row
+    self._nBuffered += 1
+    if self._nBuffered == len(self._buffer):
+      self.flush()
+
+  def flush(self):
+    if self._nBuffered > 0:
+      self._out.write(self._buffer[:self._nBuffered].tobytes())
+      self._nBuffered = 0
+    self._out.flush()
+
+  def tell(self):
+    self.flush()
+    return self._out.tell()
+
+  def truncate(self, position):
+    """Discards the rows written after a position (from tell)"""
+    self.flush()
+    self._out.seek(position)
+    self._out.truncate()
+
+  def close(self):
+    self.flush()
+    self._out.close()
+
+  def __del__(self):
+    if not self._out.closed:
+      self.close()
+
+
+class ForceGroupReporter(object):
+  """Reporter storing the potential energy of each force group in a binary columnar log"""
+
+  def __init__(self, fileName, reportInterval, groupNames):
+    self._reportInterval = reportInterval
+    self._nGroups = len(groupNames)
+    self._log = BinaryLogWriter(fileName, ['step'] + list(groupNames))
+
+  def describeNextReport(self, simulation):
+    steps = self._reportInterval - simulation.currentStep % self._reportInterval
+    return steps, False, False, False, False
+
+  def report(self, simulation, state):
+    self._log.append([simulation.currentStep] + getGroupEnergies(simulation.context, self._nGroups))
+
+  def flush(self):
+    self._log.flush()
+
+  def tell(self):
+    return self._log.tell()
+
+  def rewind(self, position):
+    self._log.truncate(position)
+
+  def close(self):
+    self._log.close()
+
+
+class BiasReporter(object):
+  """Reporter storing the bias of an enhanced sampling simulation in a binary columnar log.
+  biasFunc(simulation) must return the values of the columns of the log (after the step)"""
+
+  def __init__(self, fileName, reportInterval, columns, biasFunc, metadata=None):
+    self._reportInterval = reportInterval
+    self._biasFunc = biasFunc
+    self._log = BinaryLogWriter(fileName, ['step'] + list(columns), metadata=metadata)
+
+  def describeNextReport(self, simulation):
+    steps = self._reportInterval - simulation.currentStep % self._reportInterval
+    return steps, False, False, False, False
+
+  def report(self, simulation, state):
+    self._log.append([simulation.currentStep] + list(self._biasFunc(simulation)))
+
+  def flush(self):
+    self._log.flush()
+
+  def tell(self):
+    return self._log.tell()
+
+  def rewind(self, position):
+    self._log.truncate(position)
+
+  def close(self):
+    self._log.close()
+
+
+class StateReporter(object):
+  """Reporter storing the step, time (ps), potential and kinetic energies (kJ/mol), temperature (K) and box volume
+  (nm^3) in a binary columnar log, as a StateDataReporter without the text formatting. The header keeps the text
+  headers of the columns, to export it as the StateDataReporter CSV"""
+  COLUMNS = ['step', 'time', 'potentialEnergy', 'kineticEnergy', 'temperature', 'volume']
+  HEADERS = ['Step', 'Time (ps)', 'Potential Energy (kJ/mole)', 'Kinetic Energy (kJ/mole)', 'Temperature (K)',
+             'Box Volume (nm^3)']
+
+  def __init__(self, fileName, reportInterval, blockSize=100):
+    self._reportInterval = reportInterval
+    self._log = BinaryLogWriter(fileName, self.COLUMNS, blockSize=blockSize, metadata={'headers': self.HEADERS})
+    self._dof = None
+
+  def describeNextReport(self, simulation):
+    steps = self._reportInterval - simulation.currentStep % self._reportInterval
+    return steps, False, False, False, True
+
+  def report(self, simulation, state):
+    if self._dof is None:
+      self._dof = getDegreesOfFreedom(simulation.system)
+    kinetic = state.getKineticEnergy().value_in_unit(kilojoules_per_mole)
+    integrator = simulation.context.getIntegrator()
+    if hasattr(integrator, 'computeSystemTemperature'):
+      temperature = integrator.computeSystemTemperature().value_in_unit(kelvin)
+    else:
+      temperature = 2 * kinetic / (self._dof * MOLAR_GAS_CONSTANT_R.value_in_unit(kilojoules_per_mole / kelvin))
+    box = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometers)
+    self._log.append([simulation.currentStep, state.getTime().value_in_unit(picoseconds),
+                      state.getPotentialEnergy().value_in_unit(kilojoules_per_mole), kinetic, temperature,
+                      box[0, 0] * box[1, 1] * box[2, 2]])
+
+  def flush(self):
+    self._log.flush()
+
+  def tell(self):
+    return self._log.tell()
+
+  def rewind(self, position):
+    self._log.truncate(position)
+
+  def close(self):
+    self._log.close()
+
+
+################# Enhanced sampling #################
+
+TORSION_FORCES = ['PeriodicTorsionForce', 'RBTorsionForce', 'CMAPTorsionForce']
+
+def parseAtomIndexes(selection):
+  """Parses an atom selection as "4, 10-12" into an ordered list of atom indexes"""
+  indexes = []
+  for item in selection.split(','):
+    if '-' in item.strip()[1:]:
+      start, end = item.strip().split('-', 1)
+      indexes += list(range(int(start), int(end) + 1))
+    elif item.strip():
+      indexes.append(int(item.strip()))
+  return indexes
+
+def getCVForce(cvType, atoms, positions):
+  """Returns the force computing a collective variable and whether it is periodic.
+  distance: "<group1 atoms>; <group2 atoms>", distance (nm) between the centroids of both groups.
+  dihedral: "<4 atoms>", dihedral angle (rad).
+  rmsd: "<atoms>", RMSD (nm) of the atoms to their initial positions"""
+  cvType = cvType.lower()
+  if cvType == 'distance':
+    force = CustomCentroidBondForce(2, 'distance(g1, g2)')
+    groups = [force.addGroup(parseAtomIndexes(group)) for group in atoms.split(';')]
+    force.addBond(groups)
+    return force, False
+
+  elif cvType == 'dihedral':
+    force = CustomTorsionForce('theta')
+    force.addTorsion(*parseAtomIndexes(atoms))
+    return force, True
+
+  elif cvType == 'rmsd':
+    return RMSDForce(positions, parseAtomIndexes(atoms)), False
+
+  raise ValueError(f'Unknown collective variable type: {cvType}')
+
+def getBiasVariables(pDic, positions):
+  """Returns the metadynamics bias variables (and their names) defined in the params file as lines
+  cv_<i> :: <type> | <atoms> | <min> | <max> | <width>"""
+  variables, cvNames = [], []
+  cvKeys = sorted([key for key in pDic if key.startswith('cv_')], key=lambda k: int(k.split('_')[1]))
+  for key in cvKeys:
+    cvType, atoms, minValue, maxValue, width = [field.strip() for field in pDic[key].split('|')]
+    force, periodic = getCVForce(cvType, atoms, positions)
+    minValue, maxValue = (-np.pi, np.pi) if periodic else (float(minValue), float(maxValue))
+    variables.append(app.BiasVariable(force, minValue, maxValue, float(width), periodic))
+    cvNames.append(f'{cvType.lower()}_{len(cvNames) + 1}')
+  return variables, cvNames
+
+def getMetadynamicsBias(meta, simulation, temperature, biasGroup):
+  """Returns the current bias of a well-tempered metadynamics simulation (the energy of the force group of its bias
+  force), the bias shifted by the c(t) reweighting factor (Tiwary & Parrinello, 2015) and the values of the
+  collective variables"""
+  kT = (MOLAR_GAS_CONSTANT_R * temperature * kelvin).value_in_unit(kilojoules_per_mole)
+  bias = simulation.context.getState(getEnergy=True, groups={biasGroup}).getPotentialEnergy()
+  bias = bias.value_in_unit(kilojoules_per_mole)
+
+  freeEnergy = -meta.getFreeEnergy().value_in_unit(kilojoules_per_mole).flatten() / kT
+  logSum = lambda x: x.max() + np.log(np.sum(np.exp(x - x.max())))
+  ct = kT * (logSum(freeEnergy) - logSum(freeEnergy / meta.biasFactor))
+  return [bias, bias - ct] + list(meta.getCollectiveVariables(simulation))
+
+def assignAMDForceGroups(system):
+  """Places the torsion forces of the system in group 1 and the rest of them in group 0, so each region boosted by
+  accelerated MD is a single force group. Returns the names of the groups"""
+  hasTorsions = False
+  for force in system.getForces():
+    isTorsion = force.__class__.__name__ in TORSION_FORCES
+    force.setForceGroup(int(isTorsion))
+    hasTorsions = hasTorsions or isTorsion
+  if not hasTorsions:
+    raise ValueError('The system has no torsion forces to boost')
+  return ['OtherForces', 'TorsionForces']
+
+def getAMDBoosts(amdType):
+  """Returns the energy of the regions boosted by each type of accelerated MD and the force groups they act on.
+  Dihedral: torsion forces (group 1). Total: all the forces. Dual: torsion forces and, independently, the rest of them"""
+  if amdType == 'Dihedral':
+    return [('energy1', [1])]
+  elif amdType == 'Total':
+    return [('energy', [0, 1])]
+  return [('energy0', [0]), ('energy1', [1])]
+
+def getAMDIntegrator(boosts, temperature, fricCoef, stepSize):
+  """Langevin middle integrator with accelerated MD boosts (Hamelberg et al., 2004), for a system whose forces are
+  grouped by assignAMDForceGroups. For each boosted region, when its potential V is below the threshold E, the
+  potential is raised by (E-V)^2/(alpha+E-V) and its forces are scaled accordingly. The thresholds start disabled,
+  they must be set with setAMDParameters. The total boost energy is stored in the global variable boost.
+  The thermostat factors are computed from dt at each step, so they follow setStepSize (e.g. a monitor rollback)"""
+  integrator = CustomIntegrator(stepSize)
+  integrator.addGlobalVariable('gamma', fricCoef)
+  integrator.addGlobalVariable('kT', (MOLAR_GAS_CONSTANT_R * temperature * kelvin).value_in_unit(kilojoules_per_mole))
+  integrator.addGlobalVariable('boost', 0)
+  integrator.addPerDofVariable('x1', 0)
+  for k in range(len(boosts)):
+    for varName in ['V', 'E', 'alpha', 'factor', 'boost']:
+      integrator.addGlobalVariable(f'{varName}{k}', -1e10 if varName == 'E' else 1)
+
+  integrator.addUpdateContextState()
+  for k, (energy, _) in enumerate(boosts):
+    integrator.addComputeGlobal(f'V{k}', energy)
+    integrator.addComputeGlobal(f'factor{k}', f'select(step(E{k}-V{k}), (alpha{k}/(alpha{k}+E{k}-V{k}))^2, 1)')
+    integrator.addComputeGlobal(f'boost{k}', f'step(E{k}-V{k})*(E{k}-V{k})^2/(alpha{k}+E{k}-V{k})')
+  integrator.addComputeGlobal('boost', ' + '.join(f'boost{k}' for k in range(len(boosts))))
+
+  # A single computation cannot depend on several force groups, so each group kicks the velocities separately
+  for g in [0, 1]:
+    factors = '*'.join([f'factor{k}' for k, (_, groups) in enumerate(boosts) if g in groups] or ['1'])
+    integrator.addComputePerDof('v', f'v + dt*f{g}*{factors}/m')
+  integrator.addConstrainVelocities()
+  integrator.addComputePerDof('x', 'x + 0.5*dt*v')
+  integrator.addComputePerDof('v', 'exp(-gamma*dt)*v + sqrt(1-exp(-2*gamma*dt))*sqrt(kT/m)*gaussian')
+  integrator.addComputePerDof('x', 'x + 0.5*dt*v')
+  integrator.addComputePerDof('x1', 'x')
+  integrator.addConstrainPositions()
+  integrator.addComputePerDof('v', 'v + (x-x1)/dt')
+  return integrator
+
+def estimateAMDParameters(simulation, boosts, topology, amdType, nSteps, interval=10):
+  """Runs a short unboosted simulation to measure the average potential of each boosted region and returns their
+  (E, alpha) from the usual heuristics (Pierce et al., 2012), in kJ/mol:
+  dihedral: E = <V> + 3.5 Nres, alpha = 3.5 Nres / 5; total: E = <V> + 0.16 Natoms, alpha = 0.16 Natoms"""
+  nRes = len([res for res in topology.residues() if res.name not in SOLVENT_RESIDUES])
+  nAtoms = topology.getNumAtoms()
+
+  energies = []
+  for _ in range(max(1, nSteps // interval)):
+    simulation.step(interval)
+    energies.append([simulation.integrator.getGlobalVariableByName(f'V{k}') for k in range(len(boosts))])
+  meanEnergies = np.mean(energies, axis=0)
+
+  kcal = 4.184
+  regions = {'Dihedral': ['dihedral'], 'Total': ['total'], 'Dual': ['total', 'dihedral']}[amdType]
+  params = []
+  for region, meanV in zip(regions, meanEnergies):
+    boost = 3.5 * nRes * kcal if region == 'dihedral' else 0.16 * nAtoms * kcal
+    params.append((float(meanV) + boost, boost / 5 if region == 'dihedral' else boost))
+  return params
+
+def setAMDParameters(integrator, amdParams):
+  for k, (E, alpha) in enumerate(amdParams):
+    integrator.setGlobalVariableByName(f'E{k}', E)
+    integrator.setGlobalVariableByName(f'alpha{k}', alpha)
+
+
+################# DCD trajectories #################
+
+def readDCD(dcdFile):
+  """Reads a DCD trajectory as written by OpenMM (only fully written frames are considered).
+  Returns the steps of the frames, the coordinates (nFrames, nAtoms, 3) in nm and the box vectors of each frame
+  (None if the trajectory is not periodic)"""
+  header = np.fromfile(dcdFile, dtype='<i4', count=DCD_HEADER_SIZE // 4)
+  firstStep, interval, boxFlag, nAtoms = header[3], header[4], header[12], header[67]
+
+  frameLength = 3 * (nAtoms + 2) + (14 if boxFlag else 0)
+  nFrames = (os.path.getsize(dcdFile) - DCD_HEADER_SIZE) // (4 * frameLength)
+  frames = np.memmap(dcdFile, dtype='<f4', mode='r', offset=DCD_HEADER_SIZE, shape=(nFrames, frameLength))
+
+  boxes = None
+  if boxFlag:
+    cells = frames[:, 1:13].copy().view('<f8')
+    boxes = [computePeriodicBoxVectors(a / 10, b / 10, c / 10, np.arccos(cosA), np.arccos(cosB), np.arccos(cosG))
+             for a, cosG, b, cosB, cosA, c in cells]
+    frames = frames[:, 14:]
+
+  coords = frames.reshape(nFrames, 3, nAtoms + 2)[:, :, 1:-1].transpose(0, 2, 1) / 10
+  steps = firstStep + interval * np.arange(nFrames)
+  return steps, coords, boxes
+
+def encodeDCDFrame(positions, box=None):
+  """Bytes of a DCD frame as written by DCDFile.writeModel, from the positions (nAtoms, 3) and box vectors (3, 3)
+  in nm: the unit cell record (if box is given) and the x, y and z coordinates records (angstroms)"""
+  frame = b''
+  if box is not None:
+    a, b, c, alpha, beta, gamma = computeLengthsAndAngles(box)
+    frame = struct.pack('<i6di', 48, 10 * a, np.sin(np.pi / 2 - gamma), 10 * b, np.sin(np.pi / 2 - beta),
+                        np.sin(np.pi / 2 - alpha), 10 * c, 48)
+  records = np.empty((3, len(positions) + 2), dtype='<f4')
+  records[:, 1:-1] = 10 * np.asarray(positions).T
+  records.view('<i4')[:, [0, -1]] = 4 * len(positions)
+  return frame + records.tobytes()
+
+def truncateDCD(reporter, offset, nFrames):
+  """Discards the frames written by a DCD reporter (_out file and _dcd DCDFile) after an offset, with nFrames
+  frames before it (None if the header was not written yet)"""
+  out = reporter._out
+  out.seek(offset)
+  out.truncate()
+  if nFrames is None:
+    # The DCD (and its header) is created again in the next report
+    reporter._dcd = None
+  else:
+    # Frames count and last step in the DCD header
+    dcd = reporter._dcd
+    dcd._modelCount = nFrames
+    out.seek(8)
+    out.write(struct.pack('<i', nFrames))
+    out.seek(20)
+    out.write(struct.pack('<i', dcd._firstStep + (nFrames - 1) * dcd._interval))
+    out.seek(0, os.SEEK_END)
+
+class AsyncDCDReporter(object):
+  """DCD reporter whose frames are written by a background thread, so the integration does not wait for the file
+  system. Each report only queues the positions and box. The writer encodes with numpy all the frames in the queue
+  and writes them at once, updating the header once per batch. If queueSize frames are waiting, the next report
+  blocks until there is room (backpressure). flush waits for the queued frames to be written"""
+
+  def __init__(self, fileName, reportInterval, queueSize=8, bufferSize=1 << 22):
+    self._reportInterval = reportInterval
+    self._out = open(fileName, 'wb', buffering=bufferSize)
+    self._dcd, self._error = None, None
+    self._queue = queue.Queue(maxsize=queueSize)
+    self._thread = threading.Thread(target=self._write, daemon=True)
+    self._thread.start()
+    # Queued frames are written even if the script ends with an exception
+    atexit.register(self.close)
+
+  def describeNextReport(self, simulation):
+    steps = self._reportInterval - simulation.currentStep % self._reportInterval
+    return steps, True, False, False, False
+
+  def report(self, simulation, state):
+    if self._error is not None:
+      raise self._error
+    if self._dcd is None:
+      # The header is written here, when the writer is idle
+      self._dcd = app.DCDFile(self._out, simulation.topology, simulation.integrator.getStepSize(),
+                              self._reportInterval, self._reportInterval)
+    positions, box = state.getPositions(asNumpy=True).value_in_unit(nanometers), None
+    if not np.all(np.isfinite(positions)):
+      # Raised here, as DCDFile does, so the sanity monitor can roll the simulation back
+      raise ValueError('Particle position is not finite')
+    if simulation.topology.getPeriodicBoxVectors() is not None:
+      box = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometers)
+    self._queue.put((positions, box))
+
+  def _write(self):
+    while True:
+      batch = [self._queue.get()]
+      while not self._queue.empty():
+        batch.append(self._queue.get())
+      frames = [frame for frame in batch if frame is not None]
+      try:
+        if frames and self._error is None:
+          self.writeFrames(frames)
+      except Exception as e:
+        self._error = e
+      for _ in batch:
+        self._queue.task_done()
+      if len(frames) < len(batch):
+        break
+
+  def writeFrames(self, frames):
+    dcd = self._dcd
+    self._out.write(b''.join(encodeDCDFrame(positions, box) for positions, box in frames))
+    dcd._modelCount += len(frames)
+    self._out.seek(8)
+    self._out.write(struct.pack('<i', dcd._modelCount))
+    self._out.seek(20)
+    self._out.write(struct.pack('<i', dcd._firstStep + (dcd._modelCount - 1) * dcd._interval))
+    self._out.seek(0, os.SEEK_END)
+
+  def flush(self):
+    self._queue.join()
+    if self._error is not None:
+      raise self._error
+    self._out.flush()
+
+  def tell(self):
+    self.flush()
+    return self._out.tell(), self._dcd._modelCount if self._dcd is not None else None
+
+  def rewind(self, position):
+    self.flush()
+    truncateDCD(self, *position)
+
+  def close(self):
+    if self._thread.is_alive():
+      self._queue.put(None)
+      self._thread.join()
+    if not self._out.closed:
+      self._out.close()
+    error, self._error = self._error, None
+    if error is not None:
+      raise error
+
+def setFramePositions(context, coords, box=None):
+  if box is not None:
+    context.setPeriodicBoxVectors(*box)
+  context.setPositions(coords * nanometers)
+
+def loadStateFile(context, stateFile):
+  """Sets the box, positions and velocities of a serialized State (XML). Unlike Context.setState, the parameters of
+  the State are not applied, so it can continue a simulation whose forces (e.g. barostat) were different"""
+  with open(stateFile) as f:
+    state = XmlSerializer.deserialize(f.read())
+  if context.getSystem().usesPeriodicBoundaryConditions():
+    context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+  context.setPositions(state.getPositions())
+  context.setVelocities(state.getVelocities())
+
+
+################# Streaming #################
+# A running simulation flushes its reporters at chunk boundaries and then updates a frame index, so the frames (and
+# reporter rows) up to the indexed step can be consumed before the simulation finishes
+
+def flushReporters(simulation):
+  for reporter in simulation.reporters:
+    if hasattr(reporter, 'flush'):
+      reporter.flush()
+    elif hasattr(getattr(reporter, '_out', None), 'flush'):
+      reporter._out.flush()
+
+def writeTrajectoryIndex(fileName, dcdFile, nFrames, step, time, finished=False):
+  """Atomically stores the number of frames fully written in the trajectory, with the step and time (ps) of the last
+  one and the size of the dcd they span"""
+  index = {'frames': nFrames, 'step': step, 'time': time, 'dcdBytes': os.path.getsize(dcdFile), 'finished': finished}
+  writeJSON(fileName, index)
+
+def writeJSON(fileName, data):
+  """Writes a JSON file atomically, so a reader never finds it half written"""
+  with open(fileName + '.tmp', 'w') as f:
+    json.dump(data, f)
+  os.replace(fileName + '.tmp', fileName)
+
+
+################# Sanity monitor #################
+# The simulation runs in chunks and, after each of them, a few cheap checks are done on its energies. Sane chunks are
+# checkpointed. An exploding one is rolled back, with its reporters, to the last checkpoint and continued with a
+# reduced step size, or the simulation is aborted with a SimulationError
+MAX_ENERGY_JUMP = 100  # kJ/mol per atom between consecutive checks
+
+class SimulationError(Exception):
+  pass
+
+def getDegreesOfFreedom(system):
+  """Degrees of freedom of a system, as computed by the StateDataReporter for the temperature"""
+  dof = 3 * sum(1 for i in range(system.getNumParticles()) if system.getParticleMass(i).value_in_unit(dalton) > 0)
+  dof -= system.getNumConstraints()
+  if any(isinstance(force, CMMotionRemover) for force in system.getForces()):
+    dof -= 3
+  return max(dof, 1)
+
+def isRewindable(out):
+  return out is not None and out not in [sys.stdout, sys.stderr] and hasattr(out, 'seekable') and out.seekable()
+
+def getReportersPositions(simulation):
+  """Flushes the reporters writing to files and returns their positions (and frames written, for the DCD
+  reporters), to rewind them later with rewindReporters"""
+  positions = []
+  for reporter in simulation.reporters:
+    if hasattr(reporter, 'rewind'):
+      positions.append(reporter.tell())
+    elif isRewindable(getattr(reporter, '_out', None)):
+      reporter._out.flush()
+      dcd = getattr(reporter, '_dcd', None)
+      positions.append((reporter._out.tell(), dcd._modelCount if dcd is not None else None))
+    else:
+      positions.append(None)
+  return positions
+
+def rewindReporters(simulation, positions):
+  """Discards what the reporters wrote after their positions (from getReportersPositions)"""
+  for reporter, position in zip(simulation.reporters, positions):
+    if position is None:
+      continue
+    elif hasattr(reporter, 'rewind'):
+      reporter.rewind(position)
+      continue
+
+    offset, nFrames = position
+    if isinstance(reporter, app.DCDReporter):
+      truncateDCD(reporter, offset, nFrames)
+    else:
+      reporter._out.seek(offset)
+      reporter._out.truncate()
+
+class SimulationMonitor(object):
+  """Runs a simulation in chunks, checking after each one that its energies are finite, its temperature below
+  maxTemperature and its potential energy does not jump. Sane chunks are checkpointed (context and reporters).
+  When a chunk fails, the simulation is rolled back to the last checkpoint and its step size (or error tolerance,
+  for variable step integrators) multiplied by stepFactor, up to maxRollbacks times. Then, or if rollback is False
+  (e.g. metadynamics, whose bias cannot be rolled back), a SimulationError is raised.
+  The events, final step size and simulated time are stored in the JSON logFile"""
+
+  def __init__(self, simulation, logFile, maxTemperature=1000, maxRollbacks=3, stepFactor=0.5, rollback=True,
+               maxEnergyJump=MAX_ENERGY_JUMP):
+    self.simulation, self.logFile = simulation, logFile
+    self.maxTemperature, self.maxRollbacks, self.stepFactor = maxTemperature, maxRollbacks, stepFactor
+    self.rollback, self.maxEnergyJump = rollback, maxEnergyJump
+    self._dof = getDegreesOfFreedom(simulation.system)
+    self._nAtoms = max(simulation.system.getNumParticles(), 1)
+    self.events, self.time = [], 0
+    self.checkpoint(simulation.context.getState(getEnergy=True))
+    self.writeLog('running')
+
+  def step(self, steps, stepFunc=None):
+    """Runs some steps (with stepFunc(steps) if given) and checks the resulting state. Returns whether they were
+    sane, otherwise the simulation is back in the last checkpoint"""
+    try:
+      (stepFunc or self.simulation.step)(steps)
+      state = self.simulation.context.getState(getEnergy=True)
+      reason = self.checkState(state)
+    except (ValueError, OpenMMException) as e:
+      reason = str(e).split('.')[0]
+
+    if reason is None:
+      self.time += state.getTime().value_in_unit(picoseconds) - self._time
+      self.checkpoint(state)
+      return True
+    self.rollBack(reason)
+    return False
+
+  def checkState(self, state):
+    """Returns why the state is not sane, or None"""
+    potential = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+    kinetic = state.getKineticEnergy().value_in_unit(kilojoules_per_mole)
+    if not np.isfinite(potential) or not np.isfinite(kinetic):
+      return 'Energy is not finite'
+    temperature = 2 * kinetic / (self._dof * MOLAR_GAS_CONSTANT_R.value_in_unit(kilojoules_per_mole / kelvin))
+    if temperature > self.maxTemperature:
+      return 'Temperature of {:.0f} K'.format(temperature)
+    if (potential - self._potential) / self._nAtoms > self.maxEnergyJump:
+      return 'Potential energy jump of {:.0f} kJ/mol per atom'.format((potential - self._potential) / self._nAtoms)
+
+  def checkpoint(self, state):
+    self._checkpoint = self.simulation.context.createCheckpoint()
+    self._step, self._reporters = self.simulation.currentStep, getReportersPositions(self.simulation)
+    self._potential = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+    self._time = state.getTime().value_in_unit(picoseconds)
+
+  def rollBack(self, reason):
+    integrator = self.simulation.integrator
+    event = {'step': self.simulation.currentStep, 'checkpointStep': self._step, 'reason': reason}
+    if not self.rollback or sum(e['action'] == 'rollback' for e in self.events) >= self.maxRollbacks:
+      self.events.append({**event, 'action': 'abort'})
+      self.writeLog('aborted')
+      raise SimulationError('Simulation aborted at step {}: {}'.format(event['step'], reason))
+
+    self.simulation.context.loadCheckpoint(self._checkpoint)
+    self.simulation.currentStep = self._step
+    rewindReporters(self.simulation, self._reporters)
+    if hasattr(integrator, 'setErrorTolerance'):
+      integrator.setErrorTolerance(integrator.getErrorTolerance() * self.stepFactor)
+      event['errorTolerance'] = integrator.getErrorTolerance()
+    else:
+      integrator.setStepSize(integrator.getStepSize() * self.stepFactor)
+      event['stepSize'] = integrator.getStepSize().value_in_unit(picoseconds)
+    self.events.append({**event, 'action': 'rollback'})
+    print('Step {}: {}. Rolled back to step {}'.format(event['step'], reason, self._step))
+    sys.stdout.flush()
+    self.writeLog('running')
+
+  def writeLog(self, status):
+    writeJSON(self.logFile, {'status': status, 'step': self._step, 'time': self.time, 'events': self.events})
+
+  def close(self):
+    self.writeLog('finished')
+
+
+################# Profiling #################
+# Where the time of a simulation goes: python functions (cProfile stats, or a py-spy flame graph), evaluation of each
+# force group, integration steps with and without the barostat moves and writing of each reporter
+PROFILE_TOP_FUNCTIONS = 25
+
+def timeForceGroups(system, context, groupNames, nSamples=10):
+  """Mean wall time (s) of computing the forces and energy of all the forces and of each force group of the system.
+  Forces out of groupNames (e.g. the metadynamics bias) are named after their class"""
+  groups = OrderedDict()
+  for force in system.getForces():
+    group = force.getForceGroup()
+    groups.setdefault(group, groupNames[group] if group < len(groupNames) else force.__class__.__name__)
+
+  # First evaluation, which may compile kernels or build neighbor lists, is not timed
+  context.getState(getForces=True, getEnergy=True)
+  timings = OrderedDict()
+  for name, groupSet in [('All', -1)] + [(name, {group}) for group, name in groups.items()]:
+    start = time.perf_counter()
+    for _ in range(nSamples):
+      context.getState(getForces=True, getEnergy=True, groups=groupSet)
+    timings[name] = (time.perf_counter() - start) / nSamples
+  return timings
+
+def timeSteps(context, integrator, nSteps):
+  """Mean wall time (s) of an integration step, without reporters"""
+  start = time.perf_counter()
+  integrator.step(nSteps)
+  context.getState(getEnergy=True)
+  return (time.perf_counter() - start) / nSteps
+
+def getBarostats(system):
+  return [force for force in system.getForces() if 'Barostat' in force.__class__.__name__]
+
+def timeBarostat(system, context, integrator, nSteps):
+  """Mean wall time (s) per step of the Monte Carlo barostat moves, from the steps time with and without them.
+  The context is restored afterwards"""
+  barostats = getBarostats(system)
+  checkpoint = context.createCheckpoint()
+  withBarostat = timeSteps(context, integrator, nSteps)
+  frequencies = [barostat.getFrequency() for barostat in barostats]
+  for barostat in barostats:
+    barostat.setFrequency(0)
+  context.reinitialize(preserveState=True)
+  timeSteps(context, integrator, 1)
+  withoutBarostat = timeSteps(context, integrator, nSteps)
+
+  for barostat, frequency in zip(barostats, frequencies):
+    barostat.setFrequency(frequency)
+  context.reinitialize(preserveState=True)
+  context.loadCheckpoint(checkpoint)
+  return max(withBarostat - withoutBarostat, 0)
+
+def getSimulationTime(simulation):
+  return simulation.context.getState().getTime().value_in_unit(picoseconds)
+
+def getReporterName(reporter):
+  """Class of a reporter and the file it writes, if any"""
+  out = getattr(reporter, '_out', None) or getattr(getattr(reporter, '_log', None), '_out', None)
+  name = reporter.__class__.__name__
+  if isinstance(getattr(out, 'name', None), str) and out not in [sys.stdout, sys.stderr]:
+    name += ' ({})'.format(os.path.basename(out.name))
+  return name
+
+class SimulationProfiler(object):
+  """Profiles a simulation script with cProfile (stats in statsFile) or, if profiler is py-spy and it is installed,
+  with a py-spy flame graph (statsFile with .svg extension). It also times the writing of the reporters
+  (timeReporters), the force groups, steps and barostat (timeSimulation) and the production run (startRun, stopRun).
+  The report is written to the JSON reportFile when closed"""
+
+  def __init__(self, reportFile, statsFile, profiler='cProfile'):
+    self.reportFile = reportFile
+    self.report = OrderedDict([('profiler', profiler)])
+    self._cProfile, self._pySpy = None, None
+    if profiler == 'py-spy' and shutil.which('py-spy') is None:
+      print('py-spy is not installed, profiling with cProfile')
+      self.report['profiler'] = profiler = 'cProfile'
+
+    if profiler == 'py-spy':
+      self.statsFile = os.path.splitext(statsFile)[0] + '.svg'
+      self._pySpy = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--output', self.statsFile,
+                                      '--nonblocking'])
+    else:
+      self.statsFile = statsFile
+      self._cProfile = cProfile.Profile()
+      self._cProfile.enable()
+    self.report['statsFile'] = self.statsFile
+    self._reporterTimes = OrderedDict()
+
+  def timeReporters(self, simulation):
+    """Wraps the report method of the reporters of the simulation to accumulate their calls and wall time"""
+    for reporter in simulation.reporters:
+      name = getReporterName(reporter)
+      self._reporterTimes[name] = {'calls': 0, 'time': 0}
+      reporter.report = self._timedReport(reporter.report, self._reporterTimes[name])
+
+  @staticmethod
+  def _timedReport(report, times):
+    def timedReport(simulation, state):
+      start = time.perf_counter()
+      report(simulation, state)
+      times['calls'] += 1
+      times['time'] += time.perf_counter() - start
+    return timedReport
+
+  def startRun(self, simulation):
+    self._runStart = (time.perf_counter(), simulation.currentStep, getSimulationTime(simulation))
+
+  def stopRun(self, simulation):
+    """Stores the wall time of the run since startRun, its steps and its performance (ns/day)"""
+    startTime, startStep, startSimTime = self._runStart
+    runTime = time.perf_counter() - startTime
+    simulatedTime = getSimulationTime(simulation) - startSimTime
+    self.report.update({'steps': simulation.currentStep - startStep, 'runTime': runTime,
+                        'nsPerDay': simulatedTime / 1000 * 86400 / runTime if runTime > 0 else None})
+
+  def timeSimulation(self, simulation, groupNames, nSamples=10):
+    """Times the force groups, the integration steps and the barostat moves of the simulation in its current state,
+    which is restored afterwards"""
+    system, context, integrator = simulation.system, simulation.context, simulation.integrator
+    self.report.update({'platform': context.getPlatform().getName(), 'atoms': system.getNumParticles()})
+    self.report['forceGroups'] = timeForceGroups(system, context, groupNames, nSamples)
+
+    checkpoint = context.createCheckpoint()
+    timeSteps(context, integrator, 1)
+    self.report['stepTime'] = timeSteps(context, integrator, nSamples)
+    context.loadCheckpoint(checkpoint)
+    barostats = getBarostats(system)
+    if barostats:
+      # Enough steps for several barostat moves
+      nSteps = max(nSamples, 5 * max(barostat.getFrequency() for barostat in barostats))
+      self.report['barostatTime'] = timeBarostat(system, context, integrator, nSteps)
+
+  def getTopFunctions(self, nFunctions=PROFILE_TOP_FUNCTIONS):
+    """Functions with the largest cumulative time in the cProfile stats"""
+    stats = pstats.Stats(self._cProfile)
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:nFunctions]
+    return [{'function': '{}:{}({})'.format(os.path.basename(fileName), line, name), 'calls': nCalls,
+             'tottime': totTime, 'cumtime': cumTime}
+            for (fileName, line, name), (_, nCalls, totTime, cumTime, _) in functions]
+
+  def close(self):
+    if self._cProfile is not None:
+      self._cProfile.disable()
+      self._cProfile.dump_stats(self.statsFile)
+      self.report['functions'] = self.getTopFunctions()
+    else:
+      # py-spy writes its flame graph when interrupted
+      self._pySpy.send_signal(signal.SIGINT)
+      self._pySpy.wait()
+
+    self.report['reporters'] = self._reporterTimes
+    writeJSON(self.reportFile, self.report)
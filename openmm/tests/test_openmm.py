@@ -24,12 +24,38 @@
 # *
 # **************************************************************************
 
-import os
+import os, sys, ast, glob, subprocess
 
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
-from pwem.protocols import ProtImportPdb
+from pwem.protocols import ProtImportPdb, ProtImportSetOfAtomStructs
+from pwchem.protocols import ProtChemImportSmallMolecules
 
-from ..protocols import ProtOpenMMReceptorPrep, ProtOpenMMSystemPrep, ProtOpenMMSystemSimulation
+from ..protocols import ProtOpenMMReceptorPrep, ProtOpenMMSystemPrep, ProtOpenMMSystemSimulation, \
+  ProtOpenMMEnergyDecomposition, ProtOpenMMReplicaExchange, \
+  ProtOpenMMAlchemical, ProtOpenMMUmbrellaSampling, ProtOpenMMAdaptiveSampling, \
+  ProtOpenMMPoseRescoring, ProtOpenMMMinimizeSet
+from ..utils import parseParamsFile, readProfileReport, readReportLog, readDeviceBenchmark
+
+def readResidueNames(structFile):
+  """Names of the residues of a PDB or PDBx/mmCIF (as written by OpenMM) structure file"""
+  names = set()
+  with open(structFile) as f:
+    for line in f:
+      if line.startswith(('ATOM', 'HETATM')):
+        names.add(line.split()[5] if structFile.endswith('.cif') else line[17:20].strip())
+  return names
+
+def readBoxAngles(structFile):
+  """Angles (alpha, beta, gamma) in degrees of the periodic box of a PDB or PDBx/mmCIF structure file"""
+  angles = {}
+  with open(structFile) as f:
+    for line in f:
+      if line.startswith('CRYST1'):
+        return [float(line[33:40]), float(line[40:47]), float(line[47:54])]
+      elif line.startswith('_cell.angle_'):
+        key, value = line.split()[:2]
+        angles[key] = float(value)
+  return [angles['_cell.angle_{}'.format(name)] for name in ['alpha', 'beta', 'gamma']]
 
 class TestOpenMMPrepareReceptor(BaseTest):
   @classmethod
@@ -57,6 +83,16 @@ class TestOpenMMPrepareReceptor(BaseTest):
     cls.launchProtocol(protPrepare)
     return protPrepare
 
+  @classmethod
+  def _runImportSmallMolecules(cls):
+    cls.dsLig = DataSet.getDataSet('smallMolecules')
+    protImportMols = cls.newProtocol(
+      ProtChemImportSmallMolecules,
+      filesPath=cls.dsLig.getFile('mol2'))
+
+    cls.launchProtocol(protImportMols)
+    return protImportMols
+
   def test(self):
     protPrepare = self._runPrepareReceptor()
     self._waitOutput(protPrepare, 'outputStructure', sleepTime=10)
@@ -81,6 +117,114 @@ class TestOpenMMPrepareSystem(TestOpenMMPrepareReceptor):
         self.assertIsNotNone(getattr(protPrepare, 'outputSystem', None))
 
 
+class TestOpenMMPrepareSystemCache(TestOpenMMPrepareSystem):
+    def test(self):
+        protPrepareRec = self._runPrepareReceptor()
+        self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+        protPrepare = self._runPrepareSystem(protPrepareRec)
+        self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+        # The same preparation reuses the cached system
+        protRepeat = self._runPrepareSystem(protPrepareRec)
+        self._waitOutput(protRepeat, 'outputSystem', sleepTime=10)
+        self.assertTrue(any('reused from the cache' in line for line in protRepeat.summary()))
+
+
+class TestOpenMMPrepareSystemLigandCache(TestOpenMMPrepareSystem):
+    @classmethod
+    def _runPrepareSystemLigands(cls, protPrepare, protImportMols):
+        protPrepareS = cls.newProtocol(
+            ProtOpenMMSystemPrep,
+            inputStructure=protPrepare.outputStructure,
+            addLigands=True, inputSmallMolecules=protImportMols.outputSmallMolecules)
+
+        cls.launchProtocol(protPrepareS)
+        return protPrepareS
+
+    def test(self):
+        protPrepareRec = self._runPrepareReceptor()
+        self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+        protImportMols = self._runImportSmallMolecules()
+        self._waitOutput(protImportMols, 'outputSmallMolecules', sleepTime=10)
+        protPrepare = self._runPrepareSystemLigands(protPrepareRec, protImportMols)
+        self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+        # The ligands are converted again (with a new timestamp in the SDFs), but the cache entry is the same
+        protRepeat = self._runPrepareSystemLigands(protPrepareRec, protImportMols)
+        self._waitOutput(protRepeat, 'outputSystem', sleepTime=10)
+        self.assertTrue(any('reused from the cache' in line for line in protRepeat.summary()))
+
+
+class TestOpenMMPrepareSystemFast(TestOpenMMPrepareSystem):
+    def test(self):
+        protPrepareRec = self._runPrepareReceptor()
+        self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+        protPrepare = self._runPrepareSystem(protPrepareRec)
+        self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+        protFast = self.newProtocol(ProtOpenMMSystemPrep, inputStructure=protPrepareRec.outputStructure,
+                                    fastSolvation=True, useCache=False)
+        self.launchProtocol(protFast)
+        self._waitOutput(protFast, 'outputSystem', sleepTime=10)
+
+        # The fast solvation builds a box with the same waters and ions
+        summary, fastSummary = [parseParamsFile(prot.getSolvationSummaryFile()) for prot in [protPrepare, protFast]]
+        self.assertEqual(summary['nAtoms'], fastSummary['nAtoms'])
+        self.assertEqual(summary['nWaters'], fastSummary['nWaters'])
+
+
+class TestOpenMMPrepareSystemDodecahedron(TestOpenMMPrepareSystem):
+    @classmethod
+    def _runPrepareSystem(cls, protPrepare):
+        protPrepareS = cls.newProtocol(
+            ProtOpenMMSystemPrep,
+            inputStructure=protPrepare.outputStructure,
+            boxShape=1, useCache=False)
+
+        cls.launchProtocol(protPrepareS)
+        return protPrepareS
+
+    def test(self):
+        protPrepareRec = self._runPrepareReceptor()
+        self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+        protPrepare = self._runPrepareSystem(protPrepareRec)
+        self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+        # A rhombic dodecahedron box is triclinic: alpha = beta = 60, gamma = 90 degrees
+        alpha, beta, gamma = readBoxAngles(protPrepare.outputSystem.getSystemFile())
+        self.assertAlmostEqual(alpha, 60, places=1)
+        self.assertAlmostEqual(beta, 60, places=1)
+        self.assertAlmostEqual(gamma, 90, places=1)
+        self.assertTrue(any('estimated speedup' in line for line in protPrepare.summary()))
+
+
+class TestOpenMMPrepareMembrane(TestOpenMMPrepareSystem):
+    @classmethod
+    def _runPrepareSystem(cls, protPrepare):
+        protPrepareS = cls.newProtocol(
+            ProtOpenMMSystemPrep,
+            inputStructure=protPrepare.outputStructure,
+            solventType=2, orientProtein=True, useCache=False)
+
+        cls.launchProtocol(protPrepareS)
+        return protPrepareS
+
+    def test(self):
+        protPrepareRec = self._runPrepareReceptor()
+        self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+        protPrepare = self._runPrepareSystem(protPrepareRec)
+        self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+        # The structure is embedded in a lipid bilayer, solvated with explicit water
+        outSystem = protPrepare.outputSystem
+        self.assertEqual(outSystem.getSolventType(), 'Membrane')
+        # PDB residue names are truncated to 3 characters (POPC -> POP)
+        resNames = {name[:3] for name in readResidueNames(outSystem.getSystemFile())}
+        self.assertIn(protPrepare.getEnumText('lipidType')[:3], resNames)
+        self.assertIn('HOH', resNames)
+        self.assertGreater(int(parseParamsFile(protPrepare.getSolvationSummaryFile())['nWaters']), 0)
+
+
 class TestOpenMMSimulation(TestOpenMMPrepareSystem):
   @classmethod
   def _runSimulation(cls, protPrepareS):
@@ -101,3 +245,384 @@ class TestOpenMMSimulation(TestOpenMMPrepareSystem):
     protSim = self._runSimulation(protPrepare)
     self._waitOutput(protSim, 'outputSystem', sleepTime=10)
     self.assertIsNotNone(getattr(protSim, 'outputSystem', None))
+    columns, data = readReportLog(protSim.outputSystem.getReportFile())
+    self.assertIn('temperature', columns)
+    self.assertEqual(len(data), protSim.nSteps.get() // protSim.nTraj.get())
+
+
+class TestOpenMMImplicitSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runPrepareSystem(cls, protPrepare):
+    protPrepareS = cls.newProtocol(
+      ProtOpenMMSystemPrep,
+      inputStructure=protPrepare.outputStructure,
+      solventType=1, nonbondedMethod=1)
+
+    cls.launchProtocol(protPrepareS)
+    return protPrepareS
+
+
+class TestOpenMMAcceleratedSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runSimulation(cls, protPrepareS):
+    protSim = cls.newProtocol(
+      ProtOpenMMSystemSimulation,
+      inputSystem=protPrepareS.outputSystem,
+      maxIter=50, nSteps=100, integrator=2,
+      enhancedSampling=1, amdEstimateSteps=100)
+
+    cls.launchProtocol(protSim)
+    return protSim
+
+
+class TestOpenMMStreamingSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runSimulation(cls, protPrepareS):
+    protSim = cls.newProtocol(
+      ProtOpenMMSystemSimulation,
+      inputSystem=protPrepareS.outputSystem,
+      maxIter=50, nSteps=100, nTraj=10,
+      streamOutput=True, streamFrames=2, numberOfThreads=2)
+
+    cls.launchProtocol(protSim)
+    return protSim
+
+
+class TestOpenMMMonitoredSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runSimulation(cls, protPrepareS):
+    # Any chunk is above a maximum temperature of 1 K, so the monitor always rolls back with smaller step sizes
+    # until it aborts the simulation, whatever the platform
+    protSim = cls.newProtocol(
+      ProtOpenMMSystemSimulation,
+      inputSystem=protPrepareS.outputSystem,
+      maxIter=50, nSteps=200, nTraj=10, stepSize=0.002,
+      useMonitor=True, monitorInterval=50, maxTemperature=1, maxRollbacks=2)
+
+    cls.proj.launchProtocol(protSim, wait=True)
+    return protSim
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protSim = self._runSimulation(protPrepare)
+    self.assertTrue(protSim.isFailed())
+    monitorLog = protSim.getMonitorLog()
+    self.assertEqual(monitorLog['status'], 'aborted')
+    self.assertEqual([event['action'] for event in monitorLog['events']], ['rollback', 'rollback', 'abort'])
+    self.assertTrue(all(event['reason'].startswith('Temperature') for event in monitorLog['events']))
+    self.assertTrue(all(event['checkpointStep'] == 0 for event in monitorLog['events']))
+    self.assertEqual([event['stepSize'] for event in monitorLog['events'][:2]], [0.001, 0.0005])
+
+
+class TestOpenMMProfiledSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runSimulation(cls, protPrepareS):
+    protSim = cls.newProtocol(
+      ProtOpenMMSystemSimulation,
+      inputSystem=protPrepareS.outputSystem,
+      maxIter=50, nSteps=200, nTraj=10,
+      addBarostat=True, profile=True, profileSamples=5)
+
+    cls.launchProtocol(protSim)
+    return protSim
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protSim = self._runSimulation(protPrepare)
+    self._waitOutput(protSim, 'outputSystem', sleepTime=10)
+    report = readProfileReport(protSim.outputSystem.getProfileFile())
+    self.assertIn('NonbondedForce', report['forceGroups'])
+    self.assertIn('barostatTime', report)
+    self.assertTrue(report['functions'])
+
+
+class TestOpenMMBenchmarkedSimulation(TestOpenMMSimulation):
+  @classmethod
+  def _runSimulation(cls, protPrepareS):
+    # Without GPUs, only the CPU configuration can run and it is the one chosen
+    protSim = cls.newProtocol(
+      ProtOpenMMSystemSimulation,
+      inputSystem=protPrepareS.outputSystem,
+      maxIter=50, nSteps=100, deviceMode=2, benchmarkSteps=50)
+
+    cls.launchProtocol(protSim)
+    return protSim
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protSim = self._runSimulation(protPrepare)
+    self._waitOutput(protSim, 'outputSystem', sleepTime=10)
+    benchmark = readDeviceBenchmark(protSim.getBenchmarkFile())
+    self.assertIn(benchmark['best'], benchmark['results'])
+    self.assertGreater(benchmark['best']['nsPerDay'], 0)
+
+
+class TestOpenMMContinuedSimulation(TestOpenMMSimulation):
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+    protSim = self._runSimulation(protPrepare)
+    self._waitOutput(protSim, 'outputSystem', sleepTime=10)
+    self.assertTrue(os.path.exists(protSim.outputSystem.getStateFile()))
+
+    # Continues the final state of the first simulation
+    protCont = self._runSimulation(protSim)
+    self._waitOutput(protCont, 'outputSystem', sleepTime=10)
+    self.assertIsNotNone(getattr(protCont, 'outputSystem', None))
+
+
+class TestOpenMMEnergyDecomposition(TestOpenMMSimulation):
+  @classmethod
+  def _runDecomposition(cls, protSim):
+    protDec = cls.newProtocol(
+      ProtOpenMMEnergyDecomposition,
+      inputSystem=protSim.outputSystem)
+
+    cls.launchProtocol(protDec)
+    return protDec
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+    protSim = self._runSimulation(protPrepare)
+    self._waitOutput(protSim, 'outputSystem', sleepTime=10)
+
+    protDec = self._runDecomposition(protSim)
+    self._waitOutput(protDec, 'outputSystem', sleepTime=10)
+    self.assertIsNotNone(getattr(protDec, 'outputSystem', None))
+    self.assertTrue(os.path.exists(protDec.outputSystem.getEnergyGroupsFile()))
+
+
+class TestOpenMMReplicaExchange(TestOpenMMPrepareSystem):
+  @classmethod
+  def _runReplicaExchange(cls, protPrepareS):
+    protREMD = cls.newProtocol(
+      ProtOpenMMReplicaExchange,
+      inputSystem=protPrepareS.outputSystem,
+      remdType=1, nReplicas=3, minTemp=300, maxTemp=450,
+      exchangeInterval=100, nExchanges=10, maxIter=100)
+
+    cls.launchProtocol(protREMD)
+    return protREMD
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protREMD = self._runReplicaExchange(protPrepare)
+    self._waitOutput(protREMD, 'outputSystem', sleepTime=10)
+    self.assertIsNotNone(getattr(protREMD, 'outputSystem', None))
+    self.assertTrue(os.path.exists(protREMD.getStatsFile()))
+
+
+class TestOpenMMAlchemical(TestOpenMMPrepareSystem):
+  @classmethod
+  def _runAlchemical(cls, protPrepareS):
+    protAlch = cls.newProtocol(
+      ProtOpenMMAlchemical,
+      inputSystem=protPrepareS.outputSystem,
+      alchResidues='10', elecLambdas='1.0, 0.0', stericsLambdas='1.0, 0.5, 0.0',
+      nEquilSteps=100, nIterations=10, stepsPerIteration=50, maxIter=100)
+
+    cls.launchProtocol(protAlch)
+    return protAlch
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protAlch = self._runAlchemical(protPrepare)
+    self._waitOutput(protAlch, 'deltaG', sleepTime=10)
+    self.assertIsNotNone(getattr(protAlch, 'deltaG', None))
+
+
+class TestOpenMMRestrainedAlchemical(TestOpenMMAlchemical):
+  @classmethod
+  def _runAlchemical(cls, protPrepareS):
+    protAlch = cls.newProtocol(
+      ProtOpenMMAlchemical,
+      inputSystem=protPrepareS.outputSystem,
+      alchResidues='10', elecLambdas='1.0, 0.0', stericsLambdas='1.0, 0.5, 0.0',
+      restrainLigand=True, pocketResidues='5-9, 11-15',
+      nEquilSteps=100, nIterations=10, stepsPerIteration=50, maxIter=100)
+
+    cls.launchProtocol(protAlch)
+    return protAlch
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    # The standard state correction of the restraint is computed along with the decoupling free energy
+    protAlch = self._runAlchemical(protPrepare)
+    self._waitOutput(protAlch, 'deltaG', sleepTime=10)
+    self.assertIsNotNone(getattr(protAlch, 'deltaG', None))
+    self.assertTrue(any('Restraint standard state correction' in line for line in protAlch.summary()))
+
+
+class TestOpenMMUmbrellaSampling(TestOpenMMPrepareSystem):
+  @classmethod
+  def _runUmbrella(cls, protPrepareS):
+    protUmbrella = cls.newProtocol(
+      ProtOpenMMUmbrellaSampling,
+      inputSystem=protPrepareS.outputSystem,
+      pullResidues='10', refResidues='1-5', finalDistance=2.0,
+      smdSteps=1000, nWindows=4, windowEquilSteps=100, windowSteps=500, cvInterval=50, maxIter=100)
+
+    cls.launchProtocol(protUmbrella)
+    return protUmbrella
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protUmbrella = self._runUmbrella(protPrepare)
+    self._waitOutput(protUmbrella, 'outputSystem', sleepTime=10)
+    self.assertIsNotNone(getattr(protUmbrella, 'outputSystem', None))
+    self.assertTrue(os.path.exists(protUmbrella.getWindowFile(3)))
+
+
+class TestOpenMMAdaptiveSampling(TestOpenMMPrepareSystem):
+  @classmethod
+  def _runAdaptiveSampling(cls, protPrepareS):
+    protAdaptive = cls.newProtocol(
+      ProtOpenMMAdaptiveSampling,
+      inputSystem=protPrepareS.outputSystem,
+      nRounds=2, nTrajs=2, nSteps=200, saveInterval=20, nClusters=4, maxIter=100)
+
+    cls.launchProtocol(protAdaptive)
+    return protAdaptive
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+
+    protAdaptive = self._runAdaptiveSampling(protPrepare)
+    self._waitOutput(protAdaptive, 'outputSystem', sleepTime=10)
+    self.assertIsNotNone(getattr(protAdaptive, 'outputSystem', None))
+    self.assertEqual(protAdaptive.getCampaignState()['round'], 2)
+
+
+class TestOpenMMPoseRescoring(TestOpenMMImplicitSimulation):
+  @classmethod
+  def _runRescoring(cls, protPrepareS, protImportMols):
+    protRescoring = cls.newProtocol(
+      ProtOpenMMPoseRescoring,
+      inputSystem=protPrepareS.outputSystem,
+      inputSmallMolecules=protImportMols.outputSmallMolecules,
+      nSteps=200, saveInterval=50, maxIter=100)
+
+    cls.launchProtocol(protRescoring)
+    return protRescoring
+
+  def test(self):
+    protPrepareRec = self._runPrepareReceptor()
+    self._waitOutput(protPrepareRec, 'outputStructure', sleepTime=10)
+    protPrepare = self._runPrepareSystem(protPrepareRec)
+    self._waitOutput(protPrepare, 'outputSystem', sleepTime=10)
+    protImportMols = self._runImportSmallMolecules()
+    self._waitOutput(protImportMols, 'outputSmallMolecules', sleepTime=10)
+
+    protRescoring = self._runRescoring(protPrepare, protImportMols)
+    self._waitOutput(protRescoring, 'outputSmallMolecules', sleepTime=10)
+    self.assertIsNotNone(getattr(protRescoring, 'outputSmallMolecules', None))
+
+
+class TestOpenMMMinimizeSet(BaseTest):
+  @classmethod
+  def setUpClass(cls):
+    cls.ds = DataSet.getDataSet('model_building_tutorial')
+    setupTestProject(cls)
+
+  @classmethod
+  def _runImportAtomStructs(cls):
+    protImport = cls.newProtocol(
+      ProtImportSetOfAtomStructs,
+      inputPdbData=1, filesPath=os.path.dirname(cls.ds.getFile('PDBx_mmCIF/1ake_mut1.pdb')),
+      filesPattern='1ake_mut*.pdb')
+
+    cls.launchProtocol(protImport)
+    return protImport
+
+  @classmethod
+  def _runMinimizeSet(cls, protImport):
+    protMinimize = cls.newProtocol(
+      ProtOpenMMMinimizeSet,
+      inputAtomStructs=protImport.outputAtomStructs,
+      maxIter=100)
+
+    cls.launchProtocol(protMinimize)
+    return protMinimize
+
+  def test(self):
+    protImport = self._runImportAtomStructs()
+    self._waitOutput(protImport, 'outputAtomStructs', sleepTime=5)
+
+    protMinimize = self._runMinimizeSet(protImport)
+    self._waitOutput(protMinimize, 'outputAtomStructs', sleepTime=10)
+    self.assertEqual(len(protMinimize.outputAtomStructs), len(protImport.outputAtomStructs))
+
+
+class TestOpenMMImports(BaseTest):
+  """Import time of the plugin and dependencies of its scripts, which run in the OpenMM environment"""
+  IMPORT_CHECK = "import sys, time; t0 = time.time(); import {}; print(time.time() - t0); print(' '.join(sys.modules))"
+  HEAVY_MODULES = ['matplotlib', 'scipion.install']
+  SCIPION_MODULES = ['pyworkflow', 'pwem', 'pwchem', 'scipion', 'matplotlib']
+
+  def _importModules(self, modules):
+    output = subprocess.check_output([sys.executable, '-c', self.IMPORT_CHECK.format(modules)], text=True)
+    importTime, loaded = output.strip().split('\n')[-2:]
+    return float(importTime), set(loaded.split())
+
+  def test_pluginImport(self):
+    pluginName = __name__.split('.')[0]
+    baseTime, baseModules = self._importModules('pwem.protocols, pwchem.protocols, pwchem.objects')
+    pluginTime, pluginModules = self._importModules(f'{pluginName}, {pluginName}.protocols')
+    print(f'Dependencies import: {baseTime:.2f} s. Plugin and protocols import: {pluginTime:.2f} s')
+
+    heavy = [mod for mod in pluginModules - baseModules
+             if any(mod == heavyMod or mod.startswith(heavyMod + '.') for heavyMod in self.HEAVY_MODULES)]
+    self.assertEqual(heavy, [], 'Modules only needed by viewers or installation are imported with the plugin')
+
+  def test_scriptsImports(self):
+    scriptsDir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts')
+    for script in glob.glob(os.path.join(scriptsDir, '*.py')):
+      with open(script) as f:
+        tree = ast.parse(f.read())
+      for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+          modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+          self.assertEqual(node.level, 0, f'{os.path.basename(script)} uses a relative import')
+          modules = [node.module]
+        else:
+          continue
+        for module in modules:
+          self.assertNotIn(module.split('.')[0], self.SCIPION_MODULES,
+                           f'{os.path.basename(script)} imports {module}, not available in the OpenMM environment')
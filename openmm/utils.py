@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Biocomputing Unit, CNB-CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, re, json, time, fcntl, shutil, socket, hashlib
+import numpy as np
+
+from pyworkflow.protocol import params
+
+from . import Plugin
+from .constants import OPENMM_DIC
+
+
+def parseParamsFile(paramsFile):
+  """Parses a "key :: value" file as the ones exchanged with the OpenMM scripts"""
+  paramsDic = {}
+  with open(paramsFile) as f:
+    for line in f:
+      key, value = line.strip().split('::')
+      paramsDic[key.strip()] = value.strip()
+  return paramsDic
+
+def readBinaryLogHeader(fileName):
+  """Returns the header (columns and dtype) of a binary columnar log written by the OpenMM scripts"""
+  with open(fileName + '.json') as f:
+    return json.load(f)
+
+def readBinaryLog(fileName):
+  """Reads a binary columnar log written by the OpenMM scripts without copying it into memory.
+  Returns the column names and a (nRows, nColumns) array with the rows fully written so far"""
+  header = readBinaryLogHeader(fileName)
+  columns, dtype = header['columns'], np.dtype(header['dtype'])
+  nRows = os.path.getsize(fileName) // (dtype.itemsize * len(columns))
+  if nRows == 0:
+    return columns, np.zeros((0, len(columns)), dtype=dtype)
+  return columns, np.memmap(fileName, dtype=dtype, mode='r', shape=(nRows, len(columns)))
+
+def exportBinaryLog(fileName, txtFile):
+  """Writes a binary columnar log as a CSV text file, with the text headers of its columns if it has them"""
+  columns, data = readBinaryLog(fileName)
+  headers = readBinaryLogHeader(fileName).get('headers', columns)
+  np.savetxt(txtFile, data, fmt='%.10g', delimiter=',', header=','.join(f'"{h}"' for h in headers))
+
+# Columns of the StateDataReporter text logs of the simulations run before the binary state log
+TEXT_REPORT_COLUMNS = ['step', 'potentialEnergy', 'temperature', 'volume']
+
+def readReportLog(reportFile):
+  """Reads the state log of a simulation as its column names and a (nRows, nColumns) array: memory mapped for the
+  binary logs or parsed for the text logs of older simulations"""
+  if reportFile.endswith('.txt'):
+    return TEXT_REPORT_COLUMNS, np.loadtxt(reportFile, delimiter=',', ndmin=2)
+  return readBinaryLog(reportFile)
+
+def readTrajectoryIndex(indexFile):
+  """Reads the frame index of a (possibly growing) trajectory written by the simulation script: number of frames
+  fully written, step and time (ps) of the last one, size of the dcd they span and whether the simulation finished"""
+  with open(indexFile) as f:
+    return json.load(f)
+
+def readMonitorLog(monitorFile):
+  """Reads the log of the sanity monitor of a simulation: status (running, finished or aborted), last checkpointed
+  step, simulated time (ps) and the rollback or abort events"""
+  with open(monitorFile) as f:
+    return json.load(f)
+
+def readProfileReport(profileFile):
+  """Reads the profiling report of a simulation: performance (ns/day), wall time (s) of each force group evaluation,
+  step and barostat moves, calls and wall time of each reporter and, for cProfile, its top functions"""
+  with open(profileFile) as f:
+    return json.load(f)
+
+def readDeviceBenchmark(benchmarkFile):
+  """Reads the devices benchmark of a simulation: performance (ns/day) of each configuration (GPU devices and
+  platform, or the CPU) or the error that prevented running on it, and the fastest one"""
+  with open(benchmarkFile) as f:
+    return json.load(f)
+
+def getSimulatedTime(step, stepSize, events=()):
+  """Simulated time (ps) up to a step, with the step size reduced by the rollbacks of the sanity monitor"""
+  time, lastStep = 0, 0
+  for event in events:
+    if event['action'] == 'rollback' and 'stepSize' in event and event['checkpointStep'] < step:
+      time += (event['checkpointStep'] - lastStep) * stepSize
+      lastStep, stepSize = event['checkpointStep'], event['stepSize']
+  return time + (step - lastStep) * stepSize
+
+def getReweightingFactors(biasFile):
+  """Returns the steps of a bias log written by an enhanced sampling simulation and the normalized weights of its
+  frames to recover unbiased averages: exp(rbias / kT), where rbias is the aMD boost or the metadynamics bias minus
+  the c(t) reweighting factor"""
+  kT = 0.0083144626 * readBinaryLogHeader(biasFile)['temperature']
+  columns, data = readBinaryLog(biasFile)
+  logWeights = data[:, columns.index('rbias')] / kT
+  weights = np.exp(logWeights - logWeights.max())
+  return data[:, 0], weights / weights.sum()
+
+def statisticalInefficiency(x):
+  """Statistical inefficiency g of a time series, from the integral of its autocorrelation up to its first zero.
+  One of each g samples is uncorrelated"""
+  x = np.asarray(x, dtype=float) - np.mean(x)
+  n, var = len(x), np.var(x)
+  if n < 3 or var == 0:
+    return 1.0
+
+  g = 1.0
+  for t in range(1, n - 1):
+    corr = np.dot(x[:n - t], x[t:]) / ((n - t) * var)
+    if corr <= 0:
+      break
+    g += 2 * corr * (1 - t / n)
+  return max(g, 1.0)
+
+def subsampleIndexes(x):
+  """Indexes of uncorrelated samples of a time series"""
+  return np.unique(np.round(np.arange(0, len(x), statisticalInefficiency(x))).astype(int))
+
+def logSumExp(a, axis=None, b=None):
+  aMax = np.max(a, axis=axis, keepdims=True)
+  expSum = np.sum(np.exp(a - aMax) if b is None else b * np.exp(a - aMax), axis=axis, keepdims=True)
+  return np.squeeze(aMax + np.log(expSum), axis=axis)
+
+def computeMBAR(uKn, nK, maxIter=10000, tolerance=1e-10):
+  """Multistate Bennett acceptance ratio (Shirts & Chodera, 2008).
+  uKn: (K, N) reduced potentials of all the N pooled samples at each of the K states. nK: samples from each state.
+  Returns the reduced free energies of the states (relative to the first one) and the (K, K) matrix with the
+  uncertainties of their differences"""
+  uKn, nK = np.asarray(uKn, dtype=float), np.asarray(nK, dtype=float)
+  logN = np.log(np.where(nK > 0, nK, 1))[:, None]
+  sampled = nK > 0
+
+  fK = np.zeros(len(nK))
+  for _ in range(maxIter):
+    logDenom = logSumExp(fK[sampled, None] - uKn[sampled] + logN[sampled], axis=0)
+    newF = -logSumExp(-uKn - logDenom, axis=1)
+    newF -= newF[0]
+    converged = np.max(np.abs(newF - fK)) < tolerance
+    fK = newF
+    if converged:
+      break
+
+  # Asymptotic covariance from the weights matrix, using its SVD for numerical stability
+  logDenom = logSumExp(fK[sampled, None] - uKn[sampled] + logN[sampled], axis=0)
+  W = np.exp(fK[:, None] - uKn - logDenom).T
+  U, S, Vt = np.linalg.svd(W, full_matrices=False)
+  V = Vt.T
+  inner = np.identity(len(S)) - (S[:, None] * (V.T * nK) @ V) * S[None, :]
+  theta = V @ (S[:, None] * np.linalg.pinv(inner, rcond=1e-10, hermitian=True) * S[None, :]) @ V.T
+  diag = np.diag(theta)
+  dF = np.sqrt(np.abs(diag[:, None] + diag[None, :] - 2 * theta))
+  return fK, dF
+
+def computeUmbrellaPMF(cvs, centers, ks, temperature, nBins=50, method='MBAR', maxIter=100000, tolerance=1e-8,
+                       distanceJacobian=True):
+  """Potential of mean force (kJ/mol) along a collective variable sampled in harmonic umbrella windows.
+  cvs: list with the (decorrelated) values sampled in each window, centered at centers with force constants ks.
+  MBAR: binless, from the MBAR weights of the pooled samples in the unbiased state.
+  WHAM: iterative weighted histogram analysis over nBins bins.
+  distanceJacobian: the CV is a distance r, so the 2kT*ln(r) volume (Jacobian) term is added to remove the entropic
+  r^2 growth of the spherical shells. Otherwise the raw PMF, -kT*ln(P(r)), is returned.
+  Returns the bin centers and the PMF in them (relative to its minimum)"""
+  kT = 0.0083144626 * temperature
+  centers, ks = np.asarray(centers)[:, None], np.asarray(ks)[:, None]
+  allCVs, nK = np.concatenate(cvs), np.array([len(cv) for cv in cvs], dtype=float)
+  edges = np.linspace(allCVs.min(), allCVs.max(), nBins + 1)
+  binCenters = (edges[1:] + edges[:-1]) / 2
+
+  if method == 'MBAR':
+    uKn = 0.5 * ks * (allCVs[None, :] - centers) ** 2 / kT
+    fK, _ = computeMBAR(uKn, nK)
+    logWeights = -logSumExp(fK[:, None] - uKn + np.log(nK)[:, None], axis=0)
+    weights = np.exp(logWeights - logWeights.max())
+    probs, _ = np.histogram(allCVs, bins=edges, weights=weights)
+  else:
+    counts = np.array([np.histogram(cv, bins=edges)[0] for cv in cvs], dtype=float)
+    biasKb = 0.5 * ks * (binCenters[None, :] - centers) ** 2 / kT
+    fK = np.zeros(len(cvs))
+    for _ in range(maxIter):
+      probs = counts.sum(axis=0) / np.sum(nK[:, None] * np.exp(fK[:, None] - biasKb), axis=0)
+      newF = -np.log(np.sum(probs[None, :] * np.exp(-biasKb), axis=1))
+      newF -= newF[0]
+      converged = np.max(np.abs(newF - fK)) < tolerance
+      fK = newF
+      if converged:
+        break
+
+  with np.errstate(divide='ignore'):
+    pmf = -kT * np.log(probs / probs.sum())
+    if distanceJacobian:
+      pmf += 2 * kT * np.log(binCenters)
+  return binCenters, pmf - pmf[np.isfinite(pmf)].min()
+
+def getStructureFile(baseName):
+  """Returns the structure file written by a script with this base name: <baseName>.pdb or, for systems too large
+  for the PDB format, <baseName>.cif"""
+  cifFile = baseName + '.cif'
+  return cifFile if not os.path.exists(baseName + '.pdb') and os.path.exists(cifFile) else baseName + '.pdb'
+
+def writeLigandParams(f, ligandFiles, ligandFF):
+  """Writes in a script params file the ligands to parametrize and the on-disk cache of their parameters"""
+  if ligandFiles:
+    f.write('ligandFiles :: {}\n'.format(','.join(ligandFiles)))
+    f.write('ligandFF :: {}\n'.format(ligandFF))
+    f.write('ligandCache :: {}\n'.format(Plugin.getLigandCacheFile(ligandFF)))
+
+def writeSystemParams(f, system):
+  """Writes in a script params file the parameters needed to build the OpenMM System of an OpenMMSystem"""
+  f.write('mFF :: {}\nwFF :: {}\n'.format(system.getForceField(), system.getWaterForceField()))
+  writeLigandParams(f, system.getLigandFiles(), system.getLigandForceField())
+  f.write('nbMethod :: {}\nnbCutoff :: {}\n'.format(system._nbMethod.get(), system._nbCutoff.get()))
+  f.write('solventType :: {}\n'.format(system.getSolventType()))
+  if system.isImplicit():
+    f.write('implicitSalt :: {}\n'.format(system.getSaltConcentration() or 0))
+
+def hashInputs(inFiles, paramsFile, pathKeys=('inputFile', 'ligandFiles', 'ligandCache')):
+  """Content hash of some input files and a script params file. The lines of the params file containing paths
+  are skipped, so the hash only depends on the contents of the inputs and not on the project they come from"""
+  sha = hashlib.sha256()
+  for inFile in inFiles:
+    with open(inFile, 'rb') as f:
+      for block in iter(lambda: f.read(2 ** 20), b''):
+        sha.update(block)
+
+  with open(paramsFile) as f:
+    for line in f:
+      if line.split('::')[0].strip() not in pathKeys:
+        sha.update(line.encode())
+  return sha.hexdigest()
+
+def storeInCache(cacheDir, files):
+  """Stores a set of files in a cache entry {name: file}. The entry is written in a temporary directory and then
+  renamed, so concurrent protocols never see it half written"""
+  tmpDir = '{}.tmp{}'.format(cacheDir, os.getpid())
+  os.makedirs(tmpDir, exist_ok=True)
+  for name, inFile in files.items():
+    shutil.copy(inFile, os.path.join(tmpDir, name))
+  try:
+    os.rename(tmpDir, cacheDir)
+  except OSError:
+    # Another protocol stored the same entry meanwhile
+    shutil.rmtree(tmpDir)
+
+def isInCache(cacheDir):
+  """Returns whether a cache entry exists, marking it as recently used for the eviction"""
+  if not os.path.isdir(cacheDir):
+    return False
+  os.utime(cacheDir)
+  return True
+
+def evictCache(cacheRoot, maxSize):
+  """Removes the least recently used entries of a cache directory until their total size (bytes) is below maxSize"""
+  entries = []
+  for name in os.listdir(cacheRoot):
+    entryDir = os.path.join(cacheRoot, name)
+    if os.path.isdir(entryDir) and '.tmp' not in name:
+      size = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+      entries.append((os.path.getmtime(entryDir), size, entryDir))
+
+  totalSize = sum(size for _, size, _ in entries)
+  for _, size, entryDir in sorted(entries):
+    if totalSize <= maxSize:
+      break
+    shutil.rmtree(entryDir, ignore_errors=True)
+    totalSize -= size
+
+
+################# Local resources scheduler #################
+# The GPUs and CPU cores of the node are leased to the OpenMM jobs of every project running on it, so concurrent
+# protocols never share a device: jobs wait until their resources are free
+
+def getSchedulerDir():
+  schedulerDir = Plugin.getCacheDir(os.path.join('scheduler', socket.gethostname()))
+  os.makedirs(schedulerDir, exist_ok=True)
+  return schedulerDir
+
+class ResourceLease(object):
+  """Exclusive lease of up to maxGpus of some GPUs (or, if none, of nThreads CPU cores) of the node.
+  Each device and core is a lock file in the scheduler directory, locked (fcntl) while the lease is held, so it is
+  released by the kernel even if the job dies. The use of each lease is recorded in the usage log of the directory"""
+
+  def __init__(self, gpus=(), maxGpus=1, nThreads=1, jobName='', pollSecs=10):
+    self.requestedGpus, self.maxGpus = list(gpus), maxGpus or len(gpus)
+    self.requestedThreads = max(1, min(nThreads, os.cpu_count()))
+    self.jobName, self.pollSecs = jobName, pollSecs
+    self.gpus, self.nThreads, self._locks = [], 0, []
+
+  def _lock(self, resource):
+    f = open(os.path.join(getSchedulerDir(), f'{resource}.lock'), 'a')
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      f.close()
+      return False
+    self._locks.append(f)
+    return True
+
+  def _unlock(self):
+    for f in self._locks:
+      fcntl.flock(f, fcntl.LOCK_UN)
+      f.close()
+    self._locks = []
+
+  def tryAcquire(self):
+    """GPU jobs get at least one and up to maxGpus of the requested GPUs that are free. CPU jobs need their
+    nThreads cores at once"""
+    if self.requestedGpus:
+      for gpu in self.requestedGpus:
+        if len(self.gpus) < self.maxGpus and self._lock(f'gpu_{gpu}'):
+          self.gpus.append(gpu)
+      acquired = len(self.gpus) > 0
+    else:
+      nCores = 0
+      for core in range(os.cpu_count()):
+        if nCores == self.requestedThreads:
+          break
+        nCores += self._lock(f'cpu_{core}')
+      acquired = nCores == self.requestedThreads
+      self.nThreads = nCores if acquired else 0
+
+    if not acquired:
+      self._unlock()
+      self.gpus = []
+    return acquired
+
+  def acquire(self):
+    """Waits (polling) until the resources are free"""
+    self._requestTime = time.time()
+    if not self.tryAcquire():
+      print('Waiting for {} to be free'.format(f'GPUs {self.requestedGpus}' if self.requestedGpus else
+                                                f'{self.requestedThreads} CPU cores'), flush=True)
+      while not self.tryAcquire():
+        time.sleep(self.pollSecs)
+    self._startTime = time.time()
+
+  def release(self):
+    self._unlock()
+    record = {'job': self.jobName, 'gpus': self.gpus, 'threads': self.nThreads,
+              'request': self._requestTime, 'start': self._startTime, 'end': time.time()}
+    with open(os.path.join(getSchedulerDir(), 'usage.log'), 'a') as f:
+      f.write(json.dumps(record) + '\n')
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.release()
+
+def getResourceUsage(since=None):
+  """Summary of the leases recorded in the node since a time (epoch seconds): number of jobs, mean waiting time (s)
+  and busy seconds of each GPU and of the CPU cores (core-seconds)"""
+  usageFile = os.path.join(getSchedulerDir(), 'usage.log')
+  records = []
+  if os.path.exists(usageFile):
+    with open(usageFile) as f:
+      records = [json.loads(line) for line in f if line.strip()]
+  records = [r for r in records if since is None or r['end'] >= since]
+
+  busy = {}
+  for r in records:
+    duration = r['end'] - max(r['start'], since or r['start'])
+    for gpu in r['gpus']:
+      busy[f'gpu_{gpu}'] = busy.get(f'gpu_{gpu}', 0) + duration
+    busy['cpu'] = busy.get('cpu', 0) + r['threads'] * duration
+  waits = [r['start'] - r['request'] for r in records]
+  return {'jobs': len(records), 'meanWait': float(np.mean(waits)) if waits else 0.0, 'busy': busy}
+
+def updateParamsFile(paramsFile, values):
+  """Sets the values of some keys of a script params file"""
+  with open(paramsFile) as f:
+    lines = [line for line in f if line.split('::')[0].strip() not in values]
+  with open(paramsFile, 'w') as f:
+    f.writelines(lines + ['{} :: {}\n'.format(key, value) for key, value in values.items()])
+
+def runScheduledScript(protocol, scriptName, paramsFile, cwd, maxGpus=1):
+  """Runs an OpenMM script of a protocol once the scheduler leases it its resources: up to maxGpus (None: all) of
+  the protocol GPUs, or its number of threads in CPU cores. Their ids are set in the params file (gpus, nThreads)"""
+  gpus = []
+  if getattr(protocol, params.USE_GPU).get():
+    gpus = [gpu for gpu in re.split(r'[\s,]+', str(getattr(protocol, params.GPU_LIST).get())) if gpu]
+  nThreads = protocol.numberOfThreads.get() if hasattr(protocol, 'numberOfThreads') else 1
+
+  with ResourceLease(gpus, maxGpus, nThreads, jobName=protocol.getRunName()) as lease:
+    leased = {'nThreads': lease.nThreads or nThreads}
+    if lease.gpus:
+      leased['gpus'] = ','.join(lease.gpus)
+    updateParamsFile(paramsFile, leased)
+    Plugin.runScript(protocol, scriptName, args=paramsFile, env=OPENMM_DIC, cwd=cwd)
@@ -5,3 +5,4 @@
 # **************************************************************************
 
 from .viewer_system import *
+from .viewer_umbrella import *
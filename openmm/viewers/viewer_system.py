@@ -26,7 +26,6 @@
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 
 import pyworkflow.protocol.params as params
 
@@ -35,8 +34,10 @@ from pwchem.utils import natural_sort
 from pwchem.constants import TCL_MD_STR
 
 from ..objects import OpenMMSystem
+from ..utils import readBinaryLog, readBinaryLogHeader, getReweightingFactors, readProfileReport, readReportLog
 
 PENERGY, TEMP, VOL = 0, 1, 2
+REPORT_COLUMNS = ['potentialEnergy', 'temperature', 'volume']
 
 class OpenMMSystemPViewer(MDSystemPViewer):
     """ Visualize the output of OpenMM simulation """
@@ -57,15 +58,63 @@ class OpenMMSystemPViewer(MDSystemPViewer):
                      label='Plot reporter trajectory analysis: ',
                      help='Plots a graph with the reporter feature chosen over the trajectory')
 
+    def _defineEnergyGroupsParams(self, form):
+      groupNames = readBinaryLogHeader(self.getMDSystem().getEnergyGroupsFile())['columns'][1:]
+      group = form.addGroup('Energy decomposition')
+      group.addParam('energyGroup', params.EnumParam, label='Display force group: ', default=0,
+                     choices=['All'] + groupNames,
+                     help='Force group whose potential energy will be plotted')
+      group.addParam('displayEnergyGroups', params.LabelParam,
+                     label='Plot energy decomposition: ',
+                     help='Plots the potential energy of the chosen force group (or all of them) over the trajectory')
+
+    def _defineBiasParams(self, form):
+      group = form.addGroup('Enhanced sampling')
+      group.addParam('displayBias', params.LabelParam,
+                     label='Plot bias: ',
+                     help='Plots the bias (and the collective variables, if any) over the trajectory')
+      if self.getMDSystem().getReportFile():
+        group.addParam('displayReweighted', params.LabelParam,
+                       label='Plot reweighted reporter feature: ',
+                       help='Plots the distribution of the reporter feature chosen, both as sampled and reweighted '
+                            'with the bias of each frame to recover the unbiased distribution')
+      if len(readBinaryLogHeader(self.getMDSystem().getBiasFile())['columns']) > 3:
+        group.addParam('displayFES', params.LabelParam,
+                       label='Plot reweighted free energy surface: ',
+                       help='Plots the free energy over the first (or first two) collective variables, from their '
+                            'reweighted distribution')
+
+    def _defineProfileParams(self, form):
+      group = form.addGroup('Profiling')
+      group.addParam('displayProfile', params.LabelParam,
+                     label='Plot profiling report: ',
+                     help='Plots the wall time of the evaluation of each force group, of a step (with the barostat '
+                          'moves and reporters share) and, if profiled with cProfile, of the top python functions')
+
     def _defineParams(self, form):
       super()._defineParams(form)
 
-      if self.getMDSystem().hasTrajectory():
+      if self.getMDSystem().hasTrajectory() and self.getMDSystem().getReportFile():
           self._defineReportParams(form)
 
+      if self.getMDSystem().getEnergyGroupsFile():
+          self._defineEnergyGroupsParams(form)
+
+      if self.getMDSystem().getBiasFile():
+          self._defineBiasParams(form)
+
+      profileFile = self.getMDSystem().getProfileFile()
+      if profileFile and os.path.exists(profileFile):
+          self._defineProfileParams(form)
+
     def _getVisualizeDict(self):
       dispDic = super()._getVisualizeDict()
-      dispDic.update({'displayReporter': self._showReportParameter})
+      dispDic.update({'displayReporter': self._showReportParameter,
+                      'displayEnergyGroups': self._showEnergyGroups,
+                      'displayBias': self._showBias,
+                      'displayReweighted': self._showReweighted,
+                      'displayFES': self._showFES,
+                      'displayProfile': self._showProfile})
       return dispDic
 
     def getMDSystem(self, objType=OpenMMSystem):
@@ -74,15 +123,25 @@ class OpenMMSystemPViewer(MDSystemPViewer):
         else:
             return self.protocol.outputSystem
 
+    def readReport(self, system):
+      """Column names and rows of the reporter log. If the trajectory is still growing, only those up to its last
+      indexed frame. The binary logs are not copied into memory"""
+      columns, data = readReportLog(system.getReportFile())
+      if system.isStreamOpen():
+        data = data[:np.searchsorted(data[:, 0], system.getTrajectoryIndex()['step'], side='right')]
+      return columns, data
+
+    def getReportFeature(self, columns, data):
+      return data[:, columns.index(REPORT_COLUMNS[self.repFeature.get()])]
+
     def _showReportParameter(self, paramName=None):
+      import matplotlib.pyplot as plt
       system = self.getMDSystem()
-      repFile = system.getReportFile()
-
-      data = np.loadtxt(repFile, delimiter=',')
+      columns, data = self.readReport(system)
       step = data[:, 0]
 
       if self.repFeature.get() == PENERGY:
-        potentialEnergy = data[:, 1]
+        potentialEnergy = self.getReportFeature(columns, data)
         plt.plot(step, potentialEnergy)
         plt.title(f'{system.getSystemName()} trajectory potential energy')
         plt.xlabel("Step")
@@ -90,7 +149,7 @@ class OpenMMSystemPViewer(MDSystemPViewer):
         plt.show()
 
       elif self.repFeature.get() == TEMP:
-        temperature = data[:, 2]
+        temperature = self.getReportFeature(columns, data)
         plt.plot(step, temperature)
         plt.title(f'{system.getSystemName()} trajectory temperature')
         plt.xlabel("Step")
@@ -98,11 +157,119 @@ class OpenMMSystemPViewer(MDSystemPViewer):
         plt.show()
 
       elif self.repFeature.get() == VOL:
-        volume = data[:, 3]
+        volume = self.getReportFeature(columns, data)
         plt.plot(step, volume)
         plt.title(f'{system.getSystemName()} trajectory volume')
         plt.xlabel("Step")
         plt.ylabel("Volume (nm^3)")
         plt.show()
 
+    def _showEnergyGroups(self, paramName=None):
+      import matplotlib.pyplot as plt
+      system = self.getMDSystem()
+      columns, data = readBinaryLog(system.getEnergyGroupsFile())
+      step = data[:, 0]
+
+      groupIdxs = range(1, len(columns)) if self.energyGroup.get() == 0 else [self.energyGroup.get()]
+      for idx in groupIdxs:
+        plt.plot(step, data[:, idx], label=columns[idx])
+      plt.title(f'{system.getSystemName()} potential energy decomposition')
+      plt.xlabel("Step")
+      plt.ylabel("Potential energy (kJ/mol)")
+      plt.legend()
+      plt.show()
+
+    def _showBias(self, paramName=None):
+      import matplotlib.pyplot as plt
+      system = self.getMDSystem()
+      columns, data = readBinaryLog(system.getBiasFile())
+      step = data[:, 0]
+
+      cvColumns = columns[3:]
+      fig, axes = plt.subplots(len(cvColumns) + 1, 1, sharex=True, squeeze=False)
+      axes[0, 0].plot(step, data[:, 1])
+      axes[0, 0].set_ylabel("Bias (kJ/mol)")
+      axes[0, 0].set_title(f'{system.getSystemName()} {readBinaryLogHeader(system.getBiasFile())["method"]} bias')
+      for i, cvName in enumerate(cvColumns):
+        axes[i + 1, 0].plot(step, data[:, columns.index(cvName)])
+        axes[i + 1, 0].set_ylabel(cvName)
+      axes[-1, 0].set_xlabel("Step")
+      plt.show()
+
+    def _showReweighted(self, paramName=None):
+      import matplotlib.pyplot as plt
+      system = self.getMDSystem()
+      columns, repData = self.readReport(system)
+      biasSteps, weights = getReweightingFactors(system.getBiasFile())
+      _, repIdxs, biasIdxs = np.intersect1d(repData[:, 0], biasSteps, return_indices=True)
+
+      values = self.getReportFeature(columns, repData)[repIdxs]
+      featureName = ['Potential energy (kJ/mol)', 'Temperature (K)', 'Volume (nm^3)'][self.repFeature.get()]
+      bins = np.histogram_bin_edges(values, bins='auto')
+      plt.hist(values, bins=bins, density=True, alpha=0.5, label='Sampled')
+      plt.hist(values, bins=bins, weights=weights[biasIdxs], density=True, alpha=0.5, label='Reweighted')
+      plt.title(f'{system.getSystemName()} reweighted distribution')
+      plt.xlabel(featureName)
+      plt.ylabel("Density")
+      plt.legend()
+      plt.show()
+
+    def _showFES(self, paramName=None, nBins=50):
+      import matplotlib.pyplot as plt
+      system = self.getMDSystem()
+      kT = 0.0083144626 * readBinaryLogHeader(system.getBiasFile())['temperature']
+      columns, data = readBinaryLog(system.getBiasFile())
+      _, weights = getReweightingFactors(system.getBiasFile())
+
+      cvColumns = columns[3:5]
+      cvValues = [data[:, columns.index(cvName)] for cvName in cvColumns]
+      hist, edges = np.histogramdd(cvValues, bins=nBins, weights=weights)
+      with np.errstate(divide='ignore'):
+        fes = -kT * np.log(hist)
+      fes -= fes[np.isfinite(fes)].min()
+
+      centers = [(edge[1:] + edge[:-1]) / 2 for edge in edges]
+      if len(cvColumns) == 1:
+        plt.plot(centers[0], fes)
+        plt.ylabel("Free energy (kJ/mol)")
+      else:
+        plt.contourf(centers[0], centers[1], fes.T, levels=20)
+        plt.colorbar(label="Free energy (kJ/mol)")
+        plt.ylabel(cvColumns[1])
+      plt.xlabel(cvColumns[0])
+      plt.title(f'{system.getSystemName()} reweighted free energy surface')
+      plt.show()
+
+    def _showProfile(self, paramName=None, nFunctions=15):
+      import matplotlib.pyplot as plt
+      system = self.getMDSystem()
+      report = readProfileReport(system.getProfileFile())
+      functions = report.get('functions', [])[:nFunctions]
+      fig, axes = plt.subplots(3 if functions else 2, 1, squeeze=False, figsize=(8, 10 if functions else 7))
+
+      groupNames = list(report['forceGroups'])
+      axes[0, 0].barh(groupNames, [1000 * report['forceGroups'][name] for name in groupNames])
+      axes[0, 0].invert_yaxis()
+      axes[0, 0].set_xlabel('Forces and energy evaluation (ms)')
+      axes[0, 0].set_title('{} profiling: {:.1f} ns/day, {} atoms ({})'.format(
+        system.getSystemName(), report['nsPerDay'], report['atoms'], report['platform']))
+
+      # Cost per step of the integration, barostat moves and each reporter
+      stepNames, stepTimes = ['Step'], [report['stepTime']]
+      if report.get('barostatTime') is not None:
+        stepNames.append('Barostat moves')
+        stepTimes.append(report['barostatTime'])
+      for name, reporterTimes in report['reporters'].items():
+        stepNames.append(name)
+        stepTimes.append(reporterTimes['time'] / max(report['steps'], 1))
+      axes[1, 0].barh(stepNames, [1000 * t for t in stepTimes])
+      axes[1, 0].invert_yaxis()
+      axes[1, 0].set_xlabel('Wall time per step (ms)')
 
+      if functions:
+        axes[2, 0].barh([function['function'] for function in functions],
+                        [function['cumtime'] for function in functions])
+        axes[2, 0].invert_yaxis()
+        axes[2, 0].set_xlabel('Cumulative time of the python functions (s)')
+      fig.tight_layout()
+      plt.show()
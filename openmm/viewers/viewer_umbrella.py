@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+import pyworkflow.protocol.params as params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER, WEB_DJANGO
+
+from ..protocols import ProtOpenMMUmbrellaSampling
+from ..utils import readBinaryLog, subsampleIndexes, computeUmbrellaPMF
+
+
+class ProtOpenMMUmbrellaViewer(ProtocolViewer):
+    """ Visualize the steered MD and the PMF of an umbrella sampling """
+    _label = 'Viewer umbrella sampling'
+    _targets = [ProtOpenMMUmbrellaSampling]
+    _environments = [DESKTOP_TKINTER, WEB_DJANGO]
+
+    def _defineParams(self, form):
+      form.addSection(label='Visualization of umbrella sampling')
+      group = form.addGroup('Potential of mean force')
+      group.addParam('pmfMethod', params.EnumParam, label='PMF estimator: ', default=0,
+                     choices=['MBAR', 'WHAM'], display=params.EnumParam.DISPLAY_HLIST,
+                     help='MBAR: binless estimate from the pooled samples. WHAM: weighted histogram analysis')
+      group.addParam('nBins', params.IntParam, label='Number of bins: ', default=50,
+                     help='Number of bins along the pulling coordinate')
+      group.addParam('decorrelate', params.BooleanParam, label='Decorrelate samples: ', default=True,
+                     help='Keep only the uncorrelated samples of each window, from its statistical inefficiency')
+      group.addParam('distanceJacobian', params.BooleanParam, label='Jacobian correction: ', default=True,
+                     help='Add the 2kT*ln(r) Jacobian term of the distance to the PMF, removing the entropic bias of '
+                          'the volume of the spherical shells growing as r^2. If not, the raw PMF, -kT*ln(P(r)), is '
+                          'plotted')
+      group.addParam('displayPMF', params.LabelParam, label='Plot PMF: ',
+                     help='Plots the potential of mean force along the pulling coordinate')
+      group.addParam('displayHistograms', params.LabelParam, label='Plot windows histograms: ',
+                     help='Plots the distribution of the distance sampled in each window, to check their overlap')
+
+      group = form.addGroup('Steered MD')
+      group.addParam('displaySMD', params.LabelParam, label='Plot pulling: ',
+                     help='Plots the distance and the center of the moving bias during the steered MD')
+
+    def _getVisualizeDict(self):
+      return {'displayPMF': self._showPMF,
+              'displayHistograms': self._showHistograms,
+              'displaySMD': self._showSMD}
+
+    def _showPMF(self, paramName=None):
+      import matplotlib.pyplot as plt
+      cvs, centers, ks, temperature = self.protocol.getWindowsData()
+      if self.decorrelate.get():
+        cvs = [cv[subsampleIndexes(cv)] for cv in cvs]
+
+      x, pmf = computeUmbrellaPMF(cvs, centers, ks, temperature, nBins=self.nBins.get(),
+                                  method=self.getEnumText('pmfMethod'), distanceJacobian=self.distanceJacobian.get())
+      plt.plot(x, pmf)
+      plt.title(f'Potential of mean force ({self.getEnumText("pmfMethod")})')
+      plt.xlabel("Distance (nm)")
+      plt.ylabel("PMF (kJ/mol)")
+      plt.show()
+
+    def _showHistograms(self, paramName=None):
+      import matplotlib.pyplot as plt
+      cvs, centers, _, _ = self.protocol.getWindowsData()
+      bins = np.linspace(np.min([cv.min() for cv in cvs]), np.max([cv.max() for cv in cvs]), self.nBins.get() + 1)
+      for cv in cvs:
+        plt.hist(cv, bins=bins, histtype='step')
+      plt.title('Umbrella windows distributions')
+      plt.xlabel("Distance (nm)")
+      plt.ylabel("Counts")
+      plt.show()
+
+    def _showSMD(self, paramName=None):
+      import matplotlib.pyplot as plt
+      columns, data = readBinaryLog(self.protocol.getSMDFile())
+      plt.plot(data[:, 0], data[:, 2], label='Distance')
+      plt.plot(data[:, 0], data[:, 1], label='Bias center')
+      plt.title('Steered MD pulling')
+      plt.xlabel("Step")
+      plt.ylabel("Distance (nm)")
+      plt.legend()
+      plt.show()